@@ -1,8 +1,12 @@
 import os
+import time
+from collections import OrderedDict
 
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from metrics import DB_SECONDS
+
 load_dotenv()
 
 # Читаем MONGO_URI из .env (или используем дефолт)
@@ -13,6 +17,16 @@ client = AsyncIOMotorClient(MONGO_URI)
 db = client["shinobi_db"]         # ваша БД
 users_collection = db["users"]     # коллекция для хранения пользователей
 
+# =========================
+# Кэш прав доступа (in-process): user_id -> (истекает_в, документ или None)
+# Заполняется одним запросом с проекцией, сбрасывается при изменении прав.
+# =========================
+PERMISSION_CACHE_TTL = float(os.getenv("PERMISSION_CACHE_TTL", 60))
+PERMISSION_CACHE_SIZE = int(os.getenv("PERMISSION_CACHE_SIZE", 10000))
+ACCESS_PROJECTION = {"_id": 0, "user_id": 1, "username": 1, "is_admin": 1, "is_allowed": 1, "video_tier": 1}
+
+_access_cache = OrderedDict()
+
 
 async def init_db():
     """
@@ -22,13 +36,39 @@ async def init_db():
     await users_collection.create_index("user_id", unique=True)
 
 
+def invalidate_user_access(user_id: int):
+    """Сбрасываем закэшированные права пользователя (после любой записи в его документ)."""
+    _access_cache.pop(user_id, None)
+
+
+async def get_user_access(user_id: int) -> dict | None:
+    """
+    Права пользователя (user_id, username, is_admin, is_allowed) или None,
+    если записи нет. Из кэша, пока не истёк TTL; иначе один find_one с проекцией.
+    Отсутствие записи тоже кэшируется — allow_user/set_admin его сбросят.
+    """
+    now = time.monotonic()
+    entry = _access_cache.get(user_id)
+    if entry is not None and entry[0] > now:
+        _access_cache.move_to_end(user_id)
+        return entry[1]
+
+    with DB_SECONDS.time(op="get_user_access"):
+        doc = await users_collection.find_one({"user_id": user_id}, ACCESS_PROJECTION)
+    _access_cache[user_id] = (now + PERMISSION_CACHE_TTL, doc)
+    _access_cache.move_to_end(user_id)
+    while len(_access_cache) > PERMISSION_CACHE_SIZE:
+        _access_cache.popitem(last=False)
+    return doc
+
+
 async def get_or_create_user(user_id: int, username: str) -> dict:
     """
     Возвращает документ (dict) о пользователе по user_id.
     Если пользователя нет — создаём новую запись (is_admin=False, is_allowed=False).
     Также сохраняем username (если есть).
     """
-    doc = await users_collection.find_one({"user_id": user_id})
+    doc = await get_user_access(user_id)
     if doc:
         return doc
 
@@ -38,19 +78,21 @@ async def get_or_create_user(user_id: int, username: str) -> dict:
         "is_admin": False,
         "is_allowed": False
     }
-    await users_collection.insert_one(new_doc)
+    with DB_SECONDS.time(op="insert_user"):
+        await users_collection.insert_one(new_doc)
+    invalidate_user_access(user_id)
     return new_doc
 
 
 async def is_user_admin(user_id: int) -> bool:
     """Проверяем, есть ли user_id в БД и установлен ли ему is_admin=True."""
-    doc = await users_collection.find_one({"user_id": user_id})
+    doc = await get_user_access(user_id)
     return bool(doc and doc.get("is_admin"))
 
 
 async def is_user_allowed(user_id: int) -> bool:
     """Проверяем, есть ли user_id в БД и установлен ли ему is_allowed=True."""
-    doc = await users_collection.find_one({"user_id": user_id})
+    doc = await get_user_access(user_id)
     return bool(doc and doc.get("is_allowed"))
 
 
@@ -59,11 +101,13 @@ async def set_admin(user_id: int, is_admin: bool):
     Устанавливаем (или снимаем) флаг is_admin пользователю user_id.
     upsert=True -> если записи нет, создаём.
     """
-    await users_collection.update_one(
-        {"user_id": user_id},
-        {"$set": {"is_admin": is_admin}},
-        upsert=True
-    )
+    with DB_SECONDS.time(op="set_admin"):
+        await users_collection.update_one(
+            {"user_id": user_id},
+            {"$set": {"is_admin": is_admin}},
+            upsert=True
+        )
+    invalidate_user_access(user_id)
 
 
 async def allow_user(user_id: int) -> bool:
@@ -72,24 +116,70 @@ async def allow_user(user_id: int) -> bool:
     Если записи нет — создаём (is_admin=False, is_allowed=True).
     Возвращает True, если мы обновили / создали запись.
     """
-    res = await users_collection.update_one(
-        {"user_id": user_id},
-        {"$set": {"is_allowed": True}},
-        upsert=True
-    )
+    with DB_SECONDS.time(op="allow_user"):
+        res = await users_collection.update_one(
+            {"user_id": user_id},
+            {"$set": {"is_allowed": True}},
+            upsert=True
+        )
+    invalidate_user_access(user_id)
     return (res.modified_count > 0 or res.upserted_id is not None)
 
 
+async def set_video_tier(user_id: int, tier: str | None) -> bool:
+    """
+    Личный уровень кодирования видео (service.video_profiles.VIDEO_TIERS).
+    tier=None — сброс к глобальному. Возвращает True, если пользователь найден.
+    """
+    update = {"$set": {"video_tier": tier}} if tier else {"$unset": {"video_tier": ""}}
+    with DB_SECONDS.time(op="set_video_tier"):
+        res = await users_collection.update_one({"user_id": user_id}, update)
+    invalidate_user_access(user_id)
+    return res.matched_count > 0
+
+
 async def remove_user(user_id: int) -> bool:
     """
     Полностью удаляем запись из БД.
     Возвращает True, если пользователь был удалён.
     """
-    res = await users_collection.delete_one({"user_id": user_id})
+    with DB_SECONDS.time(op="remove_user"):
+        res = await users_collection.delete_one({"user_id": user_id})
+    invalidate_user_access(user_id)
     return (res.deleted_count > 0)
 
 
 async def get_all_users() -> list:
     """Возвращает список (list) всех пользователей (dict) из коллекции."""
     cursor = users_collection.find({})
-    return await cursor.to_list(None)
+    with DB_SECONDS.time(op="get_all_users"):
+        return await cursor.to_list(None)
+
+
+async def get_user_page(cursor: int = None, direction: str = "next") -> dict | None:
+    """
+    Одна «страница» карусели — один пользователь относительно курсора user_id
+    (идём по уникальному индексу, а не грузим всю коллекцию):
+      - cursor=None      -> первый пользователь;
+      - direction="next" -> первый с user_id > cursor;
+      - direction="prev" -> последний с user_id < cursor;
+      - direction="at"   -> сам cursor или следующий за ним.
+    Возвращает документ (с проекцией) или None.
+    """
+    if cursor is None:
+        query, order = {}, 1
+    elif direction == "next":
+        query, order = {"user_id": {"$gt": cursor}}, 1
+    elif direction == "prev":
+        query, order = {"user_id": {"$lt": cursor}}, -1
+    else:
+        query, order = {"user_id": {"$gte": cursor}}, 1
+
+    with DB_SECONDS.time(op="get_user_page"):
+        return await users_collection.find_one(query, ACCESS_PROJECTION, sort=[("user_id", order)])
+
+
+async def count_users() -> int:
+    """Количество пользователей по метаданным коллекции (без сканирования)."""
+    with DB_SECONDS.time(op="count_users"):
+        return await users_collection.estimated_document_count()
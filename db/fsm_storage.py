@@ -0,0 +1,148 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+from pymongo import UpdateOne, DeleteOne
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
+
+from metrics import DB_SECONDS
+
+load_dotenv()
+
+# "memory" — MemoryStorage aiogram (как раньше), "mongo" — MongoFSMStorage ниже
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+# Сколько секунд состояние читается из локального кэша без запроса в БД; 0 — каждое чтение из БД.
+# Кэш не знает о записях других реплик: при нескольких репликах без привязки пользователя
+# к реплике (sticky routing) реплика до конца TTL видит старое состояние и шаг диалога
+# уходит не в тот хендлер. Положительный TTL — только для одной реплики или sticky routing.
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", 0))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 10000))
+# Изменения копятся и пишутся одной пачкой раз в столько секунд
+# (до записи другие реплики видят прежнее состояние)
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.5))
+
+
+class MongoFSMStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в MongoDB (коллекция fsm: _id = ключ, state, data):
+      - состояние переживает перезапуск и общее для нескольких реплик бота;
+      - чтение — один find_one; кэш процесса (FSM_CACHE_TTL > 0) — только при одной
+        реплике или sticky routing, иначе чужие изменения видны лишь после TTL;
+      - запись — в кэш сразу, в БД отложенно: все изменения за FSM_FLUSH_INTERVAL
+        уходят одним bulk_write, несколько изменений одного ключа — одной операцией;
+      - пустое состояние (state=None, data={}) удаляет документ.
+    """
+
+    def __init__(self, database, collection: str = "fsm", cache_ttl: float = FSM_CACHE_TTL,
+                 flush_interval: float = FSM_FLUSH_INTERVAL, cache_size: int = FSM_CACHE_SIZE):
+        self._collection = database[collection]
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache_ttl = cache_ttl
+        self._flush_interval = flush_interval
+        self._cache_size = cache_size
+        self._cache = {}      # ключ -> (истекает_в, state, data)
+        self._dirty = set()   # ключи, ещё не записанные в БД
+        self._flushing = set()  # ключи текущего bulk_write: в БД, возможно, ещё старое значение
+        self._timer = None
+        self._flush_lock = asyncio.Lock()
+
+    # ---------- API BaseStorage ----------
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        doc_key = self._key(key)
+        _, data = await self._load(doc_key)
+        self._put(doc_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        doc_key = self._key(key)
+        state, _ = await self._load(doc_key)
+        self._put(doc_key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data = await self._load(self._key(key))
+        return dict(data)
+
+    async def close(self) -> None:
+        """Дописываем отложенные изменения при остановке бота."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+    # ---------- кэш и отложенная запись ----------
+
+    def _key(self, key: StorageKey) -> str:
+        return self._key_builder.build(key)
+
+    async def _load(self, doc_key: str) -> tuple:
+        cached = self._cache.get(doc_key)
+        # Незаписанные (и записываемые прямо сейчас) изменения всегда берём из кэша —
+        # в БД их ещё нет
+        if cached is not None and (doc_key in self._dirty or doc_key in self._flushing
+                                   or cached[0] > time.monotonic()):
+            return cached[1], cached[2]
+
+        with DB_SECONDS.time(op="fsm_get"):
+            doc = await self._collection.find_one({"_id": doc_key})
+        state, data = (doc.get("state"), doc.get("data") or {}) if doc else (None, {})
+        self._remember(doc_key, state, data)
+        return state, data
+
+    def _remember(self, doc_key: str, state, data: dict):
+        self._cache.pop(doc_key, None)
+        self._cache[doc_key] = (time.monotonic() + self._cache_ttl, state, data)
+        # Самые старые записи вытесняются; незаписанные не трогаем
+        if len(self._cache) > self._cache_size:
+            for old_key in list(self._cache):
+                if len(self._cache) <= self._cache_size:
+                    break
+                if old_key not in self._dirty and old_key not in self._flushing:
+                    del self._cache[old_key]
+
+    def _put(self, doc_key: str, state, data: dict):
+        self._remember(doc_key, state, data)
+        self._dirty.add(doc_key)
+        if self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._flush_interval)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            logging.exception("Не удалось записать состояния FSM, повторим позже")
+            if self._dirty and self._timer is None:
+                self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def flush(self):
+        """Пишет все накопленные изменения одним bulk_write."""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            keys, self._dirty = self._dirty, set()
+            self._flushing = keys
+            ops = []
+            for doc_key in keys:
+                _, state, data = self._cache[doc_key]
+                if state is None and not data:
+                    ops.append(DeleteOne({"_id": doc_key}))
+                else:
+                    ops.append(UpdateOne({"_id": doc_key}, {"$set": {"state": state, "data": data}}, upsert=True))
+            try:
+                with DB_SECONDS.time(op="fsm_flush"):
+                    await self._collection.bulk_write(ops, ordered=False)
+            except BaseException:
+                # Вернём ключи в очередь (новые изменения за это время тоже в кэше)
+                self._dirty |= keys
+                raise
+            finally:
+                self._flushing = set()
@@ -0,0 +1,243 @@
+import os
+import time
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from metrics import DB_SECONDS
+
+load_dotenv()
+
+# =========================
+#  Очередь задач в MongoDB: бот кладёт задачи, воркеры (worker.py) их разбирают.
+# =========================
+# "local" — обработка в процессе бота (как раньше), "mongo" — через очередь и worker.py
+JOB_BACKEND = os.getenv("JOB_BACKEND", "local")
+# Аренда задачи воркером: без heartbeat дольше этого задача достаётся другому воркеру
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 60))
+# Сколько раз задачу можно взять в работу (падения воркеров, истечение аренды)
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+# Сколько задач одного пользователя могут быть в работе одновременно (на всех воркерах):
+# остальные его задачи ждут, а свободные слоты достаются другим пользователям
+JOB_USER_MAX_RUNNING = int(os.getenv("JOB_USER_MAX_RUNNING", 1))
+# Пауза между опросами очереди (воркер — пустой очереди, бот — своей задачи)
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))
+
+# Состояния задачи
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINAL_STATUSES = (DONE, FAILED, CANCELLED)
+
+
+class GridFSStore:
+    """Файлы задач (исходники и готовые копии) в GridFS той же базы."""
+
+    def __init__(self, database):
+        self._bucket = AsyncIOMotorGridFSBucket(database, bucket_name="job_files")
+
+    async def put(self, data: bytes, filename: str) -> ObjectId:
+        return await self._bucket.upload_from_stream(filename, data)
+
+    async def get(self, file_id) -> bytes:
+        stream = await self._bucket.open_download_stream(file_id)
+        return await stream.read()
+
+    async def delete(self, file_id):
+        await self._bucket.delete(file_id)
+
+
+class JobQueue:
+    """
+    Коллекция jobs: атомарный захват задачи с арендой (lease), продление аренды
+    heartbeat'ом, повтор после истечения аренды (упавший воркер) и передача
+    результатов — id файлов копий в поле results по мере готовности.
+
+    Документ задачи:
+      user_id, kind ("photo"/"video"), priority, payload (параметры обработки),
+      status, attempts, worker, lease_until, progress, results, error,
+      error_type (имя класса исключения — бот по нему выбирает ответ), created_at.
+
+    files — хранилище файлов с методами put/get/delete (по умолчанию GridFS);
+    для тестов без mongod подходит mongomock-motor и своё хранилище в памяти.
+    """
+
+    def __init__(self, database, files=None, lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, user_max_running: int = JOB_USER_MAX_RUNNING):
+        self.collection = database["jobs"]
+        self.files = files or GridFSStore(database)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.user_max_running = user_max_running
+
+    async def init(self):
+        """Индекс под выборку очереди: статус -> приоритет -> время постановки."""
+        await self.collection.create_index([("status", 1), ("priority", -1), ("created_at", 1)])
+
+    # ---------- сторона бота ----------
+
+    async def enqueue(self, user_id: int, kind: str, payload: dict, priority: bool = False) -> ObjectId:
+        doc = {
+            "user_id": user_id,
+            "kind": kind,
+            "priority": int(bool(priority)),
+            "payload": payload,
+            "status": QUEUED,
+            "attempts": 0,
+            "worker": None,
+            "lease_until": 0.0,
+            "progress": 0.0,
+            "results": [],
+            "error": None,
+            "error_type": None,
+            "created_at": time.time(),
+        }
+        with DB_SECONDS.time(op="job_enqueue"):
+            res = await self.collection.insert_one(doc)
+        return res.inserted_id
+
+    async def get(self, job_id: ObjectId) -> dict | None:
+        with DB_SECONDS.time(op="job_get"):
+            return await self.collection.find_one({"_id": job_id})
+
+    async def queue_position(self, job: dict) -> int:
+        """Сколько задач того же вида будет взято раньше этой (0 — уже в работе)."""
+        if job["status"] != QUEUED:
+            return 0
+        with DB_SECONDS.time(op="job_position"):
+            ahead = await self.collection.count_documents({
+                "kind": job["kind"],
+                "status": QUEUED,
+                "$or": [
+                    {"priority": {"$gt": job["priority"]}},
+                    {"priority": job["priority"], "created_at": {"$lt": job["created_at"]}},
+                ],
+            })
+        return ahead + 1
+
+    async def cancel(self, job_id: ObjectId, user_id: int = None) -> bool:
+        """Отмена задачи; воркер узнаёт о ней при следующем heartbeat и останавливает работу."""
+        query = {"_id": job_id, "status": {"$in": [QUEUED, RUNNING]}}
+        if user_id is not None:
+            query["user_id"] = user_id
+        with DB_SECONDS.time(op="job_cancel"):
+            res = await self.collection.update_one(query, {"$set": {"status": CANCELLED}})
+        return res.modified_count > 0
+
+    async def delete(self, job: dict):
+        """Удаляет задачу вместе с её файлами (после доставки результата)."""
+        file_ids = list(job.get("results", []))
+        if job["payload"].get("source_id") is not None:
+            file_ids.append(job["payload"]["source_id"])
+        for file_id in file_ids:
+            try:
+                await self.files.delete(file_id)
+            except Exception:
+                pass
+        with DB_SECONDS.time(op="job_delete"):
+            await self.collection.delete_one({"_id": job["_id"]})
+
+    # ---------- сторона воркера ----------
+
+    async def _busy_users(self, now: float) -> list:
+        """Пользователи, у которых в работе уже user_max_running задач (с живой арендой)."""
+        pipeline = [
+            {"$match": {"status": RUNNING, "lease_until": {"$gte": now}}},
+            {"$group": {"_id": "$user_id", "running": {"$sum": 1}}},
+            {"$match": {"running": {"$gte": self.user_max_running}}},
+        ]
+        return [doc["_id"] async for doc in self.collection.aggregate(pipeline)]
+
+    async def claim(self, worker_id: str, kinds: list) -> dict | None:
+        """
+        Атомарно берёт следующую задачу: новую или брошенную (аренда истекла).
+        Приоритетные — первыми, дальше по времени постановки; задачи пользователей,
+        у которых уже user_max_running задач в работе, пропускаются — одна большая
+        заявка не забирает все слоты. Лимит мягкий: два воркера, берущие задачи
+        в один момент, могут на короткое время превысить его на одну задачу.
+        """
+        now = time.time()
+        query = {
+            "kind": {"$in": list(kinds)},
+            "attempts": {"$lt": self.max_attempts},
+            "$or": [
+                {"status": QUEUED},
+                {"status": RUNNING, "lease_until": {"$lt": now}},
+            ],
+        }
+        with DB_SECONDS.time(op="job_claim"):
+            if self.user_max_running:
+                busy = await self._busy_users(now)
+                if busy:
+                    query["user_id"] = {"$nin": busy}
+            return await self.collection.find_one_and_update(
+                query,
+                {
+                    "$set": {"status": RUNNING, "worker": worker_id, "lease_until": now + self.lease_seconds},
+                    "$inc": {"attempts": 1},
+                },
+                sort=[("priority", -1), ("created_at", 1)],
+                return_document=ReturnDocument.AFTER
+            )
+
+    async def heartbeat(self, job_id: ObjectId, worker_id: str, progress: float = None) -> bool:
+        """
+        Продлевает аренду. False — задача больше не наша (отменена или
+        аренда истекла и её забрал другой воркер): работу нужно бросить.
+        """
+        update = {"lease_until": time.time() + self.lease_seconds}
+        if progress is not None:
+            update["progress"] = progress
+        with DB_SECONDS.time(op="job_heartbeat"):
+            res = await self.collection.update_one(
+                {"_id": job_id, "worker": worker_id, "status": RUNNING},
+                {"$set": update}
+            )
+        return res.matched_count > 0
+
+    async def add_result(self, job_id: ObjectId, worker_id: str, file_id) -> bool:
+        """Готовая копия: бот увидит её при следующем опросе и сразу отправит."""
+        with DB_SECONDS.time(op="job_add_result"):
+            res = await self.collection.update_one(
+                {"_id": job_id, "worker": worker_id, "status": RUNNING},
+                {"$push": {"results": file_id}}
+            )
+        return res.matched_count > 0
+
+    async def complete(self, job_id: ObjectId, worker_id: str) -> bool:
+        with DB_SECONDS.time(op="job_complete"):
+            res = await self.collection.update_one(
+                {"_id": job_id, "worker": worker_id, "status": RUNNING},
+                {"$set": {"status": DONE, "progress": 1.0}}
+            )
+        return res.matched_count > 0
+
+    async def fail(self, job_id: ObjectId, worker_id: str, error: str, retry: bool = False,
+                   error_type: str = None) -> bool:
+        """
+        Ошибка обработки: retry=True — вернуть в очередь (если попытки остались).
+        error_type — имя класса исключения, чтобы бот ответил пользователю по существу.
+        """
+        with DB_SECONDS.time(op="job_fail"):
+            job = await self.collection.find_one({"_id": job_id, "worker": worker_id, "status": RUNNING})
+            if job is None:
+                return False
+            status = QUEUED if retry and job["attempts"] < self.max_attempts else FAILED
+            res = await self.collection.update_one(
+                {"_id": job_id, "worker": worker_id, "status": RUNNING},
+                {"$set": {"status": status, "worker": None, "error": error, "error_type": error_type}}
+            )
+        return res.matched_count > 0
+
+    async def fail_exhausted(self) -> int:
+        """Брошенные задачи без оставшихся попыток помечаем упавшими (бот перестанет ждать)."""
+        with DB_SECONDS.time(op="job_fail_exhausted"):
+            res = await self.collection.update_many(
+                {"status": RUNNING, "lease_until": {"$lt": time.time()}, "attempts": {"$gte": self.max_attempts}},
+                {"$set": {"status": FAILED, "error": "аренда истекла, попытки исчерпаны"}}
+            )
+        return res.modified_count
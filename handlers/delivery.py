@@ -0,0 +1,120 @@
+import os
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Message, InputFile, BufferedInputFile, FSInputFile, InputMediaPhoto, InputMediaVideo
+
+from metrics import UPLOAD_SECONDS, BYTES_OUT
+
+load_dotenv()
+
+# "group" — готовые копии склеиваются в альбомы (media group) до 10 штук,
+# "single" — каждая копия отправляется отдельным сообщением сразу
+DELIVERY_MODE = os.getenv("DELIVERY_MODE", "group")
+# Сколько секунд ждать следующие копии, прежде чем отправить неполный альбом
+MEDIA_GROUP_LINGER = float(os.getenv("MEDIA_GROUP_LINGER", 1.5))
+# Ограничение Telegram на размер альбома
+MEDIA_GROUP_MAX = 10
+# Сколько раз повторять отправку после flood control (TelegramRetryAfter)
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", 3))
+
+
+class ResultDelivery:
+    """
+    Отправка копий пользователю по мере готовности.
+    Первая копия уходит сразу (пользователь быстро видит результат),
+    следующие в режиме "group" копятся и уходят альбомами: когда набралось 10
+    или прошло MEDIA_GROUP_LINGER секунд с первой копии в буфере.
+    """
+
+    def __init__(self, message: Message, kind: str, mode: str = DELIVERY_MODE, linger: float = MEDIA_GROUP_LINGER):
+        self._message = message
+        self._kind = kind            # "photo" | "video"
+        self._mode = mode
+        self._linger = linger
+        self._buffer = []
+        self._timer = None
+        self._lock = asyncio.Lock()
+        self.sent = 0
+
+    async def add(self, media: InputFile):
+        """Готовая копия (BufferedInputFile/FSInputFile)."""
+        self._raise_timer_error()
+        self._buffer.append(media)
+        if self._mode != "group" or self.sent == 0 or len(self._buffer) >= MEDIA_GROUP_MAX:
+            await self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def close(self):
+        """
+        Отправить всё, что осталось в буфере (вызывать в конце задачи).
+        Ошибка отложенной отправки альбома пробрасывается отсюда.
+        """
+        timer = self._timer
+        if timer is not None and not timer.done():
+            if self._lock.locked():
+                # Таймер уже отправляет альбом — дожидаемся его, а не обрываем посередине
+                await asyncio.wait([timer])
+            else:
+                timer.cancel()
+                self._timer = None
+        self._raise_timer_error()
+        await self._flush()
+
+    def _raise_timer_error(self):
+        timer = self._timer
+        if timer is not None and timer.done():
+            self._timer = None
+            if not timer.cancelled() and timer.exception() is not None:
+                raise timer.exception()
+
+    async def _flush_later(self):
+        await asyncio.sleep(self._linger)
+        await self._flush()
+
+    async def _flush(self):
+        async with self._lock:
+            while self._buffer:
+                # Из буфера убираем только после успешной отправки: при ошибке копии остаются
+                batch = self._buffer[:MEDIA_GROUP_MAX]
+                await self._send(batch)
+                del self._buffer[:len(batch)]
+                self.sent += len(batch)
+
+    async def _send(self, batch: list):
+        for attempt in range(SEND_RETRIES + 1):
+            try:
+                with UPLOAD_SECONDS.time(kind=self._kind):
+                    await self._send_once(batch)
+                break
+            except TelegramRetryAfter as e:
+                # Flood control: Telegram сам говорит, сколько ждать
+                if attempt == SEND_RETRIES:
+                    raise
+                logging.warning("Flood control при отправке %s, повтор через %s с", self._kind, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+        BYTES_OUT.inc(sum(_media_size(m) for m in batch), kind=self._kind)
+
+    async def _send_once(self, batch: list):
+        if len(batch) == 1:
+            if self._kind == "photo":
+                await self._message.answer_photo(photo=batch[0])
+            else:
+                await self._message.answer_video(video=batch[0])
+        else:
+            media_cls = InputMediaPhoto if self._kind == "photo" else InputMediaVideo
+            await self._message.answer_media_group(media=[media_cls(media=m) for m in batch])
+
+
+def _media_size(media: InputFile) -> int:
+    if isinstance(media, BufferedInputFile):
+        return len(media.data)
+    if isinstance(media, FSInputFile):
+        try:
+            return os.path.getsize(media.path)
+        except OSError:
+            return 0
+    return 0
@@ -1,57 +1,144 @@
 import os
 import random
 import asyncio
-from aiogram.types import Message, CallbackQuery, FSInputFile
+import logging
+import itertools
+from bson import ObjectId
+from functools import partial
+from contextlib import asynccontextmanager
+from aiogram.types import Message, CallbackQuery, FSInputFile, BufferedInputFile
 from aiogram.fsm.context import FSMContext
+from aiogram.exceptions import TelegramAPIError
 from aiogram import Bot
 
 from states import ProcessStates, AdminStates
+from db.jobs import JobQueue, JOB_BACKEND, CANCELLED, FAILED
 from db.db import (
+    db,
     get_or_create_user,
-    is_user_admin,
-    is_user_allowed,
     set_admin,
     allow_user,
     remove_user,
-    get_all_users
+    get_user_page,
+    count_users,
+    set_video_tier
 )
 from keyboard.keyboards import (
     main_menu,
     admin_menu,
-    build_user_carousel
+    build_user_carousel,
+    build_cancel_job_kb
 )
+from handlers.status import StatusMessage
+from handlers.delivery import ResultDelivery
+from handlers.remote_jobs import run_remote_job, TIMED_OUT
 
 # Импортируем функции из service/
-from service.unique_photo import make_unique_photo
-from service.unique_video import make_unique_video
+from service.executors import PHOTO_WORKERS, VIDEO_WORKERS
+from service.scheduler import FairScheduler, Job
+from service.input_cache import InputCache, INPUT_CACHE_PHOTOS
+from service.workspace import WorkspaceManager, estimate_video_bytes
+from service.pipeline import process_photo_async, process_videos_async, JobBytes
+from service.uniqueness import photo_guard, video_guard
+from service.unique_photo import PhotoTooLarge, PHOTO_MAX_PIXELS
+from service.ffmpeg_caps import refresh_capabilities
+from service.ffmpeg_runner import FFmpegError
+from service.video_profiles import VIDEO_TIERS, probe_video, get_default_tier, set_default_tier
+from metrics import DOWNLOAD_SECONDS, BYTES_IN, INPUT_CACHE_HITS
 
 # =========================
-# Настройка: хотим максимум 2 задачи "обработки" параллельно
+#  Планировщик: честная очередь между пользователями перед пулами обработки.
+#  Слотов столько же, сколько воркеров в соответствующем пуле.
 # =========================
-MAX_CONCURRENT_TASKS = 2
-semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
+scheduler = FairScheduler(capacity={"photo": PHOTO_WORKERS, "video": VIDEO_WORKERS})
+
+# Кэш исходников по file_unique_id (повторно присланный файл не скачивается)
+input_cache = InputCache()
+
+# Рабочие папки задач (изолированные, с общим бюджетом места и уборкой брошенных)
+workspaces = WorkspaceManager()
+
+# JOB_BACKEND=mongo: обработку ведут отдельные воркеры (worker.py) через очередь в MongoDB
+job_queue = JobQueue(db) if JOB_BACKEND == "mongo" else None
+
+# Отказ по PhotoTooLarge — одинаковый в обоих режимах обработки
+PHOTO_TOO_LARGE_REPLY = (f"Фото слишком большое: обрабатываются снимки "
+                         f"до {PHOTO_MAX_PIXELS // 1_000_000} Мп. Пришлите фото меньшего размера.")
 
 # =========================
-#  Асинхронные обёртки c ограничением параллелизма
+#  Отправка результатов
 # =========================
 
-async def process_photo_async(input_path: str, output_path: str):
+async def deliver_results(job: Job, delivery: ResultDelivery, to_media):
     """
-    Запускаем make_unique_photo в отдельном потоке (Executor),
-    но с ограничением - не более N задач одновременно.
+    Отправляет результаты единиц задачи по мере готовности (to_media: результат -> список файлов).
+    При выходе, в том числе по ошибке отправки, остаток задачи отменяется
+    (cancel завершённой задачи ничего не делает), а буфер досылается.
     """
-    async with semaphore:
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, make_unique_photo, input_path, output_path)
+    try:
+        async for result in job.results():
+            for media in to_media(result):
+                await delivery.add(media)
+    finally:
+        scheduler.cancel(job.job_id)
+        await delivery.close()
+
 
-async def process_video_async(input_path: str, output_path: str):
+# =========================
+#  Исходники задач
+# =========================
+
+@asynccontextmanager
+async def fetch_source(bot: Bot, media, suffix: str, temp_path: str = None):
     """
-    Запускаем make_unique_video в отдельном потоке (Executor),
-    но с ограничением - не более N задач одновременно.
+    Исходник задачи (media — PhotoSize/Video из сообщения):
+      - при включённом кэше — путь к файлу в кэше (повтор не скачивается);
+        фото кэшируются только при INPUT_CACHE_PHOTOS=1;
+      - иначе скачиваем в temp_path (и удаляем после блока with),
+        а если temp_path не задан — в память (bytes).
     """
-    async with semaphore:
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, make_unique_video, input_path, output_path)
+    # Метка для метрик: фото скачиваются как .jpg, всё остальное — видео
+    kind = "photo" if suffix == ".jpg" else "video"
+    downloaded = False
+
+    async def download(path: str):
+        nonlocal downloaded
+        downloaded = True
+        with DOWNLOAD_SECONDS.time(kind=kind):
+            file_info = await bot.get_file(media.file_id)
+            await bot.download_file(file_info.file_path, path)
+        BYTES_IN.inc(os.path.getsize(path), kind=kind)
+
+    if input_cache.enabled and (kind == "video" or INPUT_CACHE_PHOTOS):
+        async with input_cache.acquire(media.file_unique_id, suffix, download) as path:
+            if not downloaded:
+                INPUT_CACHE_HITS.inc(kind=kind)
+            yield path
+    elif temp_path is None:
+        with DOWNLOAD_SECONDS.time(kind=kind):
+            file_info = await bot.get_file(media.file_id)
+            data = (await bot.download_file(file_info.file_path)).getvalue()
+        BYTES_IN.inc(len(data), kind=kind)
+        yield data
+    else:
+        await download(temp_path)
+        try:
+            yield temp_path
+        finally:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+
+def has_admin(user_access: dict) -> bool:
+    """Права из UserAccessMiddleware: админ ли автор апдейта."""
+    return bool(user_access and user_access.get("is_admin"))
+
+
+def has_access(user_access: dict) -> bool:
+    """Права из UserAccessMiddleware: админ или подтверждённый пользователь."""
+    return bool(user_access and (user_access.get("is_admin") or user_access.get("is_allowed")))
 
 
 # =========================
@@ -92,9 +179,8 @@ async def handle_login(message: Message):
         await message.answer("Вы снова в главном меню.", reply_markup=main_menu)
 
 
-async def handle_start_processing(message: Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not (await is_user_admin(user_id) or await is_user_allowed(user_id)):
+async def handle_start_processing(message: Message, state: FSMContext, user_access: dict = None):
+    if not has_access(user_access):
         await message.answer("У вас нет доступа. Ожидайте подтверждения админом.")
         return
 
@@ -116,10 +202,12 @@ async def handle_number(message: Message, state: FSMContext):
     await message.answer(f"Вы указали {copies_count}. Теперь отправьте фото или видео.")
 
 
-async def handle_file(message: Message, state: FSMContext, bot: Bot):
+async def handle_file(message: Message, state: FSMContext, bot: Bot, user_access: dict = None):
     """
     Скачивает фото/видео, обрабатывает N раз (с ограниченным параллелизмом),
     отправляет результат, и удаляет временные файлы.
+    Видео берётся из кэша по file_unique_id; фото (если не включён INPUT_CACHE_PHOTOS)
+    обрабатываются целиком в памяти, а диск нужен только для видео.
     """
     current_state = await state.get_state()
     if current_state != ProcessStates.waiting_file:
@@ -128,115 +216,171 @@ async def handle_file(message: Message, state: FSMContext, bot: Bot):
     data = await state.get_data()
     copies_count = data.get("copies_count", 1)
 
-    # Создадим папку temp (если не создана)
-    temp_dir = "temp"
-    os.makedirs(temp_dir, exist_ok=True)
+    user_id = message.from_user.id
+    status = StatusMessage(message)
+    # Ответ при неудаче (у осознанных отказов — свой)
+    failed_reply = "Попробуйте ещё раз позже."
+
+    async def on_position(job: Job, position: int):
+        if position:
+            text = f"Задача в очереди, позиция: {position}"
+        else:
+            text = f"Обрабатываю {copies_count} коп."
+        await status.update(text, reply_markup=build_cancel_job_kb(job.job_id))
+
+    # =========================
+    #  Обработка на воркерах через очередь
+    # =========================
+    if job_queue is not None and (message.photo or message.video):
+        if message.photo:
+            media, kind, suffix = message.photo[-1], "photo", ".jpg"
+            payload = {"copies": copies_count, "key": message.photo[-1].file_unique_id}
+        else:
+            media, kind, suffix = message.video, "video", ".mp4"
+            payload = {"copies": copies_count, "key": message.video.file_unique_id,
+                       "tier": (user_access or {}).get("video_tier") or get_default_tier()}
+        async with fetch_source(bot, media, suffix) as source:
+            try:
+                result, reason = await run_remote_job(job_queue, message, status, kind, source, payload,
+                                                      priority=has_admin(user_access))
+            except TelegramAPIError:
+                logging.exception("Не удалось отправить копии задачи пользователя %s", user_id)
+                result, reason = FAILED, None
+        cancelled, failed = result == CANCELLED, result == FAILED
+        if reason == TIMED_OUT:
+            failed_reply = "Задача не выполнена вовремя: сейчас большая очередь. Попробуйте позже."
+        elif reason == PhotoTooLarge.__name__:
+            failed_reply = PHOTO_TOO_LARGE_REPLY
 
     # =========================
     #  Если пользователь прислал фото
     # =========================
-    if message.photo:
+    elif message.photo:
         photo = message.photo[-1]
-        file_id = photo.file_id
-        file_info = await bot.get_file(file_id)
-
-        # Скачиваем оригинал
-        input_path = os.path.join(temp_dir, f"input_{message.from_user.id}.jpg")
-        await bot.download_file(file_info.file_path, input_path)
-
-        # Создадим список задач
-        tasks = []
-        out_paths = []
-        for i in range(copies_count):
-            out_name = f"output_{message.from_user.id}_{i}.jpg"
-            output_path = os.path.join(temp_dir, out_name)
-            out_paths.append(output_path)
-
-            # Каждую копию обрабатываем в отдельной асинхронной задаче
-            # (но внутри применяем Semaphore)
-            task = asyncio.create_task(
-                process_photo_async(input_path, output_path)
-            )
-            tasks.append(task)
-
-        # Запускаем все задачи (но реально не более 2 одновременно)
-        await asyncio.gather(*tasks)
-
-        # После завершения обрабатываем результат
-        for output_path in out_paths:
-            await message.answer_photo(photo=FSInputFile(output_path))
-
-        await message.answer("Все копии (фото) готовы!", reply_markup=main_menu)
-        await state.clear()
-
-        # Удаляем временные файлы
-        try:
-            os.remove(input_path)
-        except OSError:
-            pass
 
-        for path in out_paths:
+        # Исходник сразу в память (или из кэша при INPUT_CACHE_PHOTOS=1)
+        async with fetch_source(bot, photo, ".jpg") as source:
+            # Хэш исходника (кэшируется по file_unique_id) — для проверки уникальности копий
+            guard = await photo_guard(photo.file_unique_id, source)
+            job_bytes = JobBytes("photo", "standard")
+
+            # Каждая копия — отдельная единица планировщика (задача в пуле процессов).
+            # Ключ file_unique_id: воркер декодирует исходник один раз и держит основу в кэше
+            units = [
+                (1, partial(process_photo_async, photo.file_unique_id, source, guard, job_bytes))
+                for _ in range(copies_count)
+            ]
+            job = scheduler.submit(user_id, "photo", units,
+                                   priority=has_admin(user_access), on_position=on_position)
+
+            # Копии уходят пользователю по мере готовности (по одной или альбомами)
+            delivery = ResultDelivery(message, "photo")
+            names = (f"photo_{i}.jpg" for i in itertools.count(1))
+            failed = False
             try:
-                os.remove(path)
-            except OSError:
-                pass
+                await deliver_results(job, delivery, lambda data: [BufferedInputFile(data, filename=next(names))])
+            except PhotoTooLarge:
+                failed = True
+                failed_reply = PHOTO_TOO_LARGE_REPLY
+            except TelegramAPIError:
+                logging.exception("Не удалось отправить копии задачи %s", job.job_id)
+                failed = True
+        job_bytes.report(job.job_id)
+        cancelled = job.cancelled and not failed
 
     # =========================
     #  Если пользователь прислал видео
     # =========================
     elif message.video:
         video = message.video
-        file_id = video.file_id
-        file_info = await bot.get_file(file_id)
-
-        input_path = os.path.join(temp_dir, f"input_{message.from_user.id}.mp4")
-        await bot.download_file(file_info.file_path, input_path)
-
-        tasks = []
-        out_paths = []
-        for i in range(copies_count):
-            out_name = f"output_{message.from_user.id}_{i}.mp4"
-            output_path = os.path.join(temp_dir, out_name)
-            out_paths.append(output_path)
-
-            # Каждую копию обрабатываем в отдельной задаче
-            task = asyncio.create_task(
-                process_video_async(input_path, output_path)
-            )
-            tasks.append(task)
 
-        # Параллельный запуск (но реально max 2 одновременно)
-        await asyncio.gather(*tasks)
-
-        # Отправляем готовые файлы
-        for output_path in out_paths:
-            await message.answer_video(video=FSInputFile(output_path))
-
-        await message.answer("Все копии (видео) готовы!", reply_markup=main_menu)
-        await state.clear()
-
-        # Удаляем временные файлы
-        try:
-            os.remove(input_path)
-        except OSError:
-            pass
-
-        for path in out_paths:
-            try:
-                os.remove(path)
-            except OSError:
-                pass
+        # Видео обрабатывает ffmpeg — ему нужны файлы: отдельная рабочая папка на задачу
+        # (резерв под исходник и копии; при нехватке бюджета ждём освобождения места)
+        estimate = estimate_video_bytes(video.file_size, copies_count)
+        async with workspaces.acquire("video", estimate) as ws:
+            out_paths = [ws.path(f"output_{i}.mp4") for i in range(copies_count)]
+
+            async with fetch_source(bot, video, ".mp4", ws.path("input.mp4")) as input_path:
+                # Проба исходника один раз на задачу (а не на каждый пакет);
+                # уровень кодирования — личный пользователя или глобальный
+                info = await asyncio.to_thread(probe_video, input_path)
+                tier = (user_access or {}).get("video_tier") or get_default_tier()
+                guard = await video_guard(video.file_unique_id, input_path, info)
+
+                # Копии режем на пакеты по лимиту пользователя: каждый пакет —
+                # один запуск ffmpeg (одно декодирование исходника на пакет)
+                batch = scheduler.per_user_limit
+                batches = [out_paths[i:i + batch] for i in range(0, len(out_paths), batch)]
+
+                # Общий прогресс задачи = прогресс пакетов, взвешенный числом копий
+                done_copies = [0.0] * len(batches)
+
+                def batch_progress(index: int):
+                    async def on_progress(fraction: float):
+                        done_copies[index] = fraction * len(batches[index])
+                        percent = int(100 * sum(done_copies) / copies_count)
+                        await status.update(f"Обрабатываю {copies_count} коп. видео: {percent}%",
+                                            reply_markup=build_cancel_job_kb(job.job_id))
+                    return on_progress
+
+                units = [
+                    (len(paths), partial(process_videos_async, input_path, paths, tier, info,
+                                         batch_progress(i), guard))
+                    for i, paths in enumerate(batches)
+                ]
+                job = scheduler.submit(user_id, "video", units,
+                                       priority=has_admin(user_access), on_position=on_position)
+
+                # Отправляем готовые файлы по мере готовности пакетов; задача останавливается
+                # и буфер досылается до удаления рабочей папки (ffmpeg пишет в неё)
+                delivery = ResultDelivery(message, "video")
+                failed = False
+                try:
+                    await deliver_results(job, delivery, lambda paths: [FSInputFile(path) for path in paths])
+                except FFmpegError:
+                    # ffmpeg упал или остановлен по бюджету (подробности уже в логе планировщика)
+                    failed = True
+                except TelegramAPIError:
+                    logging.exception("Не удалось отправить копии задачи %s", job.job_id)
+                    failed = True
+        cancelled = job.cancelled and not failed
 
     else:
         # Если прислали не фото и не видео
         await message.answer("Пожалуйста, пришлите фото или видео.")
         return
 
+    await state.clear()
+    if cancelled:
+        await status.update("Задача отменена.", force=True)
+        await message.answer("Вы снова в главном меню.", reply_markup=main_menu)
+    elif failed:
+        await status.update("Не удалось обработать файл.", force=True)
+        await message.answer(failed_reply, reply_markup=main_menu)
+    else:
+        await status.update("Готово.", force=True)
+        kind = "фото" if message.photo else "видео"
+        await message.answer(f"Все копии ({kind}) готовы!", reply_markup=main_menu)
+
+
+async def handle_cancel_job_callback(call: CallbackQuery):
+    """Кнопка «Отменить» под статусом задачи: снимает ещё не начатые копии."""
+    job_id = call.data.split(":")[1]
+    if job_id.isdigit():
+        cancelled = scheduler.cancel(int(job_id), call.from_user.id)
+    else:
+        # Задача в очереди MongoDB (JOB_BACKEND=mongo) — id вида ObjectId
+        cancelled = (job_queue is not None and ObjectId.is_valid(job_id)
+                     and await job_queue.cancel(ObjectId(job_id), call.from_user.id))
+    if cancelled:
+        await call.answer("Задача отменена.")
+    else:
+        await call.answer("Задача уже завершена или не найдена.", show_alert=True)
+
 
 # ---- Админские команды ----
-async def handle_admin_menu(message: Message, state: FSMContext):
-    user_id = message.from_user.id
-    if not await is_user_admin(user_id):
+async def handle_admin_menu(message: Message, state: FSMContext, user_access: dict = None):
+    if not has_admin(user_access):
         await message.answer("У вас нет прав администратора!", reply_markup=main_menu)
         return
 
@@ -246,11 +390,11 @@ async def handle_admin_menu(message: Message, state: FSMContext):
             await state.set_state(AdminStates.waiting_user_id_to_add)
 
         case "Список пользователей":
-            users = await get_all_users()
-            if not users:
+            user = await get_user_page()
+            if user is None:
                 await message.answer("Нет ни одного пользователя.")
             else:
-                text, kb = build_user_carousel(users, 0)
+                text, kb = build_user_carousel(user, 0, await count_users())
                 await message.answer(text, reply_markup=kb)
 
         case "Выйти из админ-режима":
@@ -260,8 +404,63 @@ async def handle_admin_menu(message: Message, state: FSMContext):
             await message.answer("Неизвестная команда в админ-меню.")
 
 
-async def handle_add_user_id(message: Message, state: FSMContext):
-    if not await is_user_admin(message.from_user.id):
+async def handle_refresh_ffmpeg(message: Message, user_access: dict = None):
+    """/refresh_ffmpeg — заново опросить ffmpeg (версия, энкодеры, фильтры)."""
+    if not has_admin(user_access):
+        await message.answer("У вас нет прав администратора!", reply_markup=main_menu)
+        return
+
+    caps = await asyncio.to_thread(refresh_capabilities)
+    await message.answer(
+        f"ffmpeg {caps['version']}\n"
+        f"Кодек видео: {caps['video_codec']}\n"
+        f"Энкодеров: {len(caps['encoders'])}, фильтров: {len(caps['filters'])}"
+    )
+
+
+async def handle_video_tier(message: Message, user_access: dict = None):
+    """
+    /video_tier                    — показать уровни и текущий глобальный;
+    /video_tier <уровень>          — сменить глобальный уровень;
+    /video_tier <user_id> <уровень> — личный уровень пользователя ("default" — сброс).
+    """
+    if not has_admin(user_access):
+        await message.answer("У вас нет прав администратора!", reply_markup=main_menu)
+        return
+
+    args = (message.text or "").split()[1:]
+    tiers = ", ".join(VIDEO_TIERS)
+
+    if not args:
+        await message.answer(f"Глобальный уровень видео: {get_default_tier()}\nДоступные: {tiers}")
+        return
+
+    if len(args) == 1:
+        if args[0] not in VIDEO_TIERS:
+            await message.answer(f"Неизвестный уровень. Доступные: {tiers}")
+            return
+        set_default_tier(args[0])
+        await message.answer(f"Глобальный уровень видео: {args[0]}")
+        return
+
+    try:
+        target_id = int(args[0])
+    except ValueError:
+        await message.answer("Некорректный ID.")
+        return
+    tier = None if args[1] == "default" else args[1]
+    if tier is not None and tier not in VIDEO_TIERS:
+        await message.answer(f"Неизвестный уровень. Доступные: {tiers}, default")
+        return
+
+    if await set_video_tier(target_id, tier):
+        await message.answer(f"Пользователю {target_id} назначен уровень видео: {tier or 'глобальный'}")
+    else:
+        await message.answer(f"Пользователь {target_id} не найден.")
+
+
+async def handle_add_user_id(message: Message, state: FSMContext, user_access: dict = None):
+    if not has_admin(user_access):
         await message.answer("У вас нет прав администратора!", reply_markup=main_menu)
         await state.clear()
         return
@@ -277,27 +476,29 @@ async def handle_add_user_id(message: Message, state: FSMContext):
     await state.clear()
 
 
-async def handle_user_carousel_callback(call: CallbackQuery):
-    if not await is_user_admin(call.from_user.id):
+async def handle_user_carousel_callback(call: CallbackQuery, user_access: dict = None):
+    if not has_admin(user_access):
         await call.answer("У вас нет прав администратора.", show_alert=True)
         return
 
     data = call.data
     parts = data.split(":")
-    users = await get_all_users()
-
-    if not users:
-        await call.message.edit_text("Нет ни одного пользователя.")
-        await call.message.edit_reply_markup(reply_markup=None)
-        return
-
     cmd = parts[0]
-    if cmd in ("prev_user", "next_user"):
-        old_index = int(parts[1])
-        new_index = old_index - 1 if cmd == "prev_user" else old_index + 1
 
-        text, kb = build_user_carousel(users, new_index)
-        await call.message.edit_text(text, reply_markup=kb)
+    if cmd in ("prev_user", "next_user"):
+        if len(parts) < 3:
+            # Кнопка из старого формата (без курсора) — начинаем с первой страницы
+            user, new_index = await get_user_page(), 0
+        else:
+            old_index = int(parts[1])
+            cursor = int(parts[2])
+            if cmd == "prev_user":
+                user, new_index = await get_user_page(cursor, "prev"), old_index - 1
+            else:
+                user, new_index = await get_user_page(cursor, "next"), old_index + 1
+            if user is None:
+                # Соседа уже удалили — остаёмся на текущем (или ближайшем) пользователе
+                user, new_index = await get_user_page(cursor, "at"), old_index
 
     elif cmd == "delete_user":
         user_id_str = parts[1]
@@ -311,14 +512,18 @@ async def handle_user_carousel_callback(call: CallbackQuery):
         else:
             await call.answer(f"Пользователь {user_id_int} не найден.", show_alert=True)
 
-        updated_users = await get_all_users()
-        if not updated_users:
-            await call.message.edit_text("Нет ни одного пользователя.")
-            await call.message.edit_reply_markup(reply_markup=None)
-        else:
-            if old_index >= len(updated_users):
-                old_index = len(updated_users) - 1
-            text, kb = build_user_carousel(updated_users, old_index)
-            await call.message.edit_text(text, reply_markup=kb)
+        # На место удалённого встаёт следующий; если удалили последнего — предыдущий
+        user, new_index = await get_user_page(user_id_int, "next"), old_index
+        if user is None:
+            user, new_index = await get_user_page(user_id_int, "prev"), old_index - 1
     else:
         await call.answer("Неизвестная команда.", show_alert=True)
+        return
+
+    if user is None:
+        await call.message.edit_text("Нет ни одного пользователя.")
+        await call.message.edit_reply_markup(reply_markup=None)
+        return
+
+    text, kb = build_user_carousel(user, new_index, await count_users())
+    await call.message.edit_text(text, reply_markup=kb)
@@ -0,0 +1,25 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from db.db import get_user_access
+
+
+class UserAccessMiddleware(BaseMiddleware):
+    """
+    Подкладывает в контекст хендлера `user_access` — права автора апдейта
+    (dict из кэша db.get_user_access или None, если пользователя нет в БД).
+    Регистрируется как внутренний middleware: запрос делается только
+    для апдейтов, у которых нашёлся хендлер.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        data["user_access"] = await get_user_access(user.id) if user else None
+        return await handler(event, data)
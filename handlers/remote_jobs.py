@@ -0,0 +1,107 @@
+import os
+import time
+import math
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+from aiogram.types import Message, BufferedInputFile
+
+from db.jobs import JobQueue, JOB_POLL_INTERVAL, FINAL_STATUSES, CANCELLED, FAILED
+from handlers.status import StatusMessage
+from handlers.delivery import ResultDelivery
+from keyboard.keyboards import build_cancel_job_kb
+from service.ffmpeg_runner import FFMPEG_TIMEOUT
+from service.scheduler import USER_MAX_IN_FLIGHT
+
+load_dotenv()
+
+# Сколько бот ждёт задачу в очереди (сверх времени на саму обработку), секунды;
+# без лимита задача без живых воркеров висела бы вечно
+JOB_QUEUE_TIMEOUT = float(os.getenv("JOB_QUEUE_TIMEOUT", 1800))
+# Время на обработку фото-задачи воркером, секунды
+JOB_PHOTO_TIMEOUT = float(os.getenv("JOB_PHOTO_TIMEOUT", 600))
+
+# Причина неудачи, когда задача не уложилась в срок (второй элемент результата run_remote_job)
+TIMED_OUT = "timeout"
+
+
+def job_timeout(kind: str, copies: int) -> float | None:
+    """
+    Общий срок задачи: ожидание в очереди + обработка. Видео кодируется пакетами
+    по USER_MAX_IN_FLIGHT копий, на каждый пакет — до FFMPEG_TIMEOUT.
+    None — без срока (FFMPEG_TIMEOUT=0 снимает лимит и здесь).
+    """
+    if kind == "photo":
+        return JOB_QUEUE_TIMEOUT + JOB_PHOTO_TIMEOUT
+    if not FFMPEG_TIMEOUT:
+        return None
+    return JOB_QUEUE_TIMEOUT + FFMPEG_TIMEOUT * math.ceil(copies / USER_MAX_IN_FLIGHT)
+
+
+async def run_remote_job(queue: JobQueue, message: Message, status: StatusMessage, kind: str,
+                         source, payload: dict, priority: bool = False) -> tuple[str, str | None]:
+    """
+    Обработка через очередь (JOB_BACKEND=mongo): исходник уходит в хранилище задач,
+    задачу берёт worker.py, готовые копии отправляются пользователю по мере появления.
+    source — bytes или путь к файлу. Возвращает (итоговый статус, причина): причина —
+    TIMED_OUT, если задача не уложилась в job_timeout (она отменяется), тип ошибки
+    воркера (error_type, например "PhotoTooLarge") для упавшей задачи, иначе None.
+    """
+    if isinstance(source, str):
+        source = await asyncio.to_thread(_read_file, source)
+    suffix = ".jpg" if kind == "photo" else ".mp4"
+    source_id = await queue.files.put(source, f"source{suffix}")
+    job_id = await queue.enqueue(message.from_user.id, kind, {**payload, "source_id": source_id}, priority)
+    kb = build_cancel_job_kb(str(job_id))
+
+    timeout = job_timeout(kind, payload["copies"])
+    deadline = time.monotonic() + timeout if timeout else None
+    delivery = ResultDelivery(message, kind)
+    delivered = 0
+    try:
+        while True:
+            job = await queue.get(job_id)
+            if job is None:
+                return CANCELLED, None
+
+            # Новые копии — сразу пользователю
+            for file_id in job["results"][delivered:]:
+                data = await queue.files.get(file_id)
+                delivered += 1
+                await delivery.add(BufferedInputFile(data, filename=f"{kind}_{delivered}{suffix}"))
+
+            if job["status"] in FINAL_STATUSES:
+                if job["status"] == FAILED:
+                    logging.error("Задача %s упала: %s", job_id, job.get("error"))
+                    return FAILED, job.get("error_type")
+                return job["status"], None
+
+            if deadline is not None and time.monotonic() > deadline:
+                logging.warning("Задача %s не выполнена за %.0f с, отменяем", job_id, timeout)
+                await queue.cancel(job_id)
+                return FAILED, TIMED_OUT
+
+            position = await queue.queue_position(job)
+            if position:
+                text = f"Задача в очереди, позиция: {position}"
+            else:
+                text = f"Обрабатываю {payload['copies']} коп.: {int(100 * job.get('progress', 0))}%"
+            await status.update(text, reply_markup=kb)
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+    except BaseException:
+        # Отмена или ошибка отправки — задача на воркере больше не нужна
+        await queue.cancel(job_id)
+        raise
+    finally:
+        try:
+            await delivery.close()
+        finally:
+            # Результаты доставлены (или больше не нужны) — освобождаем хранилище
+            final = await queue.get(job_id)
+            await queue.delete(final or {"_id": job_id, "results": [], "payload": {"source_id": source_id}})
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
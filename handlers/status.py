@@ -0,0 +1,54 @@
+import time
+import asyncio
+
+from aiogram.types import Message, InlineKeyboardMarkup
+from aiogram.exceptions import TelegramBadRequest
+
+
+class StatusMessage:
+    """
+    Одно служебное сообщение о ходе задачи: первое обновление отправляет его,
+    следующие — редактируют. Правки не чаще min_interval секунд (лимиты Telegram):
+    промежуточные тексты схлопываются, последний гарантированно будет показан.
+    """
+
+    def __init__(self, message: Message, min_interval: float = 1.5):
+        self._source = message
+        self._message = None
+        self._min_interval = min_interval
+        self._last_edit = 0.0
+        self._shown = (None, None)
+        self._pending = None
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    async def update(self, text: str, reply_markup: InlineKeyboardMarkup = None, force: bool = False):
+        self._pending = (text, reply_markup)
+        wait = self._min_interval - (time.monotonic() - self._last_edit)
+        if force or self._message is None or wait <= 0:
+            await self._flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later(wait))
+
+    async def _flush_later(self, delay: float):
+        await asyncio.sleep(delay)
+        await self._flush()
+
+    async def _flush(self):
+        async with self._lock:
+            if self._pending is None:
+                return
+            text, reply_markup = self._pending
+            self._pending = None
+            if (text, reply_markup) == self._shown:
+                return
+            try:
+                if self._message is None:
+                    self._message = await self._source.answer(text, reply_markup=reply_markup)
+                else:
+                    await self._message.edit_text(text, reply_markup=reply_markup)
+            except TelegramBadRequest:
+                # "message is not modified" / сообщение удалено — не критично
+                pass
+            self._shown = (text, reply_markup)
+            self._last_edit = time.monotonic()
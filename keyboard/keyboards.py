@@ -4,7 +4,7 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton
 )
-from typing import List, Tuple
+from typing import Optional, Tuple
 
 # Главное меню (пример)
 main_menu = ReplyKeyboardMarkup(
@@ -29,26 +29,25 @@ admin_menu = ReplyKeyboardMarkup(
 )
 
 
-def build_user_carousel(users: List[dict], index: int) -> Tuple[str, InlineKeyboardMarkup]:
+def build_user_carousel(user: Optional[dict], index: int, total: int) -> Tuple[str, InlineKeyboardMarkup]:
     """
-    Отображаем ОДНОГО пользователя (users[index]) + inline-клавиатуру «◀ Удалить ▶».
+    Отображаем ОДНОГО пользователя (user — страница из get_user_page) + inline-клавиатуру «◀ Удалить ▶».
+    index — его порядковый номер (с нуля), total — всего пользователей.
     - Если index=0, кнопка «◀» не показывается.
-    - Если index=len(users)-1, кнопка «▶» не показывается.
+    - Если index=total-1, кнопка «▶» не показывается.
+    Кнопки несут курсор (user_id), так что следующая страница — один запрос по индексу.
     Возвращаем (text, inline_kb).
     """
 
-    n = len(users)
-    if n == 0:
+    if user is None:
         # Вообще нет пользователей
         return ("Нет ни одного пользователя.", InlineKeyboardMarkup(inline_keyboard=[]))
 
-    # Безопасно сдвигаем index в диапазон [0..n-1]
+    # Счётчик приблизительный — не даём index выйти за него
+    total = max(total, index + 1, 1)
     if index < 0:
         index = 0
-    elif index >= n:
-        index = n - 1
 
-    user = users[index]
     user_id = user["user_id"]
     username = user.get("username") or "NoName"
     is_admin = user.get("is_admin", False)
@@ -61,7 +60,7 @@ def build_user_carousel(users: List[dict], index: int) -> Tuple[str, InlineKeybo
     # ID: ...
     # [admin, allowed]
     lines = [
-        f"Юзер {index+1}/{n}",
+        f"Юзер {index+1}/{total}",
         f"Ник: {username}",
         f"ID: {user_id}"
     ]
@@ -81,7 +80,7 @@ def build_user_carousel(users: List[dict], index: int) -> Tuple[str, InlineKeybo
     if index > 0:
         left_btn = InlineKeyboardButton(
             text="◀",
-            callback_data=f"prev_user:{index}"
+            callback_data=f"prev_user:{index}:{user_id}"
         )
 
     # Кнопка «Удалить»
@@ -92,10 +91,10 @@ def build_user_carousel(users: List[dict], index: int) -> Tuple[str, InlineKeybo
 
     # Правая кнопка (если есть куда листать)
     right_btn = None
-    if index < n - 1:
+    if index < total - 1:
         right_btn = InlineKeyboardButton(
             text="▶",
-            callback_data=f"next_user:{index}"
+            callback_data=f"next_user:{index}:{user_id}"
         )
 
     # Собираем ряд
@@ -108,3 +107,10 @@ def build_user_carousel(users: List[dict], index: int) -> Tuple[str, InlineKeybo
 
     inline_kb = InlineKeyboardMarkup(inline_keyboard=[row])
     return text_result, inline_kb
+
+
+def build_cancel_job_kb(job_id) -> InlineKeyboardMarkup:
+    """Inline-кнопка «Отменить» под сообщением о статусе задачи (id локальной задачи или задачи в MongoDB)."""
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="Отменить", callback_data=f"cancel_job:{job_id}")
+    ]])
@@ -17,12 +17,33 @@ from handlers.handlers import (
     handle_admin_menu,
     handle_add_user_id,
     handle_user_carousel_callback,  # <-- новый коллбэк вместо remove_user_callback
+    handle_cancel_job_callback,
+    handle_refresh_ffmpeg,
+    handle_video_tier,
+    job_queue,
+    workspaces,
     ProcessStates,
     AdminStates
 )
 
 # Импортируем init_db
-from db.db import init_db
+from db.db import init_db, db
+
+# Хранилище FSM: в памяти или в MongoDB (общее для нескольких реплик бота)
+from db.fsm_storage import FSM_STORAGE, MongoFSMStorage
+
+# Права пользователя в контексте хендлеров (кэш поверх MongoDB)
+from handlers.middlewares import UserAccessMiddleware
+
+# Пулы для обработки фото/видео
+from service.executors import warm_up_executors, shutdown_executors
+from service.ffmpeg_caps import refresh_capabilities
+
+# Режим вебхука (BOT_MODE=webhook) вместо long polling
+from webhook import BOT_MODE, run_webhook
+
+# Метрики стадий и очереди (http://127.0.0.1:9108/metrics)
+from metrics import start_metrics_server, stop_metrics_server
 
 load_dotenv()
 
@@ -34,7 +55,27 @@ async def main():
     await init_db()
 
     bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    storage = MongoFSMStorage(db) if FSM_STORAGE == "mongo" else MemoryStorage()
+    dp = Dispatcher(storage=storage)
+
+    if job_queue is not None:
+        # JOB_BACKEND=mongo: обрабатывают воркеры (worker.py), бот только ставит задачи
+        await job_queue.init()
+    else:
+        # Пулы обработки: прогрев при старте, корректная остановка при выключении
+        dp.startup.register(warm_up_executors)
+    # Реестр возможностей ffmpeg строится один раз при старте
+    dp.startup.register(refresh_capabilities)
+    dp.shutdown.register(shutdown_executors)
+    dp.startup.register(start_metrics_server)
+    dp.shutdown.register(stop_metrics_server)
+    # Уборка брошенных рабочих папок задач (в том числе оставшихся после падения)
+    dp.startup.register(workspaces.start_sweeper)
+    dp.shutdown.register(workspaces.stop_sweeper)
+
+    # Права автора апдейта -> data["user_access"] (без лишних запросов в БД)
+    dp.message.middleware(UserAccessMiddleware())
+    dp.callback_query.middleware(UserAccessMiddleware())
 
     # /start
     dp.message.register(cmd_start, Command("start"))
@@ -42,6 +83,12 @@ async def main():
     # /login <пароль>
     dp.message.register(handle_login, Command("login"))
 
+    # /refresh_ffmpeg — обновить реестр возможностей ffmpeg (только админ)
+    dp.message.register(handle_refresh_ffmpeg, Command("refresh_ffmpeg"))
+
+    # /video_tier — уровень скорость/качество кодирования видео (глобально или на пользователя)
+    dp.message.register(handle_video_tier, Command("video_tier"))
+
     # «Начать обработку»
     dp.message.register(handle_start_processing, lambda m: m.text == "Начать обработку")
     dp.message.register(handle_number, ProcessStates.waiting_number)
@@ -62,8 +109,17 @@ async def main():
                   or c.data.startswith("delete_user:")
     )
 
+    # Отмена задачи в очереди
+    dp.callback_query.register(
+        handle_cancel_job_callback,
+        lambda c: c.data.startswith("cancel_job:")
+    )
+
     # Запуск бота
-    await dp.start_polling(bot, skip_updates=True)
+    if BOT_MODE == "webhook":
+        await run_webhook(dp, bot)
+    else:
+        await dp.start_polling(bot, skip_updates=True)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,186 @@
+# metrics.py
+# Простые метрики в формате Prometheus (text exposition 0.0.4) без внешних зависимостей
+# и локальный HTTP-эндпоинт /metrics на aiohttp.
+import os
+import time
+import logging
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Границы бакетов по умолчанию (секунды): от быстрых запросов в БД до долгих кодирований
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: dict = None) -> str:
+    items = list(key) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+        _registry.append(self)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счётчик."""
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = _labels_key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    """Текущее значение (глубина очереди, задачи в работе)."""
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[_labels_key(labels)] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = _labels_key(labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(_Metric):
+    """Распределение длительностей по бакетам."""
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = _labels_key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+        state["counts"][bisect_left(self.buckets, value)] += 1
+        state["sum"] += value
+        state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """with HIST.time(kind="photo"): ... — замер блока (подходит и для async-кода)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for key, state in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state["counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(key, {'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {state['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {state['count']}")
+        return lines
+
+
+def render_all() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# =========================
+#  Метрики бота
+# =========================
+DOWNLOAD_SECONDS = Histogram("shinobi_download_seconds", "Скачивание исходника из Telegram (get_file + download_file)")
+QUEUE_WAIT_SECONDS = Histogram("shinobi_queue_wait_seconds", "Ожидание единицы работы в очереди планировщика")
+TRANSFORM_SECONDS = Histogram("shinobi_transform_seconds", "Преобразование копии (декодирование основы, масштаб, цвет, шум)")
+ENCODE_SECONDS = Histogram("shinobi_encode_seconds", "Кодирование копии (для видео — весь запуск ffmpeg)")
+UPLOAD_SECONDS = Histogram("shinobi_upload_seconds", "Отправка результата в Telegram")
+DB_SECONDS = Histogram("shinobi_db_seconds", "Запросы в MongoDB")
+
+QUEUE_DEPTH = Gauge("shinobi_queue_depth", "Единиц работы, ожидающих в очереди")
+IN_FLIGHT = Gauge("shinobi_in_flight", "Единиц работы в обработке")
+WORKSPACE_BYTES = Gauge("shinobi_workspace_bytes", "Байт зарезервировано под рабочие папки задач (medium=ram|disk)")
+
+BYTES_IN = Counter("shinobi_bytes_in_total", "Байт исходников скачано из Telegram")
+BYTES_OUT = Counter("shinobi_bytes_out_total", "Байт результатов отправлено в Telegram")
+INPUT_CACHE_HITS = Counter("shinobi_input_cache_hits_total", "Исходник взят из кэша без скачивания")
+# Экономия режима кодирования = baseline - encoded (оба счётчика только растут; копия может выйти и больше).
+# Пишутся по завершении фото-задачи; baseline — оценка по копиям задачи, у которых он измерен
+ENCODED_BYTES = Counter("shinobi_encoded_bytes_total", "Байт копий фото, отданных пользователям")
+BASELINE_BYTES = Counter("shinobi_baseline_bytes_total", "Оценка байт тех же копий в baseline-режиме (baseline — с чем сравниваем)")
+JOB_BYTES_SAVED_RATIO = Histogram("shinobi_job_bytes_saved_ratio", "Доля байт, сэкономленная на задаче",
+                                  buckets=(0, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.9))
+UNIQUENESS_RETRIES = Counter("shinobi_uniqueness_retries_total", "Копий пересоздано: слишком похожи на исходник или другую копию")
+
+
+# =========================
+#  HTTP-эндпоинт
+# =========================
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 — эндпоинт не запускается
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+
+_runner = None
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_all(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(port: int = None):
+    """
+    Поднимает http://METRICS_HOST:port/metrics (вызывается при старте бота и воркера;
+    по умолчанию port = METRICS_PORT). Занятый порт не роняет процесс: метрики
+    этого процесса просто недоступны, в лог пишется предупреждение.
+    """
+    global _runner
+    port = METRICS_PORT if port is None else port
+    if not port or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        await runner.cleanup()
+        logging.warning("Метрики не запущены на %s:%d: %s", METRICS_HOST, port, e)
+        return
+    _runner = runner
+    logging.info("Метрики: http://%s:%d/metrics", METRICS_HOST, port)
+
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,78 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# =========================
+# Размеры пулов (из .env)
+# =========================
+CPU_COUNT = os.cpu_count() or 1
+
+# Фото: чистый Python/PIL/NumPy держит GIL -> нужны отдельные процессы
+PHOTO_WORKERS = int(os.getenv("PHOTO_WORKERS", CPU_COUNT))
+# Видео: вся работа в дочернем ffmpeg (asyncio-подпроцесс, см. service.ffmpeg_runner),
+# здесь — только число одновременных запусков для планировщика. libx264 сам занимает
+# все ядра, поэтому по умолчанию одновременно идёт по ffmpeg на каждые 4 ядра
+VIDEO_WORKERS = int(os.getenv("VIDEO_WORKERS", max(1, CPU_COUNT // 4)))
+# Перезапуск процесса-воркера после N задач, чтобы ограничить рост памяти
+PHOTO_MAX_TASKS_PER_CHILD = int(os.getenv("PHOTO_MAX_TASKS_PER_CHILD", 100))
+
+_photo_pool = None
+
+
+def _init_photo_worker():
+    """Инициализация процесса: заранее импортируем тяжёлые модули (PIL, NumPy)."""
+    import service.unique_photo  # noqa: F401
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def start_executors():
+    """Создаёт пул (идемпотентно)."""
+    global _photo_pool
+    if _photo_pool is None:
+        _photo_pool = ProcessPoolExecutor(
+            max_workers=PHOTO_WORKERS,
+            # spawn: fork из процесса с event loop и потоками небезопасен,
+            # к тому же max_tasks_per_child с fork не работает
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_photo_worker,
+            max_tasks_per_child=PHOTO_MAX_TASKS_PER_CHILD
+        )
+        logging.info("Пул запущен: фото=%d процессов (видео: до %d ffmpeg одновременно)", PHOTO_WORKERS, VIDEO_WORKERS)
+
+
+async def warm_up_executors():
+    """
+    Прогрев: поднимаем все процессы фото-пула заранее, чтобы первая задача
+    пользователя не платила за запуск интерпретатора и импорт PIL/NumPy.
+    """
+    start_executors()
+    loop = asyncio.get_running_loop()
+    pids = await asyncio.gather(
+        *(loop.run_in_executor(_photo_pool, _ping) for _ in range(PHOTO_WORKERS))
+    )
+    logging.info("Фото-пул прогрет: %d процессов", len(set(pids)))
+
+
+def shutdown_executors():
+    """Корректная остановка пула при выключении бота (ожидающие задачи отменяются)."""
+    global _photo_pool
+    if _photo_pool is not None:
+        _photo_pool.shutdown(wait=True, cancel_futures=True)
+        _photo_pool = None
+
+
+async def run_photo(func, *args):
+    """Выполнить CPU-задачу по фото в пуле процессов."""
+    start_executors()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_photo_pool, func, *args)
+
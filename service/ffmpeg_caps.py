@@ -0,0 +1,104 @@
+import re
+import logging
+import threading
+import subprocess
+import imageio_ffmpeg
+
+# Кэш возможностей ffmpeg на всё время жизни процесса.
+# Строится один раз при старте (или по команде админа), а не на каждую копию.
+_caps = None
+_lock = threading.Lock()
+
+# Предпочтения кодеков H.264: от аппаратного к программным
+H264_ENCODERS = ("h264_nvenc", "libx264", "libopenh264", "h264_v4l2m2m")
+
+
+def is_nvidia_gpu_available() -> bool:
+    """
+    Проверяем, есть ли доступ к утилите nvidia-smi,
+    что обычно говорит о наличии и рабочем состоянии NVIDIA GPU.
+    """
+    try:
+        subprocess.run(
+            ["nvidia-smi"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        return True
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
+
+
+def _run(ffmpeg_exe: str, *args) -> str:
+    proc = subprocess.run(
+        [ffmpeg_exe, '-hide_banner', *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        errors="replace"
+    )
+    return proc.stdout
+
+
+def _parse_table(text: str) -> set:
+    """
+    Вывод `-encoders`/`-filters`: строки вида " V....D libx264  описание".
+    Имя — второе поле; легенда до разделителя '------' (у фильтров его нет) пропускается.
+    """
+    names = set()
+    for line in text.splitlines():
+        m = re.match(r"^\s*([A-Z.|]{3,6})\s+(\S+)\s+", line)
+        if m and m.group(2) != "=":
+            names.add(m.group(2))
+    return names
+
+
+def probe_capabilities() -> dict:
+    """Опрашивает ffmpeg: путь, версия, энкодеры, фильтры (+ наличие NVIDIA GPU)."""
+    ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+
+    version_line = _run(ffmpeg_exe, '-version').splitlines()[:1]
+    m = re.match(r"ffmpeg version (\S+)", version_line[0]) if version_line else None
+
+    caps = {
+        "ffmpeg": ffmpeg_exe,
+        "version": m.group(1) if m else "unknown",
+        "encoders": _parse_table(_run(ffmpeg_exe, '-encoders')),
+        "filters": _parse_table(_run(ffmpeg_exe, '-filters')),
+        # nvenc бывает вшит в сборку и без видеокарты — проверяем и сам GPU
+        "nvidia_gpu": is_nvidia_gpu_available(),
+    }
+    caps["video_codec"] = pick_video_codec(caps)
+    return caps
+
+
+def pick_video_codec(caps: dict) -> str:
+    """Лучший доступный H.264-энкодер."""
+    for codec in H264_ENCODERS:
+        if codec == "h264_nvenc" and not caps["nvidia_gpu"]:
+            continue
+        if codec in caps["encoders"]:
+            return codec
+    return "h264"
+
+
+def refresh_capabilities() -> dict:
+    """Перестраивает реестр (например, после обновления ffmpeg или драйвера)."""
+    global _caps
+    caps = probe_capabilities()
+    with _lock:
+        _caps = caps
+    logging.info(
+        "ffmpeg %s: кодек %s, энкодеров %d, фильтров %d",
+        caps["version"], caps["video_codec"], len(caps["encoders"]), len(caps["filters"])
+    )
+    return caps
+
+
+def get_capabilities() -> dict:
+    """Возможности ffmpeg из кэша; опрос только при первом обращении."""
+    caps = _caps
+    if caps is None:
+        caps = refresh_capabilities()
+    return caps
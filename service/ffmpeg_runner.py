@@ -0,0 +1,147 @@
+import os
+import signal
+import asyncio
+import logging
+from collections import deque
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Бюджеты одного запуска ffmpeg; 0 — без ограничения
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", 900))          # секунды настенного времени
+FFMPEG_CPU_BUDGET = float(os.getenv("FFMPEG_CPU_BUDGET", 3600))   # секунды CPU (user + sys)
+
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+class FFmpegError(RuntimeError):
+    """ffmpeg завершился с ошибкой; stderr — последние строки его лога."""
+
+    def __init__(self, message: str, stderr: str = ""):
+        super().__init__(message + (f"\n{stderr}" if stderr else ""))
+        self.stderr = stderr
+
+
+class FFmpegBudgetExceeded(FFmpegError):
+    """Превышен бюджет по времени или CPU — процесс остановлен."""
+
+
+def _cpu_seconds(pid: int) -> float | None:
+    """utime + stime процесса из /proc (None, если /proc недоступен)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # comm может содержать пробелы — поля считаем после ')'
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / _CLK_TCK
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+async def _kill(proc: asyncio.subprocess.Process):
+    """
+    Останавливаем всю группу процессов ffmpeg сразу через SIGKILL:
+    результат всё равно выбрасывается, а на SIGTERM ffmpeg может долго
+    дописывать выход (или вовсе не реагировать на бесконечных входах).
+    """
+    if proc.returncode is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        return
+    await proc.wait()
+
+
+async def _read_progress(stream, duration: float, on_progress):
+    """
+    Разбор `-progress pipe:1`: блоки key=value, каждый заканчивается progress=continue|end.
+    out_time_us — позиция в выходе; доля = позиция / длительность исходника.
+    """
+    position = 0.0
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        key, _, value = line.decode(errors="replace").strip().partition("=")
+        if key in ("out_time_us", "out_time_ms") and value.isdigit():
+            # out_time_ms исторически тоже в микросекундах
+            position = int(value) / 1_000_000
+        elif key == "progress" and on_progress is not None:
+            fraction = 1.0 if value == "end" else (min(position / duration, 1.0) if duration else 0.0)
+            # Прогресс — только отчёт: ошибка в нём (flood control или сеть при правке
+            # статуса) не должна останавливать кодирование
+            try:
+                res = on_progress(fraction)
+                if asyncio.iscoroutine(res):
+                    await res
+            except Exception:
+                logging.warning("Ошибка в on_progress ffmpeg, кодирование продолжается", exc_info=True)
+
+
+async def _drain(stream, tail: deque):
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        tail.append(line.decode(errors="replace").rstrip())
+
+
+async def _watch_cpu(pid: int, budget: float):
+    """Возвращается, когда процесс израсходовал budget секунд CPU."""
+    while True:
+        await asyncio.sleep(1)
+        used = _cpu_seconds(pid)
+        if used is None:
+            # Нет /proc (не Linux) или процесс уже завершился — следить нечем
+            return await asyncio.Future()
+        if used > budget:
+            return
+
+
+async def run_ffmpeg(cmd: list, duration: float = 0.0, on_progress=None,
+                     timeout: float = FFMPEG_TIMEOUT, cpu_budget: float = FFMPEG_CPU_BUDGET):
+    """
+    Запускает ffmpeg (cmd[0] — путь к нему) как asyncio-подпроцесс в своей группе процессов.
+      - on_progress(доля 0..1) вызывается по мере кодирования (duration — длительность исходника);
+      - timeout / cpu_budget — лимиты настенного времени и CPU, при превышении FFmpegBudgetExceeded;
+      - отмена корутины (отмена задачи пользователем) останавливает ffmpeg.
+    """
+    cmd = [cmd[0], '-nostdin', '-nostats', '-progress', 'pipe:1', *cmd[1:]]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        # Своя сессия: killpg не заденет бота
+        start_new_session=True
+    )
+    tail = deque(maxlen=20)
+    io_tasks = [
+        asyncio.ensure_future(_read_progress(proc.stdout, duration, on_progress)),
+        asyncio.ensure_future(_drain(proc.stderr, tail)),
+    ]
+    waiter = asyncio.ensure_future(proc.wait())
+    watchers = [waiter]
+    if cpu_budget:
+        watchers.append(asyncio.ensure_future(_watch_cpu(proc.pid, cpu_budget)))
+
+    try:
+        done, _ = await asyncio.wait(watchers, timeout=timeout or None, return_when=asyncio.FIRST_COMPLETED)
+        if waiter not in done:
+            reason = "CPU" if done else "времени"
+            logging.warning("ffmpeg (pid %d) превысил бюджет %s, останавливаем", proc.pid, reason)
+            await _kill(proc)
+            raise FFmpegBudgetExceeded(f"ffmpeg остановлен: превышен бюджет {reason}", "\n".join(tail))
+        # Дочитываем вывод до конца
+        await asyncio.gather(*io_tasks)
+    except BaseException:
+        # Отмена задачи или превышение бюджета
+        await asyncio.shield(_kill(proc))
+        raise
+    finally:
+        for task in watchers + io_tasks:
+            task.cancel()
+
+    if proc.returncode != 0:
+        raise FFmpegError(f"ffmpeg завершился с кодом {proc.returncode}", "\n".join(tail))
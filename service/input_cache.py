@@ -0,0 +1,113 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Каталог и бюджет кэша исходников; INPUT_CACHE_MAX_MB=0 отключает кэш
+INPUT_CACHE_DIR = os.getenv("INPUT_CACHE_DIR", os.path.join("cache", "inputs"))
+INPUT_CACHE_MAX_MB = int(os.getenv("INPUT_CACHE_MAX_MB", 2048))
+# Кэшировать ли фото: по умолчанию нет — фото скачиваются сразу в память и на диск не пишутся,
+# а декодированная основа повторного фото и так держится в кэше воркера пула
+INPUT_CACHE_PHOTOS = os.getenv("INPUT_CACHE_PHOTOS", "0") == "1"
+
+
+class InputCache:
+    """
+    Дисковый кэш скачанных исходников по Telegram file_unique_id
+    (один и тот же файл у всех пользователей и при пересылке).
+      - LRU-вытеснение при превышении бюджета max_bytes;
+      - файл, который сейчас обрабатывается, закреплён и не вытесняется;
+      - повторная загрузка одного ключа параллельно не выполняется (замок на ключ);
+      - скачивание идёт в *.part и атомарно переименовывается.
+    """
+
+    def __init__(self, directory: str = INPUT_CACHE_DIR, max_bytes: int = INPUT_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()     # имя файла -> размер
+        self._pins = defaultdict(int)
+        self._locks = defaultdict(asyncio.Lock)
+        self._total = 0
+        if self.enabled:
+            self._load_existing()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _load_existing(self):
+        """Подхватываем файлы, оставшиеся с прошлого запуска (старые — первыми на вытеснение)."""
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".part"):
+                # Недокачанный файл после падения
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self._total += size
+        self._evict()
+
+    @asynccontextmanager
+    async def acquire(self, key: str, suffix: str, fetch):
+        """
+        Путь к закэшированному исходнику (закреплён на время блока with).
+        При промахе вызывается `await fetch(path)`, которая скачивает файл в path.
+        """
+        name = f"{key}{suffix}"
+        path = os.path.join(self.directory, name)
+
+        async with self._locks[name]:
+            if name in self._entries and os.path.exists(path):
+                self._entries.move_to_end(name)
+                # mtime = время последнего использования (для порядка после рестарта)
+                os.utime(path)
+            else:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = path + ".part"
+                try:
+                    await fetch(tmp_path)
+                    os.replace(tmp_path, path)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                size = os.path.getsize(path)
+                self._total += size - self._entries.get(name, 0)
+                self._entries[name] = size
+            self._pins[name] += 1
+
+        try:
+            yield path
+        finally:
+            self._pins[name] -= 1
+            if self._pins[name] <= 0:
+                del self._pins[name]
+            self._evict()
+
+    def _evict(self):
+        """Удаляем давно не использованные файлы, пока не уложимся в бюджет."""
+        if self._total <= self.max_bytes:
+            return
+        for name in list(self._entries):
+            if self._total <= self.max_bytes:
+                break
+            lock = self._locks.get(name)
+            if self._pins.get(name) or (lock is not None and lock.locked()):
+                continue
+            size = self._entries.pop(name)
+            self._total -= size
+            self._locks.pop(name, None)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                logging.warning("Не удалось удалить %s из кэша исходников", name)
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+
+from service.executors import run_photo
+from service.unique_photo import make_photo_copy_timed
+from service.unique_video import make_unique_videos_async
+from service.segmented_video import use_segments, make_unique_videos_segmented
+from service.uniqueness import UniquenessGuard, UNIQUENESS_MAX_RETRIES, video_hash
+from metrics import (TRANSFORM_SECONDS, ENCODE_SECONDS, UNIQUENESS_RETRIES,
+                     ENCODED_BYTES, BASELINE_BYTES, JOB_BYTES_SAVED_RATIO)
+
+# =========================
+#  Единицы обработки — общие для бота (локальный режим) и воркера (worker.py)
+# =========================
+
+
+class JobBytes:
+    """
+    Статистика размера результатов фото-задачи: сколько байт отдано и сколько
+    было бы без режима кодирования. baseline — с чем сравниваем ("standard": та же
+    копия в PHOTO_ENCODE_MODE=standard). Baseline меряется у первой копии каждой
+    задачи (и у доли ENCODE_STATS_SAMPLE остальных), на всю задачу он пересчитывается
+    по отношению размеров в выборке. Для видео такого baseline нет: сравнение
+    с исходником мерило бы перекодирование, а не режим кодирования.
+    """
+
+    def __init__(self, kind: str, baseline: str):
+        self.kind = kind
+        self.baseline = baseline
+        self.output_bytes = 0       # все отданные копии задачи
+        self.sample_output = 0      # копии с измеренным baseline
+        self.sample_baseline = 0
+        self._sampled = False
+
+    def want_baseline(self) -> bool:
+        """True ровно для одной (первой) копии задачи: её baseline меряется всегда."""
+        if self._sampled:
+            return False
+        self._sampled = True
+        return True
+
+    def add_sample(self, output_bytes: int, baseline_bytes: int):
+        """Копия с измеренным baseline (в том числе отвергнутая проверкой уникальности)."""
+        self.sample_output += output_bytes
+        self.sample_baseline += baseline_bytes
+
+    def add(self, output_bytes: int):
+        """Отданная пользователю копия."""
+        self.output_bytes += output_bytes
+
+    def report(self, job_label):
+        if not self.sample_baseline or not self.sample_output:
+            return
+        # Оценка baseline всей задачи по отношению размеров в выборке
+        baseline_bytes = round(self.output_bytes * self.sample_baseline / self.sample_output)
+        ENCODED_BYTES.inc(self.output_bytes, kind=self.kind, baseline=self.baseline)
+        BASELINE_BYTES.inc(baseline_bytes, kind=self.kind, baseline=self.baseline)
+        if not baseline_bytes:
+            return
+        saved = baseline_bytes - self.output_bytes
+        JOB_BYTES_SAVED_RATIO.observe(max(saved, 0) / baseline_bytes, kind=self.kind)
+        logging.info("Задача %s (%s): результаты %d КБ, сэкономлено ~%d КБ (%.0f%%) относительно %s",
+                     job_label, self.kind, self.output_bytes // 1024, saved // 1024,
+                     100 * saved / baseline_bytes, self.baseline)
+
+
+async def process_photo_async(key: str, source, guard: UniquenessGuard = None,
+                              job_bytes: JobBytes = None) -> bytes:
+    """
+    Одна копия фото в пуле процессов; длительности стадий воркера идут в метрики.
+    С guard копия, слишком похожая на исходник или другие копии задачи,
+    пересоздаётся (не больше UNIQUENESS_MAX_RETRIES раз).
+    """
+    for attempt in range(UNIQUENESS_MAX_RETRIES + 1):
+        measure = job_bytes is not None and job_bytes.want_baseline()
+        data, stats, copy_hash = await run_photo(make_photo_copy_timed, key, source, measure)
+        TRANSFORM_SECONDS.observe(stats["transform"], kind="photo")
+        ENCODE_SECONDS.observe(stats["encode"], kind="photo")
+        if stats["baseline_encode"]:
+            # Лишнее кодирование ради статистики — отдельно, чтобы его цена была видна
+            ENCODE_SECONDS.observe(stats["baseline_encode"], kind="photo_stats")
+        if job_bytes is not None and stats["baseline_bytes"] is not None:
+            job_bytes.add_sample(len(data), stats["baseline_bytes"])
+        if guard is None or guard.accept(copy_hash, force=attempt == UNIQUENESS_MAX_RETRIES):
+            if job_bytes is not None:
+                job_bytes.add(len(data))
+            return data
+        UNIQUENESS_RETRIES.inc(kind="photo")
+
+
+async def process_videos_async(input_path: str, output_paths: list, tier: str = None, info: dict = None,
+                               on_progress=None, guard: UniquenessGuard = None) -> list:
+    """
+    Пакет копий видео: все копии делаются одним процессом ffmpeg
+    (исходник декодируется один раз), прогресс — через on_progress(доля).
+    Длинные ролики кодируются по частям параллельно (service.segmented_video).
+    С guard (нужен info) слишком похожие копии пересоздаются — только они, одним запуском.
+    Возвращаем пути готовых файлов.
+    """
+    make = make_unique_videos_segmented if info and use_segments(info) else make_unique_videos_async
+    pending = list(output_paths)
+    for attempt in range(UNIQUENESS_MAX_RETRIES + 1):
+        with ENCODE_SECONDS.time(kind="video"):
+            await make(input_path, pending, tier, info, on_progress if attempt == 0 else None)
+        if guard is None or info is None:
+            break
+        try:
+            # Копии пакета хэшируются параллельно (у каждой — свои короткие ffmpeg по кадрам)
+            hashes = await asyncio.gather(*(video_hash(path, info["duration"]) for path in pending))
+        except Exception:
+            logging.warning("Не удалось посчитать хэши копий видео, отдаём без проверки", exc_info=True)
+            break
+        accepted = guard.accept_batch(hashes, force=attempt == UNIQUENESS_MAX_RETRIES)
+        pending = [path for path, ok in zip(pending, accepted) if not ok]
+        if not pending:
+            break
+        UNIQUENESS_RETRIES.inc(len(pending), kind="video")
+    return output_paths
@@ -0,0 +1,252 @@
+import os
+import time
+import asyncio
+import inspect
+import logging
+import itertools
+from collections import deque, defaultdict
+
+from dotenv import load_dotenv
+
+from metrics import QUEUE_WAIT_SECONDS, QUEUE_DEPTH, IN_FLIGHT
+
+load_dotenv()
+
+# Сколько копий одного пользователя может обрабатываться одновременно
+USER_MAX_IN_FLIGHT = int(os.getenv("USER_MAX_IN_FLIGHT", 4))
+# Админы обслуживаются раньше остальных (1/0)
+ADMIN_PRIORITY = os.getenv("ADMIN_PRIORITY", "1") == "1"
+
+_DONE = object()
+
+
+class Job:
+    """
+    Заявка пользователя: набор независимых единиц работы одного вида (photo/video).
+    Единица = (вес в копиях, фабрика корутины). Результаты единиц отдаются
+    через async-итератор results() по мере готовности.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id: int, kind: str, units: list, priority: bool = False, on_position=None):
+        self.job_id = next(Job._ids)
+        self.user_id = user_id
+        self.kind = kind
+        self.priority = priority
+        self.on_position = on_position   # async (или обычная) функция (job, position) -> None
+        self.pending = deque(units)
+        self.submitted_at = time.monotonic()
+        self.started = False
+        self.cancelled = False
+        self.position = None
+        self._outstanding = len(self.pending)
+        self._tasks = set()
+        self._results = asyncio.Queue()
+        if self._outstanding == 0:
+            self._results.put_nowait(_DONE)
+
+    async def results(self):
+        """Результаты единиц по мере готовности; исключение единицы пробрасывается."""
+        while True:
+            item = await self._results.get()
+            if item is _DONE:
+                return
+            ok, value = item
+            if not ok:
+                raise value
+            yield value
+
+    def _unit_finished(self, ok: bool, value):
+        self._outstanding -= 1
+        if not self.cancelled:
+            self._results.put_nowait((ok, value))
+            if self._outstanding == 0:
+                self._results.put_nowait(_DONE)
+
+
+class FairScheduler:
+    """
+    Планировщик перед сервисами обработки:
+      - round-robin между пользователями (один тяжёлый запрос не забирает все слоты);
+      - приоритетные пользователи (админы) обслуживаются первыми;
+      - не больше per_user_limit копий одного пользователя в работе;
+      - capacity — число одновременных единиц для каждого вида работы;
+      - позиция в очереди сообщается через Job.on_position (0 = обработка началась);
+      - отмена ещё не запущенных единиц заявки.
+    """
+
+    def __init__(self, capacity: dict, per_user_limit: int = USER_MAX_IN_FLIGHT):
+        self.capacity = dict(capacity)
+        self.per_user_limit = per_user_limit
+        self._busy = defaultdict(int)
+        self._user_in_flight = defaultdict(int)
+        self._user_jobs = {}                           # user_id -> deque[Job]
+        self._rotation = {True: deque(), False: deque()}  # приоритет -> очередь user_id
+        self._jobs = {}                                # job_id -> Job
+
+    # ---------- публичный API ----------
+
+    def submit(self, user_id: int, kind: str, units: list, priority: bool = False, on_position=None) -> Job:
+        job = Job(user_id, kind, units, priority=priority and ADMIN_PRIORITY, on_position=on_position)
+        if not job.pending:
+            return job
+
+        self._jobs[job.job_id] = job
+        jobs = self._user_jobs.get(user_id)
+        if jobs is None:
+            jobs = self._user_jobs[user_id] = deque()
+            self._rotation[job.priority].append(user_id)
+        jobs.append(job)
+        QUEUE_DEPTH.inc(len(job.pending), kind=kind)
+
+        self._dispatch()
+        return job
+
+    def cancel(self, job_id: int, user_id: int = None) -> bool:
+        """
+        Отменяет ещё не запущенные единицы заявки и прерывает работающие
+        (их корутины получают CancelledError — например, ffmpeg останавливается).
+        user_id — проверка, что отменяет владелец.
+        """
+        job = self._jobs.get(job_id)
+        if job is None or job.cancelled or (user_id is not None and job.user_id != user_id):
+            return False
+
+        job.cancelled = True
+        QUEUE_DEPTH.dec(len(job.pending), kind=job.kind)
+        job._outstanding -= len(job.pending)
+        job.pending.clear()
+        current = asyncio.current_task()
+        for task in job._tasks:
+            if task is not current:
+                task.cancel()
+        job._results.put_nowait(_DONE)
+        self._drop_job(job)
+        self._dispatch()
+        return True
+
+    def queue_position(self, job: Job) -> int:
+        """
+        Примерная позиция ожидающей заявки: при round-robin перед ней стоят
+        все приоритетные заявки, заявки пользователей раньше в ротации и
+        по одной заявке каждого пользователя за каждую её предшественницу
+        у того же владельца. 0 — заявка уже в работе.
+        """
+        if job.started:
+            return 0
+        position = 0
+        for priority in (True, False):
+            rotation = self._rotation[priority]
+            if priority != job.priority:
+                if priority:
+                    position += sum(len(self._user_jobs[u]) for u in rotation)
+                continue
+            user_index = rotation.index(job.user_id)
+            job_index = self._user_jobs[job.user_id].index(job)
+            return position + job_index * len(rotation) + user_index + 1
+        return position
+
+    def stats(self) -> dict:
+        """Состояние очереди (для логов/метрик)."""
+        return {
+            "waiting_jobs": sum(len(jobs) for jobs in self._user_jobs.values()),
+            "busy": dict(self._busy),
+            "capacity": dict(self.capacity),
+        }
+
+    # ---------- внутреннее ----------
+
+    def _drop_job(self, job: Job):
+        jobs = self._user_jobs.get(job.user_id)
+        if jobs is not None and job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self._user_jobs[job.user_id]
+                self._rotation[job.priority].remove(job.user_id)
+        if job._outstanding <= 0:
+            self._jobs.pop(job.job_id, None)
+
+    def _can_start(self, job: Job) -> bool:
+        weight = job.pending[0][0]
+        if self._busy[job.kind] >= self.capacity.get(job.kind, 1):
+            return False
+        in_flight = self._user_in_flight[job.user_id]
+        # Единица тяжелее лимита всё же запускается, если у пользователя ничего не идёт
+        return in_flight == 0 or in_flight + weight <= self.per_user_limit
+
+    def _dispatch(self):
+        """Запускаем единицы, пока есть свободные слоты и кого запускать."""
+        progress = True
+        while progress:
+            progress = False
+            for priority in (True, False):
+                rotation = self._rotation[priority]
+                for _ in range(len(rotation)):
+                    user_id = rotation[0]
+                    # Пользователь уходит в конец очереди — следующим будет другой
+                    rotation.rotate(-1)
+                    job = self._user_jobs[user_id][0]
+                    if not self._can_start(job):
+                        continue
+                    self._start_unit(job)
+                    progress = True
+                    break
+                if progress:
+                    break
+        self._notify_positions()
+
+    def _start_unit(self, job: Job):
+        weight, factory = job.pending.popleft()
+        job.started = True
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - job.submitted_at, kind=job.kind)
+        QUEUE_DEPTH.dec(kind=job.kind)
+        IN_FLIGHT.inc(kind=job.kind)
+        self._busy[job.kind] += 1
+        self._user_in_flight[job.user_id] += weight
+        if not job.pending:
+            self._drop_job(job)
+        task = asyncio.ensure_future(factory())
+        job._tasks.add(task)
+        task.add_done_callback(lambda t: self._unit_done(job, weight, t))
+
+    def _unit_done(self, job: Job, weight: int, task: asyncio.Task):
+        """
+        Итог единицы — в колбэке завершения задачи, а не в её finally:
+        задача, отменённая до первого шага, своего кода не выполняет,
+        и слот пула иначе остался бы занятым.
+        """
+        job._tasks.discard(task)
+        if task.cancelled():
+            # Единицу отменили в обход cancel() (остановка цикла, отмена самой задачи) —
+            # отменяем и заявку: results() завершается, а не получает пустую ошибку
+            if not job.cancelled:
+                self.cancel(job.job_id)
+            # Заявку отменили — результат единицы никому не нужен
+            job._unit_finished(False, None)
+        elif task.exception() is not None:
+            e = task.exception()
+            logging.error("Ошибка в задаче %s пользователя %s", job.job_id, job.user_id, exc_info=e)
+            job._unit_finished(False, e)
+            # Остаток заявки уже не нужен
+            self.cancel(job.job_id)
+        else:
+            job._unit_finished(True, task.result())
+
+        IN_FLIGHT.dec(kind=job.kind)
+        self._busy[job.kind] -= 1
+        self._user_in_flight[job.user_id] -= weight
+        if job._outstanding <= 0:
+            self._jobs.pop(job.job_id, None)
+        self._dispatch()
+
+    def _notify_positions(self):
+        for job in list(self._jobs.values()):
+            position = self.queue_position(job) if not job.cancelled else None
+            if position is None or position == job.position:
+                continue
+            job.position = position
+            if job.on_position is not None:
+                res = job.on_position(job, position)
+                if inspect.isawaitable(res):
+                    asyncio.ensure_future(res)
@@ -0,0 +1,139 @@
+import os
+import csv
+import shutil
+import asyncio
+import logging
+import tempfile
+
+from dotenv import load_dotenv
+
+from service.ffmpeg_caps import get_capabilities
+from service.ffmpeg_runner import run_ffmpeg
+from service.unique_video import (
+    random_video_params,
+    build_unique_videos_cmd,
+    build_audio_cmd,
+    print_batch_params
+)
+
+load_dotenv()
+
+# Ролики длиннее этого (сек) кодируются по частям параллельно; 0 — режим отключён
+SEGMENT_MIN_DURATION = float(os.getenv("SEGMENT_MIN_DURATION", 60))
+# Желаемая длина части (реальная граница — ближайший следующий ключевой кадр)
+SEGMENT_SECONDS = float(os.getenv("SEGMENT_SECONDS", 20))
+# Сколько частей кодируется одновременно во всём процессе, на все задачи (по умолчанию — число ядер)
+SEGMENT_WORKERS = int(os.getenv("SEGMENT_WORKERS", os.cpu_count() or 1))
+
+# Общий на процесс лимит кодирования частей: параллельные пакеты (VIDEO_WORKERS)
+# делят одни и те же ядра, а не запускают каждый по SEGMENT_WORKERS ffmpeg
+_part_slots = asyncio.Semaphore(SEGMENT_WORKERS)
+
+
+def use_segments(info: dict) -> bool:
+    """Включать ли сегментный режим для исходника с пробой info."""
+    return bool(SEGMENT_MIN_DURATION) and info.get("duration", 0) > SEGMENT_MIN_DURATION
+
+
+async def _gather_limited(coros: list, semaphore: asyncio.Semaphore):
+    """Выполняет корутины, занимая слот semaphore на каждую; при ошибке остальные отменяются."""
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    tasks = [asyncio.ensure_future(run(c)) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def make_unique_videos_segmented(input_path: str, output_paths: list, tier: str = None,
+                                       info: dict = None, on_progress=None):
+    """
+    Пакет копий для длинного ролика, по частям:
+      1) исходник режется по ключевым кадрам без перекодирования (-c copy -f segment);
+      2) каждая часть проходит тот же граф (split на N копий) параллельно с другими,
+         параметры копии (включая seed шума) одинаковы во всех её частях;
+      3) аудио каждой копии кодируется целиком одним проходом (без щелчков на стыках AAC);
+      4) части склеиваются concat-демультиплексором без перекодирования.
+    info — проба исходника (service.video_profiles.probe_video).
+    """
+    if not output_paths:
+        return
+    ffmpeg_exe = get_capabilities()["ffmpeg"]
+    duration = info.get("duration", 0.0)
+    params = [random_video_params() for _ in output_paths]
+
+    work_dir = tempfile.mkdtemp(prefix="seg_", dir=os.path.dirname(output_paths[0]) or None)
+    try:
+        # 1) Нарезка: только видео, MKV переносит любые кодеки без bitstream-фильтров;
+        #    список частей с их границами (csv: имя,начало,конец) — для весов прогресса
+        list_path = os.path.join(work_dir, 'segments.csv')
+        await run_ffmpeg([
+            ffmpeg_exe, '-y', '-i', input_path, '-map', '0:v:0', '-an', '-c', 'copy',
+            '-f', 'segment', '-segment_time', str(SEGMENT_SECONDS), '-reset_timestamps', '1',
+            '-segment_list', list_path, '-segment_list_type', 'csv',
+            os.path.join(work_dir, 'src_%04d.mkv')
+        ])
+        with open(list_path, newline="") as f:
+            rows = list(csv.reader(f))
+        segments = [row[0] for row in rows]
+        lengths = [float(row[2]) - float(row[1]) for row in rows]
+
+        # Прогресс: доля каждой части (0..1 от её длины) с весом её длины в исходнике,
+        # аудио — проход по всей длине
+        positions = {}
+        weights = {k: length / (sum(lengths) or 1.0) for k, length in enumerate(lengths)}
+        weights["audio"] = 1.0
+
+        def track(key):
+            async def on_part_progress(fraction: float):
+                positions[key] = fraction * weights[key]
+                if on_progress is not None:
+                    # Аудио — отдельный проход по всей длине, считаем его десятой долей работы
+                    video = sum(v for k, v in positions.items() if k != "audio")
+                    res = on_progress(min(0.9 * video + 0.1 * positions.get("audio", 0.0), 1.0))
+                    if asyncio.iscoroutine(res):
+                        await res
+            return on_part_progress
+
+        # 2) Части: все копии каждой части за один проход, профиль — по пробе всего исходника
+        # Аудио кодируется отдельно, но место под него в битрейте резервируем
+        video_info = {**info, "has_audio": False, "reserve_audio": info.get("has_audio", False)}
+        parts = [[os.path.join(work_dir, f"copy{i}_{k:04d}.mp4") for i in range(len(output_paths))]
+                 for k in range(len(segments))]
+        jobs = []
+        for k, segment in enumerate(segments):
+            cmd, _, profile = build_unique_videos_cmd(os.path.join(work_dir, segment), parts[k],
+                                                      tier, video_info, params)
+            jobs.append(run_ffmpeg(cmd, duration=lengths[k], on_progress=track(k)))
+
+        # 3) Аудио копий целиком
+        audio_paths = []
+        if info.get("has_audio"):
+            audio_paths = [os.path.join(work_dir, f"audio{i}.m4a") for i in range(len(output_paths))]
+            jobs.append(run_ffmpeg(build_audio_cmd(input_path, audio_paths, params),
+                                   duration=duration, on_progress=track("audio")))
+
+        await _gather_limited(jobs, _part_slots)
+
+        # 4) Склейка каждой копии (+ её аудио)
+        for i, output_path in enumerate(output_paths):
+            list_path = os.path.join(work_dir, f"copy{i}.txt")
+            with open(list_path, "w") as f:
+                for k in range(len(segments)):
+                    f.write(f"file '{os.path.abspath(parts[k][i])}'\n")
+            cmd = [ffmpeg_exe, '-y', '-f', 'concat', '-safe', '0', '-i', list_path]
+            if audio_paths:
+                cmd += ['-i', audio_paths[i], '-map', '0:v', '-map', '1:a']
+            cmd += ['-c', 'copy', '-movflags', '+faststart', output_path]
+            await run_ffmpeg(cmd)
+
+        logging.info("Сегментный режим: %d частей по ~%g с", len(segments), SEGMENT_SECONDS)
+        print_batch_params(profile, params, output_paths)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
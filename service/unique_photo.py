@@ -1,7 +1,49 @@
+import io
 import os
+import math
+import time
 import random
+from collections import OrderedDict
 import piexif
-from PIL import Image, ImageDraw, ImageEnhance
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image, ImageStat
+
+from service.uniqueness import image_hash
+
+load_dotenv()
+
+# Исходники с длинной стороной больше этой уменьшаются при декодировании до неё (копия после
+# масштаба и поворота может выйти до ~19% больше); меньшие не трогаем; 0 — без ограничения
+PHOTO_MAX_SIDE = int(os.getenv("PHOTO_MAX_SIDE", 2560))
+# Потолок пикселей исходника: больше — отказ до декодирования (защита от decompression bomb)
+PHOTO_MAX_PIXELS = int(os.getenv("PHOTO_MAX_PIXELS", 250_000_000))
+# Pillow проверяет тот же потолок при открытии (предупреждение выше него, ошибка выше двух)
+Image.MAX_IMAGE_PIXELS = PHOTO_MAX_PIXELS
+# Кодирование копий:
+#   standard — JPEG quality=90 с настройками Pillow по умолчанию (как раньше);
+#   tuned    — оптимальные таблицы Хаффмана (и progressive по PHOTO_PROGRESSIVE): те же пиксели, меньше байт;
+#   target   — tuned с подбором наибольшего качества, при котором копия не больше PHOTO_TARGET_KB
+PHOTO_ENCODE_MODE = os.getenv("PHOTO_ENCODE_MODE", "tuned")
+PHOTO_QUALITY = int(os.getenv("PHOTO_QUALITY", 90))
+PHOTO_MIN_QUALITY = int(os.getenv("PHOTO_MIN_QUALITY", 70))
+PHOTO_TARGET_KB = int(os.getenv("PHOTO_TARGET_KB", 500))
+# progressive экономит ещё ~2%, но кодирует в 2-3 раза дольше optimize — по умолчанию выключен
+PHOTO_PROGRESSIVE = os.getenv("PHOTO_PROGRESSIVE", "0") == "1"
+# Прореживание цвета: 4:2:0 (меньше байт), 4:2:2 или 4:4:4 (чётче мелкий цветной текст)
+PHOTO_SUBSAMPLING = os.getenv("PHOTO_SUBSAMPLING", "4:2:0")
+# Доля копий, которые для статистики экономии дополнительно кодируются в режиме standard
+# (второе полное кодирование только ради размера) — сверх первой копии задачи, которая
+# меряется всегда (JobBytes); 0 — только первая копия
+ENCODE_STATS_SAMPLE = float(os.getenv("ENCODE_STATS_SAMPLE", 0.05))
+
+# Верхние границы случайного масштаба и поворота (градусы) в render_unique_photo
+SCALE_MAX = 1.10
+ROTATE_MAX = 5
+
+
+class PhotoTooLarge(ValueError):
+    """Исходник больше PHOTO_MAX_PIXELS."""
 
 def random_flip(img: Image.Image) -> Image.Image:
     """С 50% шансом отражаем картинку по горизонтали, с 50% - по вертикали."""
@@ -34,55 +76,138 @@ def scale_image(img: Image.Image, scale_min=0.90, scale_max=1.10) -> Image.Image
         return img
     return img.resize((new_w, new_h), Image.Resampling.LANCZOS)
 
-def add_transparent_noise(img: Image.Image, intensity=5):
+def geometric_transform(img: Image.Image, angle: float = 0.0, factor: float = 1.0,
+                        hflip: bool = False, vflip: bool = False,
+                        resample=Image.Resampling.BILINEAR) -> Image.Image:
+    """
+    Отражение, поворот на angle градусов (как Image.rotate, против часовой) и масштаб
+    factor одной аффинной матрицей — картинка пересэмплируется ровно один раз.
+    Холст — габарит повёрнутой и отмасштабированной картинки (как rotate(expand=True)),
+    углы заливаются чёрным.
+    BILINEAR: при масштабе ±10% алиасинга нет, а BICUBIC в transform вдвое дороже.
+    """
+    width, height = img.size
+    rad = math.radians(angle)
+    cos, sin = math.cos(rad), math.sin(rad)
+    out_w = max(1, math.ceil(factor * (width * abs(cos) + height * abs(sin)) - 1e-6))
+    out_h = max(1, math.ceil(factor * (width * abs(sin) + height * abs(cos)) - 1e-6))
+
+    # Прямое преобразование: out = c_out + factor * R * F * (p - c_in).
+    # transform ждёт обратное (из точки результата в точку исходника):
+    # p = c_in + F * R^-1 * (out - c_out) / factor
+    fx = -1 if hflip else 1
+    fy = -1 if vflip else 1
+    a, b = fx * cos / factor, -fx * sin / factor
+    d, e = fy * sin / factor, fy * cos / factor
+    c = width / 2 - a * out_w / 2 - b * out_h / 2
+    f = height / 2 - d * out_w / 2 - e * out_h / 2
+
+    fill = (0,) * len(img.getbands()) if len(img.getbands()) > 1 else 0
+    return img.transform((out_w, out_h), Image.Transform.AFFINE, (a, b, c, d, e, f),
+                         resample=resample, fillcolor=fill)
+
+def random_geometry(img: Image.Image, angle_range=(-ROTATE_MAX, ROTATE_MAX),
+                    scale_min=0.90, scale_max=SCALE_MAX) -> Image.Image:
+    """
+    random_flip + random_rotate + scale_image за одно пересэмплирование:
+    отражения с шансом 50%, поворот в angle_range, масштаб в [scale_min, scale_max].
+    """
+    return geometric_transform(
+        img,
+        angle=random.uniform(*angle_range),
+        factor=random.uniform(scale_min, scale_max),
+        hflip=random.choice([True, False]),
+        vflip=random.choice([True, False]),
+    )
+
+def add_transparent_noise(img: Image.Image, intensity=5, rng: np.random.Generator = None) -> Image.Image:
     """
     Добавляем шум сильнее (intensity=5 вместо 3).
     Увеличиваем кол-во точек и прозрачность в чуть большем диапазоне (5..30).
+
+    Все координаты, цвета и альфы генерируются массивами NumPy и смешиваются
+    с пикселями за один проход (без Python-цикла по точкам).
+    RGB-картинка остаётся RGB — без лишнего круга через RGBA.
     """
-    result = img.convert("RGBA")
-    draw = ImageDraw.Draw(result, "RGBA")
-    width, height = result.size
+    rng = rng or np.random.default_rng()
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+
+    arr = np.array(img)
+    height, width = arr.shape[:2]
 
     total_pixels = width * height
     # Увеличим число точек:
     num_points = (total_pixels // 10000) * intensity
+    if num_points == 0:
+        return img
+
+    ys = rng.integers(0, height, num_points)
+    xs = rng.integers(0, width, num_points)
+    colors = rng.integers(0, 256, (num_points, 3), dtype=np.uint32)
+    alpha = rng.integers(5, 31, (num_points, 1), dtype=np.uint32)  # чуть выше альфа
+
+    # Та же формула, что у ImageDraw при заливке полупрозрачным цветом:
+    # dst = (color * a + dst * (255 - a)) / 255
+    src = arr[ys, xs, :3].astype(np.uint32)
+    blended = (colors * alpha + src * (255 - alpha) + 127) // 255
+    arr[ys, xs, :3] = blended.astype(np.uint8)
+
+    return Image.fromarray(arr, img.mode)
+
+# Веса яркости ITU-R 601-2 — те же, что у convert("L") и ImageEnhance
+LUMA = (0.299, 0.587, 0.114)
 
-    for _ in range(num_points):
-        x = random.randint(0, width - 1)
-        y = random.randint(0, height - 1)
-        color = (
-            random.randint(0, 255),
-            random.randint(0, 255),
-            random.randint(0, 255),
-            random.randint(5, 30)  # чуть выше альфа
-        )
-        draw.point((x, y), fill=color)
+def color_matrix(img: Image.Image, saturation: float, brightness: float, contrast: float) -> tuple:
+    """
+    Цепочка ImageEnhance.Color -> Brightness -> Contrast как (matrix, clamp):
+      - matrix — 3x4 для convert("RGB", matrix), все три шага линейны:
+          насыщенность: s*x + (1 - s)*luma(x)
+          яркость:      b*x
+          контраст:     c*x + (1 - c)*m, где m — средняя яркость после первых двух шагов;
+          luma не меняется от насыщенности, поэтому m = b * средняя яркость исходника;
+      - clamp — границы (lo, hi) для LUT: цепочка обрезает до 0..255 после каждого шага,
+        а после линейного контраста эти обрезания складываются в одну пару границ.
+    """
+    means = ImageStat.Stat(img).mean[:3]
+    mean_luma = sum(w * m for w, m in zip(LUMA, means))
+    # ImageEnhance.Contrast берёт среднее, округлённое до целого
+    offset = (1 - contrast) * int(brightness * mean_luma + 0.5)
+    gain = contrast * brightness
 
-    return result
+    matrix = []
+    for row in range(3):
+        for col in range(3):
+            value = (1 - saturation) * LUMA[col] + (saturation if row == col else 0.0)
+            matrix.append(gain * value)
+        matrix.append(offset)
+
+    # Обрезание после насыщенности и яркости: 0..min(255, 255*b), затем контраст
+    low = min(max(round(offset), 0), 255)
+    high = min(max(round(contrast * min(255.0, 255.0 * brightness) + offset), 0), 255)
+    return tuple(matrix), (low, high)
+
+def apply_color_corrections(img: Image.Image, saturation: float, brightness: float, contrast: float) -> Image.Image:
+    """Насыщенность, яркость и контраст: один проход матрицей и, если нужно, LUT-обрезание."""
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    matrix, (low, high) = color_matrix(img, saturation, brightness, contrast)
+    img = img.convert("RGB", matrix)
+    if low > 0 or high < 255:
+        img = img.point([min(max(v, low), high) for v in range(256)] * 3)
+    return img
 
 def strong_color_corrections(img: Image.Image) -> Image.Image:
     """
-    Более сильная цветокоррекция:
+    Более сильная цветокоррекция (одной матрицей, см. color_matrix):
       - Насыщенность (0.8..1.2)
       - Яркость (0.85..1.15)
       - Контраст (0.8..1.3)
     """
-    # 1) Сильнее насыщенность (Color)
     sat_factor = random.uniform(0.8, 1.2)
-    enhancer_color = ImageEnhance.Color(img)
-    img = enhancer_color.enhance(sat_factor)
-
-    # 2) Яркость (Brightness)
     bright_factor = random.uniform(0.85, 1.15)
-    enhancer_bright = ImageEnhance.Brightness(img)
-    img = enhancer_bright.enhance(bright_factor)
-
-    # 3) Контраст (Contrast)
     contrast_factor = random.uniform(0.8, 1.3)
-    enhancer_contrast = ImageEnhance.Contrast(img)
-    img = enhancer_contrast.enhance(contrast_factor)
-
-    return img
+    return apply_color_corrections(img, sat_factor, bright_factor, contrast_factor)
 
 def generate_random_exif() -> bytes:
     """
@@ -111,48 +236,174 @@ def generate_random_exif() -> bytes:
     exif_bytes = piexif.dump(exif_dict)
     return exif_bytes
 
-def make_unique_photo(input_path: str, output_path: str):
+def base_size(size: tuple, max_side: int = PHOTO_MAX_SIDE) -> tuple:
     """
-    1) Открываем картинку
-    2) Последовательно:
-       - Случайно flip (отзеркаливание)
-       - Лёгкий поворот ±5 градусов
-       - Масштаб ±10%
+    Размер основы: исходный, если длинная сторона не больше max_side,
+    иначе пропорционально уменьшенный до max_side.
+    """
+    width, height = size
+    if not max_side or max(width, height) <= max_side:
+        return width, height
+    ratio = max_side / max(width, height)
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+def load_base_image(source, max_side: int = PHOTO_MAX_SIDE) -> Image.Image:
+    """
+    Декодируем исходник ОДИН раз и держим пиксели в памяти (RGB).
+    Все копии пакета строятся от этой общей основы.
+    source — путь к файлу, bytes или бинарный файловый объект.
+
+    Большие исходники сразу уменьшаются до base_size(max_side):
+      - размеры проверяются по заголовку, до декодирования (PHOTO_MAX_PIXELS);
+      - JPEG декодируется libjpeg с уменьшением в 2/4/8 раз (draft);
+      - остаток — reduce по целому коэффициенту и LANCZOS уже на малой картинке.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    try:
+        img = Image.open(source)
+    except Image.DecompressionBombError as e:
+        # Больше двух потолков Pillow отказывает сам, ещё при открытии
+        raise PhotoTooLarge(str(e)) from None
+    width, height = img.size
+    if width * height > PHOTO_MAX_PIXELS:
+        img.close()
+        raise PhotoTooLarge(f"{width}x{height} больше {PHOTO_MAX_PIXELS} пикселей")
+
+    target = base_size(img.size, max_side)
+    if target != img.size:
+        # Для JPEG выбирает наибольшее уменьшение, при котором картинка не меньше target
+        img.draft("RGB", target)
+    img.load()  # декодирование (для JPEG — уже уменьшенное); файл при этом закрывается
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if img.size != target:
+        img = img.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    return img
+
+def render_unique_photo(base: Image.Image) -> Image.Image:
+    """
+    Одна уникальная копия из уже декодированной основы (основа не меняется):
+       - Отражения, поворот ±5° и масштаб ±10% — одним пересэмплированием
        - Сильная цветокоррекция
        - Случайный шум
-    3) Сохраняем JPEG (без EXIF)
-    4) Генерируем рандомный EXIF
-    5) Встраиваем EXIF (piexif.insert)
     """
-    import tempfile
+    # 1-3) flip + rotate + scale
+    img = random_geometry(base)
+
+    # 4) сильная цветокоррекция
+    img = strong_color_corrections(img)
 
-    with Image.open(input_path) as img:
+    # 5) шум
+    img = add_transparent_noise(img, intensity=5)
 
-        # 3) scale ±10%
-        img = scale_image(img, 0.90, 1.10)
+    # Приводим в RGB (на случай RGBA или др. режим)
+    return img if img.mode == "RGB" else img.convert("RGB")
 
-        # 4) сильная цветокоррекция
-        img = strong_color_corrections(img)
+def _jpeg(img: Image.Image, exif: bytes, **options) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", exif=exif, **options)
+    return buf.getvalue()
 
-        # 5) шум
-        img = add_transparent_noise(img, intensity=5)
+def encode_photo(img: Image.Image, mode: str = PHOTO_ENCODE_MODE, exif: bytes = None) -> bytes:
+    """
+    JPEG сразу в буфер памяти, случайный EXIF прикладывается при том же
+    кодировании (без временного файла и без повторной записи piexif.insert).
+    mode — см. PHOTO_ENCODE_MODE. В режиме target качество подбирается двоичным
+    поиском между PHOTO_MIN_QUALITY и PHOTO_QUALITY на быстрых кодированиях
+    без optimize/progressive (они только уменьшают файл), итоговое — одно с ними.
+    """
+    exif = exif if exif is not None else generate_random_exif()
+    if mode == "standard":
+        return _jpeg(img, exif, quality=90)
 
-        # Приводим в RGB (на случай RGBA или др. режим)
-        final = img.convert("RGB")
+    options = {"optimize": True, "progressive": PHOTO_PROGRESSIVE, "subsampling": PHOTO_SUBSAMPLING}
+    quality = PHOTO_QUALITY
+    target = PHOTO_TARGET_KB * 1024
+    if mode == "target" and target:
+        fast = {"subsampling": PHOTO_SUBSAMPLING}
+        if len(_jpeg(img, exif, quality=quality, **fast)) > target:
+            # Наибольшее качество, при котором копия укладывается в цель (или минимальное)
+            low, high, quality = PHOTO_MIN_QUALITY, PHOTO_QUALITY - 1, PHOTO_MIN_QUALITY
+            while low <= high:
+                middle = (low + high) // 2
+                if len(_jpeg(img, exif, quality=middle, **fast)) <= target:
+                    quality, low = middle, middle + 1
+                else:
+                    high = middle - 1
+    return _jpeg(img, exif, quality=quality, **options)
 
-        # Сохраняем во временный файл
-        import tempfile
-        tmp_fd, tmp_path = tempfile.mkstemp(suffix=".jpg")
-        os.close(tmp_fd)
+# Кэш декодированных основ внутри процесса-воркера: копии одного исходника,
+# попавшие в один и тот же процесс пула, не декодируют его заново.
+BASE_CACHE_SIZE = 2
+_base_cache = OrderedDict()
 
-        final.save(tmp_path, format="JPEG", quality=90)
+def get_base_image(key: str, source) -> Image.Image:
+    """Декодированная основа по ключу исходника (LRU на BASE_CACHE_SIZE записей)."""
+    base = _base_cache.get(key)
+    if base is None:
+        base = load_base_image(source)
+        _base_cache[key] = base
+        while len(_base_cache) > BASE_CACHE_SIZE:
+            _base_cache.popitem(last=False)
+    else:
+        _base_cache.move_to_end(key)
+    return base
 
-    # 6) генерируем EXIF
-    exif_bytes = generate_random_exif()
+def make_photo_copy(key: str, source) -> bytes:
+    """
+    Одна копия для пула процессов: основа берётся из кэша воркера по key
+    (например, хэш исходника), декодирование — только при промахе.
+    """
+    return encode_photo(render_unique_photo(get_base_image(key, source)))
+
+def make_photo_copy_timed(key: str, source, measure_baseline: bool = False) -> tuple:
+    """
+    То же, что make_photo_copy, но дополнительно возвращает статистику
+    (воркер — отдельный процесс, метрики собираются в основном) и перцептивный хэш
+    копии для проверки уникальности (считается по готовой картинке до кодирования):
+    (bytes, {"transform": сек, "encode": сек, "baseline_bytes": байт, "baseline_encode": сек}, хэш).
+    baseline_bytes — размер той же копии в режиме standard (для статистики экономии);
+    меряется при measure_baseline и у доли ENCODE_STATS_SAMPLE копий, у остальных None.
+    """
+    start = time.perf_counter()
+    img = render_unique_photo(get_base_image(key, source))
+    rendered = time.perf_counter()
+    exif = generate_random_exif()
+    data = encode_photo(img, exif=exif)
+    encoded = time.perf_counter()
+    stats = {"transform": rendered - start, "encode": encoded - rendered,
+             "baseline_bytes": None, "baseline_encode": 0.0}
+    if PHOTO_ENCODE_MODE == "standard":
+        stats["baseline_bytes"] = len(data)
+    elif measure_baseline or random.random() < ENCODE_STATS_SAMPLE:
+        stats["baseline_bytes"] = len(encode_photo(img, "standard", exif))
+        stats["baseline_encode"] = time.perf_counter() - encoded
+    return data, stats, image_hash(img)
 
-    # 7) вставляем EXIF
-    with open(tmp_path, "rb") as f_in, open(output_path, "wb") as f_out:
-        f_out.write(f_in.read())
+def make_unique_photos(source, count: int):
+    """
+    Генератор: декодирует исходник один раз и по одной отдаёт
+    `count` закодированных копий (bytes JPEG с EXIF).
+    Вызывающий может отправлять готовую копию, пока считается следующая.
+    """
+    base = load_base_image(source)
+    for _ in range(count):
+        yield encode_photo(render_unique_photo(base))
 
-    piexif.insert(exif_bytes, output_path)
-    os.remove(tmp_path)
+def make_unique_photo(source, output_path: str = None) -> bytes:
+    """
+    1) Открываем картинку (путь, bytes или файловый объект)
+    2) Последовательно:
+       - Отражения, поворот ±5° и масштаб ±10%
+       - Сильная цветокоррекция
+       - Случайный шум
+    3) Кодируем JPEG в памяти вместе со случайным EXIF
+    4) Если передан output_path — записываем результат на диск (один раз)
+    Возвращаем байты готового JPEG.
+    """
+    data = encode_photo(render_unique_photo(load_base_image(source)))
+    if output_path:
+        with open(output_path, "wb") as f:
+            f.write(data)
+    return data
@@ -1,85 +1,159 @@
 import random
+import asyncio
+import logging
 import subprocess
-import imageio_ffmpeg
 
-def is_nvidia_gpu_available():
+from service.ffmpeg_caps import get_capabilities
+from service.video_profiles import probe_video, pick_profile, encoder_args, audio_encoder_args
+from service.ffmpeg_runner import run_ffmpeg
+
+def random_video_params() -> dict:
+    """Генерация "мягких" случайных параметров для одной копии."""
+    return {
+        "brightness":  random.uniform(-0.05, 0.05),   # вместо -0.1..0.1
+        "contrast":    random.uniform(0.95, 1.10),    # уже не 0.9..1.2
+        "saturation":  random.uniform(0.95, 1.10),    # уже не 0.9..1.3
+        "noise_level": random.randint(3, 15),         # уменьшим шум
+        "noise_seed":  random.randint(0, 2**31 - 1),  # один шум во всех частях копии (сегментный режим)
+        "hue_shift":   random.uniform(-10, 10),       # вместо -20..20
+        "hue_sat":     random.uniform(0.95, 1.05),    # диапазон насыщенности hue
+        "rs":          random.uniform(-0.1, 0.1),     # меньше разброс colorbalance
+        "gs":          random.uniform(-0.1, 0.1),
+        "bs":          random.uniform(-0.1, 0.1),
+        # Аудио тоже сделаем чуть мягче
+        "volume_gain": random.uniform(0.95, 1.05),
+        "atempo_val":  random.uniform(0.98, 1.02),
+    }
+
+def _chain(filters: list, available: set, passthrough: str) -> str:
+    """Собираем цепочку, пропуская фильтры, которых нет в этой сборке ffmpeg."""
+    chain = [f for f in filters if available is None or f.split("=", 1)[0] in available]
+    # Пустая цепочка недопустима в filter_complex — подставляем сквозной фильтр
+    return ",".join(chain) or passthrough
+
+def build_video_filters(p: dict, available: set = None) -> str:
+    """Цепочка видеофильтров для одной копии."""
+    return _chain([
+        f"eq=brightness={p['brightness']:.3f}:contrast={p['contrast']:.3f}:saturation={p['saturation']:.3f}",
+        f"colorbalance=rs={p['rs']:.3f}:gs={p['gs']:.3f}:bs={p['bs']:.3f}",
+        f"noise=alls={p['noise_level']}:allf=t+u:all_seed={p['noise_seed']}",
+        f"hue=h={p['hue_shift']:.3f}:s={p['hue_sat']:.3f}",
+    ], available, "null")
+
+def build_audio_filters(p: dict, available: set = None) -> str:
+    """Фильтр для аудио одной копии."""
+    return _chain([
+        f"volume={p['volume_gain']:.3f}",
+        f"atempo={p['atempo_val']:.3f}",
+    ], available, "anull")
+
+def print_video_params(p: dict, output_path: str):
+    """Выводим информацию о применённых параметрах."""
+    print("=== Использованные параметры (мягкая коррекция) ===")
+    print(f"Brightness={p['brightness']:.3f}, Contrast={p['contrast']:.3f}, Saturation={p['saturation']:.3f}")
+    print(f"Noise={p['noise_level']}, Hue shift={p['hue_shift']:.3f}, Hue sat={p['hue_sat']:.3f}")
+    print(f"Colorbalance: rs={p['rs']:.3f}, gs={p['gs']:.3f}, bs={p['bs']:.3f}")
+    print(f"Volume={p['volume_gain']:.3f}, Atempo={p['atempo_val']:.3f}")
+    print("Файл сохранён как:", output_path)
+
+def build_unique_videos_cmd(input_path: str, output_paths: list, tier: str = None, info: dict = None,
+                            params: list = None):
     """
-    Проверяем, есть ли доступ к утилите nvidia-smi,
-    что обычно говорит о наличии и рабочем состоянии NVIDIA GPU.
+    Команда ffmpeg, которая делает len(output_paths) уникальных копий за ОДИН проход:
+    исходник демультиплексируется и декодируется один раз, затем
+    split/asplit размножают поток на N веток, у каждой ветки свои
+    случайные параметры и свой выходной файл.
+    Профиль кодирования выбирается по уровню tier и пробе исходника info
+    (если не передана — пробуем здесь). params — готовые параметры копий
+    (иначе случайные), чтобы части одной копии обрабатывались одинаково.
+    Возвращает (cmd, params копий, profile).
     """
-    try:
-        subprocess.run(
-            ["nvidia-smi"],
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-        )
-        return True
-    except (subprocess.CalledProcessError, FileNotFoundError):
-        return False
+    n = len(output_paths)
 
-def make_unique_video(input_path, output_path):
-    # Генерация "мягких" случайных параметров
-    brightness   = random.uniform(-0.05, 0.05)   # вместо -0.1..0.1
-    contrast     = random.uniform(0.95, 1.10)    # уже не 0.9..1.2
-    saturation   = random.uniform(0.95, 1.10)    # уже не 0.9..1.3
-    noise_level  = random.randint(3, 15)         # уменьшим шум
-    hue_shift    = random.uniform(-10, 10)       # вместо -20..20
-    hue_sat      = random.uniform(0.95, 1.05)    # диапазон насыщенности hue
-    rs           = random.uniform(-0.1, 0.1)     # меньше разброс colorbalance
-    gs           = random.uniform(-0.1, 0.1)
-    bs           = random.uniform(-0.1, 0.1)
-
-    # Аудио тоже сделаем чуть мягче
-    volume_gain  = random.uniform(0.95, 1.05)
-    atempo_val   = random.uniform(0.98, 1.02)
-
-    # Формируем цепочку видеофильтров
-    video_filters = (
-        f"eq=brightness={brightness:.3f}:contrast={contrast:.3f}:saturation={saturation:.3f},"
-        f"colorbalance=rs={rs:.3f}:gs={gs:.3f}:bs={bs:.3f},"
-        f"noise=alls={noise_level}:allf=t+u,"
-        f"hue=h={hue_shift:.3f}:s={hue_sat:.3f}"
-    )
-
-    # Фильтр для аудио
-    audio_filters = f"volume={volume_gain:.3f},atempo={atempo_val:.3f}"
-
-    # Проверяем, есть ли NVIDIA GPU
-    if is_nvidia_gpu_available():
-        video_codec = 'h264_nvenc'
-        print("Используем аппаратное кодирование (NVENC).")
-    else:
-        video_codec = 'libx264'
-        print("Аппаратное кодирование не доступно. Используем CPU (libx264).")
-
-    # Путь к локальному ffmpeg
-    ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+    # Путь к ffmpeg, кодек и набор фильтров — из реестра возможностей (без проб на каждый вызов)
+    caps = get_capabilities()
+    ffmpeg_exe = caps["ffmpeg"]
+    video_codec = caps["video_codec"]
+    filters = caps["filters"]
+
+    info = info or probe_video(input_path)
+    profile = pick_profile(info, tier)
+    # Без аудиодорожки ссылка [0:a] в filter_complex уронит ffmpeg
+    with_audio = info["has_audio"]
+    params = params or [random_video_params() for _ in range(n)]
+
+    # Граф: [0:v](scale,)split=N -> N веток фильтров (и так же для аудио).
+    # Уменьшение кадра делается один раз до split, а не в каждой ветке
+    source = "[0:v]"
+    if profile["scale"] and "scale" in filters:
+        source += "scale=%d:%d," % profile["scale"]
+    graph = [source + "split=%d%s" % (n, "".join(f"[v{i}]" for i in range(n)))]
+    for i, p in enumerate(params):
+        graph.append(f"[v{i}]{build_video_filters(p, filters)}[vout{i}]")
+    if with_audio:
+        graph.append("[0:a]asplit=%d%s" % (n, "".join(f"[a{i}]" for i in range(n))))
+        for i, p in enumerate(params):
+            graph.append(f"[a{i}]{build_audio_filters(p, filters)}[aout{i}]")
 
     cmd = [
         ffmpeg_exe,
         '-y',
         '-i', input_path,
-        '-vf', video_filters,
-        '-af', audio_filters,
-        '-c:v', video_codec,
-        # Для NVENC некоторые параметры могут отличаться, 
-        # но baseline/level 3.0 тоже работают, если это нужно:
-        '-profile:v', 'baseline',
-        '-level', '3.0',
-        '-pix_fmt', 'yuv420p',
-        '-preset', 'medium',   # Можно менять на 'fast'/'slow' при необходимости
-        '-movflags', '+faststart',
-        '-c:a', 'aac',
-        output_path
+        '-filter_complex', ";".join(graph),
     ]
 
+    # Опции кодирования в ffmpeg относятся к следующему за ними выходу,
+    # поэтому повторяем их для каждой копии
+    video_args = encoder_args(profile, video_codec)
+    for i, output_path in enumerate(output_paths):
+        cmd += ['-map', f'[vout{i}]']
+        if with_audio:
+            cmd += ['-map', f'[aout{i}]', *audio_encoder_args()]
+        cmd += video_args + ['-movflags', '+faststart', output_path]
+
+    return cmd, params, profile
+
+def build_audio_cmd(input_path: str, output_paths: list, params: list) -> list:
+    """Только аудио копий (по их params) за один проход: [0:a]asplit=N -> N файлов AAC."""
+    caps = get_capabilities()
+    n = len(output_paths)
+    graph = ["[0:a]asplit=%d%s" % (n, "".join(f"[a{i}]" for i in range(n)))]
+    for i, p in enumerate(params):
+        graph.append(f"[a{i}]{build_audio_filters(p, caps['filters'])}[aout{i}]")
+
+    cmd = [caps["ffmpeg"], '-y', '-i', input_path, '-filter_complex', ";".join(graph)]
+    for i, output_path in enumerate(output_paths):
+        cmd += ['-map', f'[aout{i}]', *audio_encoder_args(), output_path]
+    return cmd
+
+def print_batch_params(profile: dict, params: list, output_paths: list):
+    logging.info("Профиль: %s, размер %s, maxrate %s кбит/с",
+                 profile["tier"], profile["scale"] or "исходный", profile["maxrate"] or "-")
+    for p, output_path in zip(params, output_paths):
+        print_video_params(p, output_path)
+
+def make_unique_videos(input_path: str, output_paths: list, tier: str = None, info: dict = None):
+    """Пакет копий синхронно (блокирует поток до конца ffmpeg)."""
+    if not output_paths:
+        return
+    cmd, params, profile = build_unique_videos_cmd(input_path, output_paths, tier, info)
     subprocess.run(cmd, check=True)
+    print_batch_params(profile, params, output_paths)
 
-    # Выводим информацию о применённых параметрах
-    print("=== Использованные параметры (мягкая коррекция) ===")
-    print(f"Brightness={brightness:.3f}, Contrast={contrast:.3f}, Saturation={saturation:.3f}")
-    print(f"Noise={noise_level}, Hue shift={hue_shift:.3f}, Hue sat={hue_sat:.3f}")
-    print(f"Colorbalance: rs={rs:.3f}, gs={gs:.3f}, bs={bs:.3f}")
-    print(f"Volume={volume_gain:.3f}, Atempo={atempo_val:.3f}")
-    print("Файл сохранён как:", output_path)
+async def make_unique_videos_async(input_path: str, output_paths: list, tier: str = None,
+                                   info: dict = None, on_progress=None):
+    """
+    Пакет копий в asyncio-подпроцессе: прогресс через on_progress(доля),
+    бюджеты времени/CPU и остановка ffmpeg при отмене — см. service.ffmpeg_runner.
+    """
+    if not output_paths:
+        return
+    if info is None:
+        info = await asyncio.to_thread(probe_video, input_path)
+    cmd, params, profile = build_unique_videos_cmd(input_path, output_paths, tier, info)
+    await run_ffmpeg(cmd, duration=info.get("duration", 0.0), on_progress=on_progress)
+    print_batch_params(profile, params, output_paths)
+
+def make_unique_video(input_path, output_path):
+    """Одна копия — частный случай пакетной обработки."""
+    make_unique_videos(input_path, [output_path])
@@ -0,0 +1,212 @@
+import io
+import os
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+from service.ffmpeg_caps import get_capabilities
+from service.ffmpeg_runner import run_ffmpeg
+
+load_dotenv()
+
+# Проверка уникальности копий перцептивными хэшами; 0 — выключена
+UNIQUENESS_CHECK = os.getenv("UNIQUENESS_CHECK", "1") == "1"
+# Минимальное расстояние Хэмминга (из 128 бит pHash + dHash; у видео — среднее по кадрам)
+# от копии до исходника и до уже принятых копий задачи
+UNIQUENESS_MIN_DISTANCE_PHOTO = float(os.getenv("UNIQUENESS_MIN_DISTANCE_PHOTO", 6))
+# Видеофильтры меняют только цвет и шум, структура кадра остаётся: копии видео
+# в 1.5-4 битах от исходника, порог ловит лишь вырожденные (почти нетронутые) копии
+UNIQUENESS_MIN_DISTANCE_VIDEO = float(os.getenv("UNIQUENESS_MIN_DISTANCE_VIDEO", 1))
+# Поэтому проверка видео по умолчанию выключена: хэш копии — несколько запусков ffmpeg
+# (~0.7 с на копию 720p), а отбраковывать почти нечего; 1 — включить
+UNIQUENESS_CHECK_VIDEO = os.getenv("UNIQUENESS_CHECK_VIDEO", "0") == "1"
+# Сколько раз пересоздаём слишком похожую копию; после этого отдаём как есть
+UNIQUENESS_MAX_RETRIES = int(os.getenv("UNIQUENESS_MAX_RETRIES", 2))
+# Сколько кадров видео хэшируется (равномерно по длительности)
+UNIQUENESS_KEYFRAMES = int(os.getenv("UNIQUENESS_KEYFRAMES", 4))
+# Сколько хэшей исходников держать в памяти (повторные исходники не хэшируются заново)
+UNIQUENESS_CACHE_SIZE = int(os.getenv("UNIQUENESS_CACHE_SIZE", 256))
+
+# Миниатюра яркости 36x32: центральные 32x32 — для pHash, блоки 4x4 (9x8) — для dHash
+THUMB_WIDTH, THUMB_HEIGHT = 36, 32
+# 64 бита pHash + 64 бита dHash = 16 байт на картинку (кадр)
+HASH_BYTES = 16
+HASH_BITS = 8 * HASH_BYTES
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Ортонормированная матрица DCT-II: DCT двумерного блока X = D @ X @ D.T."""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    d = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    d[0] /= np.sqrt(2)
+    return d.astype(np.float32)
+
+
+_DCT32 = _dct_matrix(32)
+
+
+def hash_thumbnails(thumbs: np.ndarray) -> np.ndarray:
+    """
+    Пачка миниатюр яркости (N, 32, 36) -> хэши (N, 16) uint8, всё векторно:
+      - pHash: DCT центральных 32x32, 8x8 низких частот без DC, бит = коэффициент > медианы;
+      - dHash: средние блоков 4x4 (сетка 8x9), бит = яркость растёт слева направо.
+    """
+    thumbs = np.asarray(thumbs, dtype=np.float32)
+    center = thumbs[:, :, 2:34]
+    coeffs = (_DCT32 @ center @ _DCT32.T)[:, :8, :8].reshape(len(thumbs), 64)
+    median = np.median(coeffs[:, 1:], axis=1, keepdims=True)
+    phash = coeffs > median
+
+    blocks = thumbs.reshape(len(thumbs), 8, 4, 9, 4).mean(axis=(2, 4))
+    dhash = (blocks[:, :, 1:] > blocks[:, :, :-1]).reshape(len(thumbs), 64)
+
+    return np.packbits(np.concatenate([phash, dhash], axis=1), axis=1)
+
+
+def image_thumbnail(img: Image.Image) -> np.ndarray:
+    """Миниатюра яркости 32x36: сначала уменьшение (дёшево), потом перевод в L."""
+    small = img.resize((THUMB_WIDTH, THUMB_HEIGHT), Image.Resampling.BOX, reducing_gap=2.0)
+    return np.asarray(small.convert("L"))
+
+
+def image_hash(img: Image.Image) -> np.ndarray:
+    """Хэш одной картинки (16 байт)."""
+    return hash_thumbnails(image_thumbnail(img)[None])[0]
+
+
+def photo_source_hash(source) -> np.ndarray:
+    """
+    Хэш исходника фото (путь, bytes или файловый объект). Для JPEG декодирование
+    сразу в 1/8 размера (draft) — полная картинка для хэша не нужна.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with Image.open(source) as img:
+        img.draft("RGB", (THUMB_WIDTH * 4, THUMB_HEIGHT * 4))
+        return image_hash(img.convert("RGB"))
+
+
+async def _frame_thumbnail(ffmpeg_exe: str, path: str, offset: float, raw_path: str) -> bytes:
+    await run_ffmpeg([
+        ffmpeg_exe, '-y', '-v', 'error', '-ss', f"{offset:.3f}", '-i', path, '-frames:v', '1',
+        '-vf', f"scale={THUMB_WIDTH}:{THUMB_HEIGHT}:flags=area,format=gray", '-f', 'rawvideo', raw_path
+    ], timeout=60, cpu_budget=60)
+    with open(raw_path, "rb") as f:
+        return f.read()
+
+
+async def video_hash(path: str, duration: float, frames: int = UNIQUENESS_KEYFRAMES) -> np.ndarray:
+    """
+    Хэш видео — хэши frames кадров в одинаковых относительных точках (frames * 16 байт).
+    Каждый кадр — отдельный короткий ffmpeg с быстрым -ss до ключевого кадра
+    (запуски параллельны; один граф на все кадры читает входы целиком и в разы медленнее).
+    """
+    ffmpeg_exe = get_capabilities()["ffmpeg"]
+    offsets = [duration * (k + 0.5) / frames if duration else 0.0 for k in range(frames)]
+    with tempfile.TemporaryDirectory(prefix="vhash_") as tmp:
+        raws = await asyncio.gather(*(
+            _frame_thumbnail(ffmpeg_exe, path, offset, os.path.join(tmp, f"{k}.gray"))
+            for k, offset in enumerate(offsets)
+        ))
+
+    size = THUMB_WIDTH * THUMB_HEIGHT
+    # Кадр за концом короткого ролика может не получиться: берём соседний, чтобы длины совпадали
+    thumbs = [np.frombuffer(raw[:size], dtype=np.uint8) for raw in raws if len(raw) >= size]
+    if not thumbs:
+        raise ValueError(f"Не удалось получить кадры из {path}")
+    thumbs += thumbs[-1:] * (frames - len(thumbs))
+    return hash_thumbnails(np.stack(thumbs).reshape(frames, THUMB_HEIGHT, THUMB_WIDTH)).reshape(-1)
+
+
+def distances(hashes: np.ndarray, others: np.ndarray) -> np.ndarray:
+    """
+    Попарные расстояния Хэмминга (N, M) между хэшами (N, B) и (M, B); у видео (B = кадры * 16)
+    расстояние нормировано на кадр, чтобы порог не зависел от числа кадров.
+    """
+    hashes = np.atleast_2d(hashes)
+    others = np.atleast_2d(others)
+    bits = _POPCOUNT[hashes[:, None, :] ^ others[None, :, :]].sum(axis=2)
+    return bits / (hashes.shape[1] / HASH_BYTES)
+
+
+class SourceHashCache:
+    """LRU хэшей исходников по ключу (file_unique_id): повторный исходник не хэшируется."""
+
+    def __init__(self, size: int = UNIQUENESS_CACHE_SIZE):
+        self.size = size
+        self._hashes = OrderedDict()
+
+    async def get(self, key: str, compute) -> np.ndarray:
+        """Хэш по ключу; при промахе — `await compute()`."""
+        cached = self._hashes.get(key)
+        if cached is not None:
+            self._hashes.move_to_end(key)
+            return cached
+        value = await compute()
+        self._hashes[key] = value
+        while len(self._hashes) > self.size:
+            self._hashes.popitem(last=False)
+        return value
+
+
+source_hashes = SourceHashCache()
+
+
+class UniquenessGuard:
+    """
+    Проверка копий одной задачи: каждая новая копия сравнивается с исходником и со всеми
+    уже принятыми копиями; слишком похожая (ближе min_distance) не принимается —
+    вызывающий пересоздаёт только её. Сравнение и приём без await между ними,
+    поэтому параллельные копии тоже попарно проверены.
+    """
+
+    def __init__(self, source_hash: np.ndarray, min_distance: float):
+        self.min_distance = min_distance
+        self._accepted = [source_hash]
+
+    def accept(self, copy_hash: np.ndarray, force: bool = False) -> bool:
+        """True — копия принята; force — принять в любом случае (попытки кончились)."""
+        return self.accept_batch([copy_hash], force)[0]
+
+    def accept_batch(self, copy_hashes: list, force: bool = False) -> list:
+        """Пакет копий (видео): по порядку, каждая и против принятых из этого же пакета."""
+        result = []
+        for copy_hash in copy_hashes:
+            nearest = distances(copy_hash, np.stack(self._accepted)).min()
+            ok = force or nearest >= self.min_distance
+            if ok:
+                self._accepted.append(copy_hash)
+            result.append(ok)
+        return result
+
+
+async def photo_guard(key: str, source) -> UniquenessGuard | None:
+    """Проверка для фото-задачи (None — проверка выключена или исходник не разобрать)."""
+    if not UNIQUENESS_CHECK:
+        return None
+    try:
+        source_hash = await source_hashes.get(key, lambda: asyncio.to_thread(photo_source_hash, source))
+    except Exception:
+        logging.warning("Не удалось посчитать хэш исходника %s, копии не проверяются", key, exc_info=True)
+        return None
+    return UniquenessGuard(source_hash, UNIQUENESS_MIN_DISTANCE_PHOTO)
+
+
+async def video_guard(key: str, path: str, info: dict) -> UniquenessGuard | None:
+    """Проверка для видео-задачи (info — probe_video исходника); только при UNIQUENESS_CHECK_VIDEO."""
+    if not (UNIQUENESS_CHECK and UNIQUENESS_CHECK_VIDEO):
+        return None
+    try:
+        source_hash = await source_hashes.get(key, lambda: video_hash(path, info["duration"]))
+    except Exception:
+        logging.warning("Не удалось посчитать хэш исходника %s, копии не проверяются", key, exc_info=True)
+        return None
+    return UniquenessGuard(source_hash, UNIQUENESS_MIN_DISTANCE_VIDEO)
@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import shutil
+import subprocess
+
+from dotenv import load_dotenv
+
+from service.ffmpeg_caps import get_capabilities
+
+load_dotenv()
+
+# =========================
+#  Уровни скорость/качество кодирования видео.
+#  preset/crf — для libx264 (для NVENC пресет переводится в p1..p7),
+#  max_short_side — ограничение меньшей стороны кадра (None — без ограничения),
+#  gop_seconds — интервал ключевых кадров в секундах.
+# =========================
+VIDEO_TIERS = {
+    "fast":     {"preset": "veryfast", "crf": 26, "max_short_side": 720,  "gop_seconds": 4, "nvenc_preset": "p2"},
+    "balanced": {"preset": "fast",     "crf": 23, "max_short_side": 1080, "gop_seconds": 2, "nvenc_preset": "p4"},
+    "quality":  {"preset": "medium",   "crf": 20, "max_short_side": None, "gop_seconds": 2, "nvenc_preset": "p6"},
+}
+# От медленного к быстрому: куда сдвигаться для длинных роликов
+TIER_ORDER = ("quality", "balanced", "fast")
+
+# Уровень по умолчанию (админ может сменить командой /video_tier без перезапуска)
+VIDEO_TIER = os.getenv("VIDEO_TIER", "balanced")
+# Ролики длиннее этого (сек) кодируются на уровень быстрее выбранного; 0 — отключено
+LONG_VIDEO_SECONDS = float(os.getenv("LONG_VIDEO_SECONDS", 120))
+
+_default_tier = VIDEO_TIER if VIDEO_TIER in VIDEO_TIERS else "balanced"
+
+# Режим битрейта: crf — только качество (размер любой); capped — то же качество,
+# но пиковый битрейт ограничен так, чтобы копия уложилась в VIDEO_TARGET_MB
+# (лимит загрузки Bot API — 50 МБ; на коротких роликах ограничение обычно не срабатывает)
+VIDEO_RATE_MODE = os.getenv("VIDEO_RATE_MODE", "capped")
+VIDEO_TARGET_MB = float(os.getenv("VIDEO_TARGET_MB", 45))
+# Ниже этого битрейта (кбит/с) не опускаемся, даже если цель по размеру не достигается
+VIDEO_MIN_KBPS = int(os.getenv("VIDEO_MIN_KBPS", 300))
+# Битрейт AAC (кбит/с) копий
+AUDIO_BITRATE = int(os.getenv("AUDIO_BITRATE", 128))
+
+# Уровни H.264 (Annex A): (уровень, макроблоков/с, макроблоков в кадре)
+H264_LEVELS = (
+    ("3.0", 40500, 1620),
+    ("3.1", 108000, 3600),
+    ("3.2", 216000, 5120),
+    ("4.0", 245760, 8192),
+    ("4.2", 522240, 8704),
+    ("5.0", 589824, 22080),
+    ("5.1", 983040, 36864),
+    ("5.2", 2073600, 36864),
+)
+
+
+def get_default_tier() -> str:
+    return _default_tier
+
+
+def set_default_tier(tier: str):
+    """Глобальный уровень для пользователей без личной настройки."""
+    global _default_tier
+    if tier not in VIDEO_TIERS:
+        raise ValueError(f"Неизвестный уровень: {tier}")
+    _default_tier = tier
+
+
+# =========================
+#  Проба исходника
+# =========================
+
+def _parse_duration(text: str) -> float:
+    m = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", text)
+    if not m:
+        return 0.0
+    h, mnt, s = m.groups()
+    return int(h) * 3600 + int(mnt) * 60 + float(s)
+
+
+def _probe_with_ffprobe(ffprobe_exe: str, input_path: str) -> dict:
+    proc = subprocess.run(
+        [ffprobe_exe, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', input_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+        check=True
+    )
+    data = json.loads(proc.stdout)
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), {})
+    num, _, den = video.get("avg_frame_rate", "0/0").partition("/")
+    fps = float(num) / float(den) if den and float(den) else 0.0
+    return {
+        "duration": float(data.get("format", {}).get("duration") or 0),
+        "width": int(video.get("width") or 0),
+        "height": int(video.get("height") or 0),
+        "fps": fps,
+        "has_audio": any(s.get("codec_type") == "audio" for s in streams),
+    }
+
+
+def _probe_with_ffmpeg(ffmpeg_exe: str, input_path: str) -> dict:
+    """
+    Запасной вариант без ffprobe (imageio-ffmpeg его не поставляет):
+    `ffmpeg -i` читает только заголовки контейнера и печатает потоки в stderr.
+    """
+    proc = subprocess.run(
+        [ffmpeg_exe, '-hide_banner', '-i', input_path],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace"
+    )
+    text = proc.stderr
+    info = {"duration": _parse_duration(text), "width": 0, "height": 0, "fps": 0.0,
+            "has_audio": re.search(r"Stream #\d+:\d+.*: Audio:", text) is not None}
+
+    video = re.search(r"Stream #\d+:\d+.*: Video:(.*)", text)
+    if video:
+        line = video.group(1)
+        size = re.search(r"(\d{2,5})x(\d{2,5})", line)
+        if size:
+            info["width"], info["height"] = int(size.group(1)), int(size.group(2))
+        fps = re.search(r"([\d.]+) fps", line) or re.search(r"([\d.]+)k? tbr", line)
+        if fps:
+            info["fps"] = float(fps.group(1))
+    return info
+
+
+def probe_video(input_path: str) -> dict:
+    """
+    Длительность (сек), размер кадра, частота кадров и наличие аудио:
+    {"duration", "width", "height", "fps", "has_audio"}.
+    ffprobe, если он есть в PATH, иначе разбор `ffmpeg -i`.
+    """
+    ffprobe_exe = shutil.which("ffprobe")
+    if ffprobe_exe:
+        try:
+            return _probe_with_ffprobe(ffprobe_exe, input_path)
+        except (subprocess.CalledProcessError, ValueError):
+            pass
+    return _probe_with_ffmpeg(get_capabilities()["ffmpeg"], input_path)
+
+
+# =========================
+#  Выбор профиля
+# =========================
+
+def _even(value: float) -> int:
+    return max(2, int(round(value / 2)) * 2)
+
+
+def h264_level(width: int, height: int, fps: float) -> str:
+    """Минимальный уровень H.264, вмещающий кадр и частоту кадров."""
+    frame_mbs = ((width + 15) // 16) * ((height + 15) // 16)
+    mbps = frame_mbs * (fps or 30)
+    for level, max_mbps, max_fs in H264_LEVELS:
+        if frame_mbs <= max_fs and mbps <= max_mbps:
+            return level
+    return H264_LEVELS[-1][0]
+
+
+def pick_profile(info: dict, tier: str = None) -> dict:
+    """
+    Профиль кодирования для исходника: параметры уровня + итоговый размер кадра,
+    интервал ключевых кадров и уровень H.264.
+    Длинные ролики (LONG_VIDEO_SECONDS) сдвигаются на уровень быстрее.
+    """
+    tier = tier if tier in VIDEO_TIERS else get_default_tier()
+    if LONG_VIDEO_SECONDS and info.get("duration", 0) > LONG_VIDEO_SECONDS:
+        tier = TIER_ORDER[min(TIER_ORDER.index(tier) + 1, len(TIER_ORDER) - 1)]
+    settings = VIDEO_TIERS[tier]
+
+    width, height = info.get("width") or 0, info.get("height") or 0
+    scale = None
+    cap = settings["max_short_side"]
+    if cap and width and height and min(width, height) > cap:
+        k = cap / min(width, height)
+        width, height = _even(width * k), _even(height * k)
+        scale = (width, height)
+
+    fps = info.get("fps") or 30
+    return {
+        "tier": tier,
+        **settings,
+        "scale": scale,
+        "gop": max(1, int(round(fps * settings["gop_seconds"]))),
+        "level": h264_level(width, height, fps) if width and height else None,
+        "maxrate": target_maxrate(info),
+    }
+
+
+def target_maxrate(info: dict) -> int | None:
+    """
+    Пиковый битрейт видео (кбит/с) для VIDEO_RATE_MODE=capped: VIDEO_TARGET_MB на длительность
+    с запасом 5% на контейнер, минус аудио. reserve_audio — аудио кодируется отдельно
+    (сегментный режим), но в итоговом файле будет.
+    """
+    duration = info.get("duration") or 0
+    if VIDEO_RATE_MODE != "capped" or not VIDEO_TARGET_MB or not duration:
+        return None
+    total_kbps = 0.95 * VIDEO_TARGET_MB * 8 * 1024 * 1024 / 1000 / duration
+    if info.get("reserve_audio", info.get("has_audio")):
+        total_kbps -= AUDIO_BITRATE
+    return max(int(total_kbps), VIDEO_MIN_KBPS)
+
+
+def encoder_args(profile: dict, codec: str) -> list:
+    """Опции видеокодера для одного выхода ffmpeg."""
+    args = ['-c:v', codec, '-pix_fmt', 'yuv420p', '-g', str(profile["gop"])]
+    if codec == "libx264":
+        args += ['-preset', profile["preset"], '-crf', str(profile["crf"]), '-profile:v', 'high']
+    elif codec == "h264_nvenc":
+        args += ['-preset', profile["nvenc_preset"], '-rc', 'vbr', '-cq', str(profile["crf"]), '-profile:v', 'high']
+    if profile["level"] and codec in ("libx264", "h264_nvenc"):
+        args += ['-level', profile["level"]]
+    if profile.get("maxrate") and codec in ("libx264", "h264_nvenc"):
+        # CRF/CQ остаётся, VBV лишь срезает пики выше maxrate
+        args += ['-maxrate', f'{profile["maxrate"]}k', '-bufsize', f'{2 * profile["maxrate"]}k']
+    return args
+
+
+def audio_encoder_args() -> list:
+    """Опции аудиокодера для одного выхода ffmpeg."""
+    return ['-c:a', 'aac', '-b:a', f'{AUDIO_BITRATE}k']
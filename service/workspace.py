@@ -0,0 +1,186 @@
+import os
+import uuid
+import time
+import shutil
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+
+from metrics import WORKSPACE_BYTES
+
+load_dotenv()
+
+# Каталог рабочих папок задач на диске
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", os.path.join("temp", "jobs"))
+# Каталог в RAM (tmpfs), например /dev/shm/shinobi; пусто — всё на диске
+WORKSPACE_RAM_DIR = os.getenv("WORKSPACE_RAM_DIR", "")
+# Сколько из общего бюджета можно держать в RAM
+WORKSPACE_RAM_MB = int(os.getenv("WORKSPACE_RAM_MB", 1024))
+# Общий бюджет всех рабочих папок; новая задача ждёт, пока не освободится место
+WORKSPACE_MAX_MB = int(os.getenv("WORKSPACE_MAX_MB", 10240))
+# Как часто искать брошенные папки и через сколько секунд без изменений считать папку брошенной
+WORKSPACE_SWEEP_INTERVAL = float(os.getenv("WORKSPACE_SWEEP_INTERVAL", 300))
+WORKSPACE_ORPHAN_AGE = float(os.getenv("WORKSPACE_ORPHAN_AGE", 6 * 3600))
+
+MB = 1024 * 1024
+
+
+def estimate_video_bytes(input_size: int, copies: int) -> int:
+    """
+    Оценка места под видео-задачу: исходник, копии примерно его размера
+    и столько же на части при посегментном кодировании.
+    """
+    return (input_size or 0) * (1 + 2 * copies)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Workspace:
+    """Рабочая папка одной задачи: path(name) — путь к файлу внутри неё."""
+
+    def __init__(self, directory: str, medium: str, reserved: int):
+        self.directory = directory
+        self.medium = medium
+        self.reserved = reserved
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+
+class WorkspaceManager:
+    """
+    Отдельная папка на каждую задачу (имя <pid>_<вид>_<id>, чужие задачи не пересекаются):
+      - под задачу резервируется оценка её объёма; когда общий бюджет занят,
+        acquire ждёт освобождения места (back-pressure, а не переполнение диска);
+      - если задан ram_dir и резерв помещается в RAM-бюджет и свободное место tmpfs,
+        папка создаётся в RAM, иначе — на диске (большие видео уходят на диск);
+      - папка удаляется при выходе из блока with, в том числе при ошибке и отмене;
+      - sweeper удаляет брошенные папки: процесс-владелец мёртв (падение, рестарт),
+        либо папка старше orphan_age и не числится активной.
+    """
+
+    def __init__(self, disk_dir: str = WORKSPACE_DIR, ram_dir: str = WORKSPACE_RAM_DIR,
+                 max_bytes: int = WORKSPACE_MAX_MB * MB, ram_bytes: int = WORKSPACE_RAM_MB * MB,
+                 sweep_interval: float = WORKSPACE_SWEEP_INTERVAL, orphan_age: float = WORKSPACE_ORPHAN_AGE):
+        self.disk_dir = disk_dir
+        self.ram_dir = ram_dir
+        self.max_bytes = max_bytes
+        self.ram_bytes = ram_bytes if ram_dir else 0
+        self.sweep_interval = sweep_interval
+        self.orphan_age = orphan_age
+        self._used = {"ram": 0, "disk": 0}
+        self._active = set()
+        self._changed = asyncio.Condition()
+        self._sweeper = None
+
+    @property
+    def used_bytes(self) -> int:
+        return self._used["ram"] + self._used["disk"]
+
+    def _pick_medium(self, size: int) -> str:
+        if self.ram_bytes and self._used["ram"] + size <= self.ram_bytes:
+            try:
+                os.makedirs(self.ram_dir, exist_ok=True)
+                if shutil.disk_usage(self.ram_dir).free > size:
+                    return "ram"
+            except OSError:
+                logging.warning("RAM-каталог %s недоступен, работаем на диске", self.ram_dir)
+        return "disk"
+
+    @asynccontextmanager
+    async def acquire(self, kind: str, size: int = 0):
+        """Рабочая папка под задачу с резервом size байт (удаляется после блока with)."""
+        # Задача больше всего бюджета ждёт, пока не освободится весь бюджет
+        size = min(max(size, 0), self.max_bytes)
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.used_bytes + size <= self.max_bytes)
+            medium = self._pick_medium(size)
+            self._used[medium] += size
+        WORKSPACE_BYTES.inc(size, medium=medium)
+
+        base = self.ram_dir if medium == "ram" else self.disk_dir
+        directory = os.path.join(base, f"{os.getpid()}_{kind}_{uuid.uuid4().hex[:12]}")
+        self._active.add(directory)
+        try:
+            os.makedirs(directory)
+            yield Workspace(directory, medium, size)
+        finally:
+            self._active.discard(directory)
+            await asyncio.to_thread(shutil.rmtree, directory, True)
+            WORKSPACE_BYTES.dec(size, medium=medium)
+            async with self._changed:
+                self._used[medium] -= size
+                self._changed.notify_all()
+
+    # ---------- уборка брошенных папок ----------
+
+    def sweep(self) -> int:
+        """Удаляет брошенные рабочие папки; возвращает, сколько удалено."""
+        removed = 0
+        now = time.time()
+        for base in filter(None, (self.disk_dir, self.ram_dir)):
+            try:
+                names = os.listdir(base)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                path = os.path.join(base, name)
+                if path in self._active:
+                    continue
+                pid = name.split("_", 1)[0]
+                try:
+                    age = now - os.stat(path).st_mtime
+                except FileNotFoundError:
+                    continue
+                # Своя неактивная папка, папка мёртвого процесса или просто очень старая
+                orphan = (
+                    not pid.isdigit()
+                    or int(pid) == os.getpid()
+                    or not _pid_alive(int(pid))
+                    or age > self.orphan_age
+                )
+                if not orphan:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        continue
+                removed += 1
+        if removed:
+            logging.info("Удалено брошенных рабочих папок: %d", removed)
+        return removed
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception:
+                logging.exception("Ошибка при уборке рабочих папок")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def start_sweeper(self):
+        """Уборка сразу при старте (остатки прошлого запуска) и затем периодически."""
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
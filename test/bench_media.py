@@ -0,0 +1,299 @@
+"""
+Бенчмарк сервисов обработки фото и видео (офлайн: без токена бота и без БД).
+
+Генерирует синтетические исходники нужных размеров, замеряет отдельные
+стадии пайплайна и целые задачи при разном числе копий и параллелизме,
+пишет результаты в JSON, чтобы сравнивать прогоны между собой.
+
+Запуск из корня проекта:
+    PYTHONPATH=. python test/bench_media.py                  # быстрый набор
+    PYTHONPATH=. python test/bench_media.py --full           # полная матрица
+    PYTHONPATH=. python test/bench_media.py --only photo --output before.json
+
+Каждый сценарий выполняется в отдельном процессе, поэтому пиковый RSS
+и CPU-секунды (вместе с дочерними ffmpeg и воркерами пула) относятся
+именно к нему.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+# Размеры фото: Мп -> (ширина, высота) 4:3
+PHOTO_SIZES = {1: (1152, 864), 12: (4000, 3000), 48: (8000, 6000)}
+VIDEO_SIZES = {"720p": (1280, 720), "1080p": (1920, 1080)}
+
+QUICK = {
+    "photo_mp": [1, 12],
+    "photo_copies": [1, 5],
+    "video": [("720p", 10)],
+    "video_copies": [1, 3],
+}
+FULL = {
+    "photo_mp": [1, 12, 48],
+    "photo_copies": [1, 5, 20],
+    "video": [("720p", 10), ("720p", 60), ("1080p", 10), ("1080p", 120)],
+    "video_copies": [1, 5, 20],
+}
+
+
+# =========================
+#  Синтетические исходники
+# =========================
+
+def make_photo(path: str, mp: int):
+    """Градиент + шум: похоже на фото по сжимаемости JPEG, в отличие от чистого шума."""
+    if os.path.exists(path):
+        return
+    width, height = PHOTO_SIZES[mp]
+    rng = np.random.default_rng(mp)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1)
+    noise = rng.normal(0, 12, (height, width, 3)).astype(np.float32)
+    pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+    Image.fromarray(pixels, "RGB").save(path, format="JPEG", quality=92)
+
+
+def make_video(path: str, resolution: str, duration: int):
+    """Тестовая картинка testsrc2 + синус в аудио, H.264/AAC."""
+    if os.path.exists(path):
+        return
+    from service.ffmpeg_caps import get_capabilities
+
+    width, height = VIDEO_SIZES[resolution]
+    subprocess.run([
+        get_capabilities()["ffmpeg"], '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate=30:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-shortest', path
+    ], check=True)
+
+
+# =========================
+#  Сценарии (выполняются в дочернем процессе)
+# =========================
+
+def _timed(func, *args, repeat: int = 1):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def scenario_photo_stages(input_path: str, repeat: int = 3) -> dict:
+    """Время каждой стадии фото-пайплайна на одной копии (лучшее из repeat)."""
+    from service import unique_photo as up
+
+    stages = {}
+    stages["decode"], base = _timed(up.load_base_image, input_path, repeat=repeat)
+    stages["geometry"], transformed = _timed(up.random_geometry, base, repeat=repeat)
+    stages["color"], colored = _timed(up.strong_color_corrections, transformed, repeat=repeat)
+    stages["noise"], noisy = _timed(up.add_transparent_noise, colored, repeat=repeat)
+    stages["encode"], data = _timed(up.encode_photo, noisy, repeat=repeat)
+    return {"stages_s": stages, "output_bytes": len(data)}
+
+
+def scenario_photo_job(input_path: str, copies: int, workers: int) -> dict:
+    """Целая задача: copies копий через пул процессов, как в боте."""
+    from service.unique_photo import make_photo_copy
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # Прогрев процессов не входит в замер
+        list(pool.map(abs, range(workers)))
+        start = time.perf_counter()
+        outputs = list(pool.map(make_photo_copy, ["bench"] * copies, [input_path] * copies))
+        elapsed = time.perf_counter() - start
+    return {
+        "wall_s": elapsed,
+        "copies_per_s": copies / elapsed,
+        "output_bytes": sum(len(o) for o in outputs),
+    }
+
+
+def scenario_video_decode(input_path: str) -> dict:
+    """Стоимость одного только декодирования исходника (ffmpeg -> null)."""
+    from service.ffmpeg_caps import get_capabilities
+
+    start = time.perf_counter()
+    subprocess.run([
+        get_capabilities()["ffmpeg"], '-v', 'error', '-i', input_path, '-f', 'null', '-'
+    ], check=True)
+    return {"wall_s": time.perf_counter() - start}
+
+
+def scenario_video_job(input_path: str, copies: int, workers: int, workdir: str) -> dict:
+    """
+    Целая задача: copies копий, разбитых на `workers` параллельных пакетов
+    (каждый пакет — один запуск ffmpeg, как единица планировщика в боте).
+    """
+    from service.unique_video import make_unique_videos
+
+    outputs = [os.path.join(workdir, f"out_{os.getpid()}_{i}.mp4") for i in range(copies)]
+    batches = [outputs[i::workers] for i in range(workers) if outputs[i::workers]]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(batches)) as pool:
+        list(pool.map(lambda b: make_unique_videos(input_path, b), batches))
+    elapsed = time.perf_counter() - start
+
+    total = sum(os.path.getsize(p) for p in outputs)
+    for p in outputs:
+        os.remove(p)
+    return {"wall_s": elapsed, "copies_per_s": copies / elapsed, "output_bytes": total}
+
+
+SCENARIOS = {
+    "photo_stages": scenario_photo_stages,
+    "photo_job": scenario_photo_job,
+    "video_decode": scenario_video_decode,
+    "video_job": scenario_video_job,
+}
+
+
+def _peak_rss_mb() -> float:
+    """
+    Пиковый RSS этого процесса. ru_maxrss в Linux переживает exec и достаётся
+    от родителя, поэтому берём VmHWM из /proc (сбрасывается при exec).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_one(spec: dict) -> dict:
+    """Выполняет сценарий и добавляет ресурсы процесса (вместе с дочерними)."""
+    # Логи сервисов (print) не должны попасть в stdout с JSON
+    real_stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        result = SCENARIOS[spec["scenario"]](**spec["args"])
+    finally:
+        sys.stdout = real_stdout
+
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result["cpu_s"] = me.ru_utime + me.ru_stime + kids.ru_utime + kids.ru_stime
+    result["peak_rss_mb"] = _peak_rss_mb()
+    # ru_maxrss в Linux — КиБ; у детей — максимум по одному (самому большому) процессу
+    result["peak_child_rss_mb"] = kids.ru_maxrss / 1024
+    return result
+
+
+def run_isolated(spec: dict) -> dict:
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-one", json.dumps(spec)],
+        stdout=subprocess.PIPE,
+        text=True,
+        env={**os.environ, "PYTHONPATH": os.getcwd() + os.pathsep + os.environ.get("PYTHONPATH", "")}
+    )
+    if proc.returncode != 0:
+        return {"error": f"exit code {proc.returncode}"}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+# =========================
+#  Матрица прогона
+# =========================
+
+def build_plan(matrix: dict, workdir: str, only: str, concurrency: list) -> list:
+    plan = []
+    if only in (None, "photo"):
+        for mp in matrix["photo_mp"]:
+            path = os.path.join(workdir, f"photo_{mp}mp.jpg")
+            make_photo(path, mp)
+            plan.append({"scenario": "photo_stages", "input": f"{mp}MP", "args": {"input_path": path}})
+            for copies in matrix["photo_copies"]:
+                for workers in concurrency:
+                    plan.append({
+                        "scenario": "photo_job", "input": f"{mp}MP",
+                        "args": {"input_path": path, "copies": copies, "workers": workers}
+                    })
+    if only in (None, "video"):
+        for resolution, duration in matrix["video"]:
+            path = os.path.join(workdir, f"video_{resolution}_{duration}s.mp4")
+            make_video(path, resolution, duration)
+            name = f"{resolution}/{duration}s"
+            plan.append({"scenario": "video_decode", "input": name, "args": {"input_path": path}})
+            for copies in matrix["video_copies"]:
+                for workers in concurrency:
+                    plan.append({
+                        "scenario": "video_job", "input": name,
+                        "args": {"input_path": path, "copies": copies, "workers": workers, "workdir": workdir}
+                    })
+    return plan
+
+
+def environment() -> dict:
+    from service.ffmpeg_caps import get_capabilities
+
+    caps = get_capabilities()
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "pillow": Image.__version__,
+        "numpy": np.__version__,
+        "ffmpeg": caps["version"],
+        "video_codec": caps["video_codec"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк фото/видео сервисов")
+    parser.add_argument("--full", action="store_true", help="Полная матрица (долго)")
+    parser.add_argument("--only", choices=("photo", "video"), help="Только фото или только видео")
+    parser.add_argument("--concurrency", default=None,
+                        help="Список параллелизма через запятую (по умолчанию 1 и число ядер)")
+    parser.add_argument("--workdir", default=os.path.join("temp", "bench"),
+                        help="Куда складывать синтетические исходники (переиспользуются)")
+    parser.add_argument("--output", default="bench_results.json", help="JSON с результатами")
+    parser.add_argument("--run-one", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+        return
+
+    if args.concurrency:
+        concurrency = [int(v) for v in args.concurrency.split(",")]
+    else:
+        concurrency = sorted({1, os.cpu_count() or 1})
+
+    os.makedirs(args.workdir, exist_ok=True)
+
+    plan = build_plan(FULL if args.full else QUICK, args.workdir, args.only, concurrency)
+    results = []
+    for spec in plan:
+        result = run_isolated(spec)
+        row = {"scenario": spec["scenario"], "input": spec["input"],
+               **{k: v for k, v in spec["args"].items() if k not in ("input_path", "workdir")},
+               **result}
+        results.append(row)
+        print(json.dumps(row, ensure_ascii=False))
+
+    with open(args.output, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "env": environment(), "results": results},
+                  f, ensure_ascii=False, indent=2)
+    print("Результаты записаны в", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Проверка цветокоррекции одной матрицей (service/unique_photo.py, apply_color_corrections)
+против прежней цепочки ImageEnhance.Color -> Brightness -> Contrast.
+
+Промежуточные обрезания до 0..255 (пересветы после насыщенности и яркости)
+воспроизводятся LUT-границами, поэтому остаётся только округление: цепочка
+отбрасывает дробную часть после каждого шага, матрица округляет один раз
+(цепочка в среднем темнее на 1-2 уровня). Проверяем границы разницы на фото
+и на синтетике с насыщенными цветами и пересветами, и печатаем ускорение.
+
+Запуск из корня проекта:
+    PYTHONPATH=. python test/color_check.py
+"""
+import os
+import time
+import random
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+from service.unique_photo import apply_color_corrections, load_base_image
+
+SAMPLE = os.path.join(os.path.dirname(__file__), "images.jpg")
+
+# Допуски в уровнях 0..255
+MAX_MEAN_DIFF = 2.0
+MAX_P99_DIFF = 3.0
+MAX_DIFF = 4
+
+
+def enhance_chain(img: Image.Image, saturation: float, brightness: float, contrast: float) -> Image.Image:
+    """Прежняя реализация strong_color_corrections с заданными коэффициентами."""
+    img = ImageEnhance.Color(img).enhance(saturation)
+    img = ImageEnhance.Brightness(img).enhance(brightness)
+    return ImageEnhance.Contrast(img).enhance(contrast)
+
+
+def synthetic_image(width: int = 640, height: int = 480) -> Image.Image:
+    """Градиенты по всем каналам: насыщенные цвета, тени и пересветы."""
+    x = np.linspace(0, 255, width)
+    y = np.linspace(0, 255, height)[:, None]
+    arr = np.stack([
+        np.broadcast_to(x, (height, width)),
+        np.broadcast_to(y, (height, width)),
+        255 - (x + y) / 2,
+    ], axis=-1)
+    return Image.fromarray(arr.astype(np.uint8), "RGB")
+
+
+def diff_stats(a: Image.Image, b: Image.Image) -> tuple:
+    diff = np.abs(np.asarray(a, np.int16) - np.asarray(b, np.int16))
+    return float(diff.mean()), float(np.percentile(diff, 99)), int(diff.max())
+
+
+def check_close(name: str, img: Image.Image, trials: int = 20):
+    rng = random.Random(0)
+    worst = (0.0, 0.0, 0)
+    # Крайние значения диапазонов strong_color_corrections и случайные внутри
+    factors = [(0.8, 0.85, 0.8), (1.2, 1.15, 1.3), (0.8, 1.15, 1.3), (1.2, 0.85, 0.8)]
+    factors += [(rng.uniform(0.8, 1.2), rng.uniform(0.85, 1.15), rng.uniform(0.8, 1.3)) for _ in range(trials)]
+
+    for f in factors:
+        mean, p99, peak = diff_stats(enhance_chain(img, *f), apply_color_corrections(img, *f))
+        assert mean <= MAX_MEAN_DIFF and p99 <= MAX_P99_DIFF and peak <= MAX_DIFF, \
+            f"{name} {f}: среднее {mean:.2f}, p99 {p99:.1f} (макс {peak})"
+        worst = max(worst[0], mean), max(worst[1], p99), max(worst[2], peak)
+
+    identity = diff_stats(img, apply_color_corrections(img, 1.0, 1.0, 1.0))
+    assert identity[2] == 0, "единичные коэффициенты не должны менять картинку"
+    print(f"{name}: худшее среднее {worst[0]:.2f}, p99 {worst[1]:.0f}, макс {worst[2]} — ok")
+
+
+def compare_speed(img: Image.Image, repeat: int = 10):
+    f = (1.1, 1.1, 1.2)
+    timings = {}
+    for name, func in (("chain", enhance_chain), ("matrix", apply_color_corrections)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func(img, *f)
+        timings[name] = (time.perf_counter() - start) / repeat
+    print(f"{img.size[0]}x{img.size[1]}: цепочка {1000 * timings['chain']:.1f} мс, "
+          f"матрица {1000 * timings['matrix']:.1f} мс (x{timings['chain'] / timings['matrix']:.1f})")
+
+
+if __name__ == "__main__":
+    photo = load_base_image(SAMPLE, max_side=0)
+    check_close("фото", photo)
+    check_close("синтетика", synthetic_image())
+    compare_speed(photo.resize((2400, 1800)))
@@ -0,0 +1,97 @@
+"""
+Проверка хранилища FSM в MongoDB (db/fsm_storage.py) без Telegram.
+
+MongoDB подменяется mongomock-motor (pip install -r requirements-dev.txt).
+Проверяется, что чтение во время отложенной записи (bulk_write ещё не
+завершён) видит новое состояние, а не старый документ из БД, и что при
+ошибке записи изменения остаются в очереди.
+
+Запуск из корня проекта:
+    PYTHONPATH=. python test/fsm_storage_check.py
+"""
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+from mongomock_motor import AsyncMongoMockClient
+
+from db.fsm_storage import MongoFSMStorage
+
+
+class SlowCollection:
+    """Коллекция, у которой bulk_write ждёт команды теста (или падает)."""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+        self.fail = False
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    async def bulk_write(self, ops, ordered=True):
+        self.started.set()
+        await self.release.wait()
+        if self.fail:
+            raise ConnectionError("mongod недоступен")
+        return await self._collection.bulk_write(ops, ordered=ordered)
+
+
+async def check_read_during_flush():
+    database = AsyncMongoMockClient()["shinobi_fsm_check"]
+    storage = MongoFSMStorage(database, cache_ttl=0, flush_interval=3600)
+    slow = SlowCollection(storage._collection)
+    storage._collection = slow
+    key = StorageKey(bot_id=1, chat_id=10, user_id=10)
+
+    # В БД — старое состояние
+    await database["fsm"].insert_one({"_id": storage._key(key), "state": "old", "data": {}})
+    await storage.set_state(key, "new")
+
+    # Запись началась, но не завершилась: чтение не должно вернуть "old" из БД
+    flush = asyncio.ensure_future(storage.flush())
+    await slow.started.wait()
+    assert await storage.get_state(key) == "new", "во время flush читается незаписанное состояние"
+
+    slow.release.set()
+    await flush
+    assert (await database["fsm"].find_one({"_id": storage._key(key)}))["state"] == "new"
+    assert await storage.get_state(key) == "new"
+    print("fsm: чтение во время bulk_write видит новое состояние — ok")
+
+
+async def check_failed_flush():
+    database = AsyncMongoMockClient()["shinobi_fsm_check"]
+    storage = MongoFSMStorage(database, cache_ttl=0, flush_interval=3600)
+    slow = SlowCollection(storage._collection)
+    storage._collection = slow
+    key = StorageKey(bot_id=1, chat_id=20, user_id=20)
+
+    await storage.set_state(key, "pending")
+    slow.fail = True
+    flush = asyncio.ensure_future(storage.flush())
+    await slow.started.wait()
+    slow.release.set()
+    try:
+        await flush
+    except ConnectionError:
+        pass
+    else:
+        raise AssertionError("ошибка bulk_write должна дойти до вызывающего")
+
+    # Изменение не потеряно: читается из кэша и уходит в БД следующим flush
+    assert await storage.get_state(key) == "pending"
+    slow.fail = False
+    await storage.flush()
+    assert (await database["fsm"].find_one({"_id": storage._key(key)}))["state"] == "pending"
+    await storage.close()
+    print("fsm: после ошибки записи изменения остаются в очереди — ok")
+
+
+async def main():
+    await check_read_during_flush()
+    await check_failed_flush()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
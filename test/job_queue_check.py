@@ -0,0 +1,184 @@
+"""
+Проверка очереди задач (db/jobs.py) и воркера (worker.py) без Telegram.
+
+По умолчанию MongoDB подменяется mongomock-motor (pip install -r requirements-dev.txt),
+файлы задач хранятся в памяти. С --mongo используется настоящий mongod
+из MONGO_URI (и GridFS), база shinobi_jobs_check удаляется после прогона.
+
+Запуск из корня проекта:
+    PYTHONPATH=. python test/job_queue_check.py
+    PYTHONPATH=. python test/job_queue_check.py --mongo
+"""
+import io
+import asyncio
+import argparse
+
+from bson import ObjectId
+from PIL import Image
+
+import worker
+from db.jobs import JobQueue, QUEUED, RUNNING, DONE, FAILED, CANCELLED
+
+
+class MemoryFileStore:
+    """Хранилище файлов задач в памяти (вместо GridFS)."""
+
+    def __init__(self):
+        self.files = {}
+
+    async def put(self, data: bytes, filename: str):
+        file_id = ObjectId()
+        self.files[file_id] = data
+        return file_id
+
+    async def get(self, file_id) -> bytes:
+        return self.files[file_id]
+
+    async def delete(self, file_id):
+        self.files.pop(file_id, None)
+
+
+def make_queue(use_mongo: bool, **kwargs):
+    if use_mongo:
+        from db.db import client
+        database = client["shinobi_jobs_check"]
+        return JobQueue(database, **kwargs), database
+    from mongomock_motor import AsyncMongoMockClient
+    database = AsyncMongoMockClient()["shinobi_jobs_check"]
+    return JobQueue(database, files=MemoryFileStore(), **kwargs), database
+
+
+def jpeg_bytes() -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (320, 240), (120, 80, 40)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+async def check_claim_order(queue: JobQueue):
+    low = await queue.enqueue(1, "photo", {"copies": 1})
+    high = await queue.enqueue(2, "photo", {"copies": 1}, priority=True)
+    video = await queue.enqueue(3, "video", {"copies": 1})
+
+    # Два воркера одновременно: одна задача не достаётся обоим
+    first, second = await asyncio.gather(queue.claim("w1", ["photo"]), queue.claim("w2", ["photo"]))
+    assert {first["_id"], second["_id"]} == {low, high}, "каждая задача взята ровно одним воркером"
+    assert (await queue.claim("w3", ["photo"])) is None
+    assert (await queue.claim("w3", ["video"]))["_id"] == video
+
+    job = await queue.get(high)
+    assert job["status"] == RUNNING and job["attempts"] == 1
+    print("claim: приоритет, атомарность, фильтр по виду — ok")
+
+
+async def check_user_fairness(queue: JobQueue):
+    first = await queue.enqueue(1, "photo", {"copies": 1})
+    await queue.enqueue(1, "photo", {"copies": 1})
+    other = await queue.enqueue(2, "photo", {"copies": 1})
+
+    # У пользователя 1 уже задача в работе — свободный слот достаётся пользователю 2
+    assert (await queue.claim("w1", ["photo"]))["_id"] == first
+    assert (await queue.claim("w2", ["photo"]))["_id"] == other
+    assert (await queue.claim("w3", ["photo"])) is None, "вторая задача ждёт, пока идёт первая"
+    assert await queue.complete(first, "w1")
+    assert (await queue.claim("w3", ["photo"])) is not None
+    print("claim: не больше user_max_running задач одного пользователя в работе — ok")
+
+
+async def check_lease(queue: JobQueue):
+    job_id = await queue.enqueue(1, "photo", {"copies": 2})
+    job = await queue.claim("w1", ["photo"])
+    assert await queue.heartbeat(job_id, "w1", 0.5)
+    assert await queue.add_result(job_id, "w1", "file-1")
+
+    # Аренда истекла: задачу забирает другой воркер, старый теряет права
+    await asyncio.sleep(queue.lease_seconds + 0.1)
+    again = await queue.claim("w2", ["photo"])
+    assert again["_id"] == job_id and again["attempts"] == 2
+    assert again["results"] == ["file-1"], "готовые копии сохраняются между попытками"
+    assert not await queue.heartbeat(job_id, "w1")
+    assert not await queue.add_result(job_id, "w1", "file-2")
+    assert await queue.complete(job_id, "w2")
+    assert (await queue.get(job["_id"]))["status"] == DONE
+
+    # Попытки исчерпаны: брошенная задача помечается упавшей
+    exhausted = await queue.enqueue(1, "photo", {"copies": 1})
+    for n in range(queue.max_attempts):
+        assert (await queue.claim(f"w{n}", ["photo"]))["_id"] == exhausted
+        await asyncio.sleep(queue.lease_seconds + 0.1)
+    assert (await queue.claim("late", ["photo"])) is None
+    assert await queue.fail_exhausted() == 1
+    assert (await queue.get(exhausted))["status"] == FAILED
+    print("lease: heartbeat, повтор после истечения аренды, исчерпание попыток — ok")
+
+
+async def check_cancel_and_fail(queue: JobQueue):
+    job_id = await queue.enqueue(7, "video", {"copies": 1})
+    assert not await queue.cancel(job_id, user_id=8), "чужую задачу отменить нельзя"
+    await queue.claim("w1", ["video"])
+    assert await queue.cancel(job_id, user_id=7)
+    assert not await queue.heartbeat(job_id, "w1"), "воркер узнаёт об отмене по heartbeat"
+    assert (await queue.get(job_id))["status"] == CANCELLED
+
+    retry_id = await queue.enqueue(1, "video", {"copies": 1})
+    await queue.claim("w1", ["video"])
+    assert await queue.fail(retry_id, "w1", "временная ошибка", retry=True)
+    assert (await queue.get(retry_id))["status"] == QUEUED
+    await queue.claim("w1", ["video"])
+    assert await queue.fail(retry_id, "w1", "ошибка")
+    assert (await queue.get(retry_id))["status"] == FAILED
+    print("cancel/fail — ok")
+
+
+async def check_worker(queue: JobQueue):
+    """Воркер целиком: фото-задача из 3 копий через пул процессов."""
+    source_id = await queue.files.put(jpeg_bytes(), "source.jpg")
+    job_id = await queue.enqueue(1, "photo", {"copies": 3, "key": "check", "source_id": source_id})
+    job = await queue.claim("worker-check", ["photo"])
+    await worker.process_job(queue, job, "worker-check")
+
+    job = await queue.get(job_id)
+    assert job["status"] == DONE and len(job["results"]) == 3
+    for file_id in job["results"]:
+        Image.open(io.BytesIO(await queue.files.get(file_id))).verify()
+
+    await queue.delete(job)
+    assert await queue.get(job_id) is None
+    print("worker: 3 копии фото в хранилище, задача удалена вместе с файлами — ok")
+
+    # Ошибка обработки: тип исключения сохраняется в задаче, бот отвечает по нему
+    source_id = await queue.files.put(b"not an image", "source.jpg")
+    job_id = await queue.enqueue(1, "photo", {"copies": 1, "key": "broken", "source_id": source_id})
+    job = await queue.claim("worker-check", ["photo"])
+    await worker.process_job(queue, job, "worker-check")
+    job = await queue.get(job_id)
+    assert job["status"] == FAILED and job["error_type"] == "UnidentifiedImageError", job
+    print("worker: упавшая задача хранит error_type — ok")
+
+
+async def main(use_mongo: bool):
+    # Короткая аренда, чтобы проверить её истечение за доли секунды
+    queue, database = make_queue(use_mongo, lease_seconds=0.3, max_attempts=2)
+    await queue.init()
+    try:
+        await check_claim_order(queue)
+        await database["jobs"].delete_many({})
+        await check_user_fairness(queue)
+        await database["jobs"].delete_many({})
+        await check_lease(queue)
+        await database["jobs"].delete_many({})
+        await check_cancel_and_fail(queue)
+        await database["jobs"].delete_many({})
+
+        # Воркеру нужна аренда длиннее обработки
+        queue.lease_seconds = 30
+        await check_worker(queue)
+    finally:
+        worker.shutdown_executors()
+        if use_mongo:
+            await database.client.drop_database(database.name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка очереди задач и воркера")
+    parser.add_argument("--mongo", action="store_true", help="Настоящий mongod из MONGO_URI вместо mongomock")
+    asyncio.run(main(parser.parse_args().mongo))
@@ -0,0 +1,45 @@
+"""
+Проверка размера основы фото (service/unique_photo.py, load_base_image):
+исходник не больше PHOTO_MAX_SIDE сохраняет разрешение, больший уменьшается
+до PHOTO_MAX_SIDE, а выше PHOTO_MAX_PIXELS — отказ PhotoTooLarge.
+
+Запуск из корня проекта:
+    PYTHONPATH=. python test/photo_size_check.py
+"""
+import io
+
+from PIL import Image
+
+from service import unique_photo
+from service.unique_photo import load_base_image, PhotoTooLarge
+
+
+def jpeg_bytes(width: int, height: int) -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (width, height), (90, 140, 200)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+def main():
+    base = load_base_image(jpeg_bytes(2560, 1440), max_side=2560)
+    assert base.size == (2560, 1440), f"2560 px уменьшен до {base.size}"
+    print("фото 2560x1440 при PHOTO_MAX_SIDE=2560: разрешение сохранено — ok")
+
+    base = load_base_image(jpeg_bytes(5120, 2880), max_side=2560)
+    assert base.size == (2560, 1440), base.size
+    print("фото 5120x2880: уменьшено до 2560x1440 — ok")
+
+    ceiling = unique_photo.PHOTO_MAX_PIXELS
+    unique_photo.PHOTO_MAX_PIXELS = 1_000_000
+    try:
+        load_base_image(jpeg_bytes(2000, 1000), max_side=2560)
+    except PhotoTooLarge:
+        print("фото больше PHOTO_MAX_PIXELS: PhotoTooLarge — ok")
+    else:
+        raise AssertionError("ожидался PhotoTooLarge")
+    finally:
+        unique_photo.PHOTO_MAX_PIXELS = ceiling
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Стенд для режима вебхука (webhook.py): шлёт синтетические апдейты на эндпоинт.
+
+Без аргументов поднимает локальный сервер через build_webhook_app с тестовым
+диспетчером (хендлер только ждёт handler_delay и считает апдейты) и проверяет:
+  - запрос с неверным секретом получает 401;
+  - одновременно обрабатывается не больше --max-concurrency апдейтов;
+  - при остановке сервера незавершённые апдейты дорабатываются;
+и печатает задержки ответов и пропускную способность.
+
+С --url апдейты идут на уже запущенного бота (BOT_MODE=webhook), например:
+    PYTHONPATH=. python test/webhook_harness.py --url http://127.0.0.1:8080/webhook --secret S --text /start
+Бот попытается ответить несуществующим чатам — ошибки Telegram API в его логе ожидаемы.
+
+Запуск из корня проекта:
+    PYTHONPATH=. python test/webhook_harness.py
+"""
+import time
+import asyncio
+import argparse
+import statistics
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+
+from webhook import build_webhook_app, WEBHOOK_PATH
+
+FAKE_TOKEN = "123456:" + "A" * 35
+
+
+def make_update(n: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": n,
+        "message": {
+            "message_id": n,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "text": text,
+        },
+    }
+
+
+async def post_updates(url: str, secret: str, count: int, concurrency: int, text: str, users: int) -> dict:
+    """Шлёт count апдейтов не более чем concurrency запросами одновременно."""
+    latencies = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+
+    async with aiohttp.ClientSession() as session:
+        async def one(n: int):
+            async with semaphore:
+                start = time.perf_counter()
+                async with session.post(url, json=make_update(n, 1000 + n % users, text), headers=headers) as resp:
+                    await resp.read()
+                    statuses[resp.status] = statuses.get(resp.status, 0) + 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(n) for n in range(1, count + 1)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "statuses": statuses,
+        "wall_s": round(elapsed, 3),
+        "updates_per_s": round(count / elapsed, 1),
+        "p50_ms": round(1000 * statistics.median(latencies), 1),
+        "p95_ms": round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 1),
+    }
+
+
+async def check_secret(url: str):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=make_update(0, 1, "x"),
+                                headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as resp:
+            assert resp.status == 401, f"неверный секрет должен давать 401, а не {resp.status}"
+    print("секрет: неверный токен отклонён (401) — ok")
+
+
+async def run_local(args):
+    stats = {"handled": 0, "active": 0, "max_active": 0}
+    dp = Dispatcher()
+
+    @dp.message()
+    async def slow_handler(message: Message):
+        stats["active"] += 1
+        stats["max_active"] = max(stats["max_active"], stats["active"])
+        try:
+            await asyncio.sleep(args.handler_delay)
+        finally:
+            stats["active"] -= 1
+            stats["handled"] += 1
+
+    bot = Bot(FAKE_TOKEN)
+    app = build_webhook_app(dp, bot, secret_token=args.secret, max_concurrency=args.max_concurrency,
+                            shutdown_timeout=args.handler_delay * 10 + 5)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}{WEBHOOK_PATH}"
+
+    try:
+        await check_secret(url)
+        result = await post_updates(url, args.secret, args.count, args.concurrency, args.text, args.users)
+        print("нагрузка:", result)
+        assert stats["max_active"] <= args.max_concurrency, stats
+        print(f"параллелизм: максимум {stats['max_active']} из {args.max_concurrency} — ok")
+
+        # Последняя пачка без ожидания: остановка сервера должна дождаться её обработки
+        await post_updates(url, args.secret, args.max_concurrency, args.max_concurrency, args.text, args.users)
+    finally:
+        await runner.cleanup()
+
+    expected = args.count + args.max_concurrency
+    assert stats["handled"] == expected, f"обработано {stats['handled']} из {expected}"
+    print(f"остановка: все {expected} апдейтов обработаны до закрытия — ok")
+
+
+async def run_remote(args):
+    if args.secret:
+        await check_secret(args.url)
+    print("нагрузка:", await post_updates(args.url, args.secret, args.count, args.concurrency, args.text, args.users))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические апдейты для режима вебхука")
+    parser.add_argument("--url", help="Эндпоинт запущенного бота (по умолчанию — локальный тестовый сервер)")
+    parser.add_argument("--secret", default="harness-secret", help="X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--count", type=int, default=500, help="Сколько апдейтов отправить")
+    parser.add_argument("--concurrency", type=int, default=40, help="Одновременных запросов (как max_connections)")
+    parser.add_argument("--users", type=int, default=50, help="Сколько разных отправителей")
+    parser.add_argument("--text", default="hello", help="Текст сообщений")
+    parser.add_argument("--max-concurrency", type=int, default=10, help="Лимит обработчика (локальный режим)")
+    parser.add_argument("--handler-delay", type=float, default=0.05, help="Длительность тестового хендлера, с")
+    args = parser.parse_args()
+
+    asyncio.run(run_remote(args) if args.url else run_local(args))
+
+
+if __name__ == "__main__":
+    main()
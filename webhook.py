@@ -0,0 +1,126 @@
+# webhook.py
+# Режим вебхука: встроенный aiohttp-сервер вместо long polling.
+import os
+import signal
+import asyncio
+import logging
+from typing import Any, Dict
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "polling" (по умолчанию) или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес, который сообщаем Telegram (https://bot.example.com), и путь обработчика
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Где слушает встроенный сервер (за reverse proxy / балансировщиком)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+# Секрет из заголовка X-Telegram-Bot-Api-Secret-Token (A-Z, a-z, 0-9, _ и -), обязателен:
+# без него апдейты мог бы присылать кто угодно. Один и тот же на всех репликах
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Сколько соединений одновременно открывает Telegram (1..100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+# Сколько апдейтов обрабатывается одновременно; сверх этого запрос ждёт свободного места
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", 100))
+# Сколько ждать незавершённые апдейты при остановке, прежде чем отменить их
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.getenv("WEBHOOK_SHUTDOWN_TIMEOUT", 30))
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука с ограниченным параллелизмом:
+      - Telegram получает ответ сразу, апдейт обрабатывается в фоне;
+      - в работе не больше max_concurrency апдейтов; когда мест нет, ответ
+        задерживается — Telegram сам притормаживает доставку (back-pressure);
+      - при остановке ждём незавершённые апдейты (shutdown_timeout), затем отменяем.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str = None,
+                 max_concurrency: int = WEBHOOK_MAX_CONCURRENCY,
+                 shutdown_timeout: float = WEBHOOK_SHUTDOWN_TIMEOUT, **data: Any):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token or None, **data)
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._shutdown_timeout = shutdown_timeout
+        self._closing = False
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        if self._closing:
+            # Telegram повторит доставку (другой реплике или после перезапуска)
+            return web.Response(status=503)
+        update: Dict[str, Any] = await request.json(loads=bot.session.json_loads)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        """Новые апдейты не принимаем, текущие дорабатываем, затем закрываем сессию бота."""
+        self._closing = True
+        tasks = set(self._background_feed_update_tasks)
+        if tasks:
+            logging.info("Вебхук: ждём %d незавершённых апдейтов", len(tasks))
+            _, pending = await asyncio.wait(tasks, timeout=self._shutdown_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        await super().close()
+
+
+def build_webhook_app(dp: Dispatcher, bot: Bot, secret_token: str = WEBHOOK_SECRET, **kwargs) -> web.Application:
+    """aiohttp-приложение с маршрутом WEBHOOK_PATH; startup/shutdown диспетчера привязаны к приложению."""
+    app = web.Application()
+    BoundedRequestHandler(dp, bot, secret_token=secret_token, **kwargs).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """
+    Регистрирует вебхук у Telegram и обслуживает его до SIGINT/SIGTERM.
+    Несколько реплик за балансировщиком регистрируют один и тот же WEBHOOK_URL.
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_URL")
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_SECRET")
+
+    async def register_webhook():
+        await bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+            # Как skip_updates у polling: старые апдейты не обрабатываем
+            drop_pending_updates=True
+        )
+
+    dp.startup.register(register_webhook)
+    app = build_webhook_app(dp, bot)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info("Вебхук слушает %s:%d%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: остаётся KeyboardInterrupt
+            pass
+    try:
+        await stop.wait()
+    finally:
+        # on_shutdown: дорабатываем апдейты, dp.shutdown (пулы, метрики), закрываем сессию
+        await runner.cleanup()
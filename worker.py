@@ -0,0 +1,188 @@
+"""
+Воркер обработки: разбирает очередь задач из MongoDB (db/jobs.py) и делает копии
+фото/видео. Бот при JOB_BACKEND=mongo только скачивает исходники, ставит задачи
+и отправляет готовые копии, поэтому воркеров можно запускать на нескольких машинах.
+
+Запуск:
+    python worker.py
+"""
+import os
+import uuid
+import socket
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+from db.db import db
+from db.jobs import JobQueue, JOB_POLL_INTERVAL
+from service.executors import warm_up_executors, shutdown_executors, PHOTO_WORKERS
+from service.ffmpeg_caps import refresh_capabilities
+from service.scheduler import USER_MAX_IN_FLIGHT
+from service.video_profiles import probe_video
+from service.pipeline import process_photo_async, process_videos_async, JobBytes
+from service.workspace import WorkspaceManager, estimate_video_bytes
+from service.uniqueness import photo_guard, video_guard
+from metrics import start_metrics_server, stop_metrics_server
+
+load_dotenv()
+
+# Виды работ этого воркера и сколько задач он ведёт одновременно
+WORKER_KINDS = [k for k in os.getenv("WORKER_KINDS", "photo,video").split(",") if k]
+WORKER_SLOTS = int(os.getenv("WORKER_SLOTS", 2))
+# Порт /metrics воркера (свой, чтобы не конфликтовать с ботом на том же хосте); 0 — не запускать
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9109))
+
+logging.basicConfig(level=logging.INFO)
+
+# Рабочие папки видео-задач (общий бюджет места на все слоты воркера)
+workspaces = WorkspaceManager()
+
+
+class LeaseLost(Exception):
+    """Задачу отменили или её аренду забрал другой воркер."""
+
+
+async def _photo_copies(queue: JobQueue, job: dict, worker_id: str, on_progress):
+    payload = job["payload"]
+    source = await queue.files.get(payload["source_id"])
+    remaining = payload["copies"] - len(job["results"])
+    done = 0
+    # Копии прошлой попытки не хэшированы: сравниваем с исходником и копиями этой попытки
+    guard = await photo_guard(payload["key"], source)
+    job_bytes = JobBytes("photo", "standard")
+
+    async def one_copy(n: int):
+        nonlocal done
+        data = await process_photo_async(payload["key"], source, guard, job_bytes)
+        file_id = await queue.files.put(data, f"photo_{n}.jpg")
+        if not await queue.add_result(job["_id"], worker_id, file_id):
+            await queue.files.delete(file_id)
+            raise LeaseLost()
+        done += 1
+        on_progress(done / remaining)
+
+    # Не больше копий одновременно, чем процессов в пуле: остальные ждут своей очереди в пуле
+    semaphore = asyncio.Semaphore(PHOTO_WORKERS)
+
+    async def limited(n: int):
+        async with semaphore:
+            await one_copy(n)
+
+    await asyncio.gather(*(limited(n) for n in range(remaining)))
+    job_bytes.report(job["_id"])
+
+
+async def _video_copies(queue: JobQueue, job: dict, worker_id: str, on_progress):
+    payload = job["payload"]
+    source = await queue.files.get(payload["source_id"])
+    remaining = payload["copies"] - len(job["results"])
+    async with workspaces.acquire("video", estimate_video_bytes(len(source), remaining)) as ws:
+        input_path = ws.path("input.mp4")
+        with open(input_path, "wb") as f:
+            f.write(source)
+        del source
+        info = await asyncio.to_thread(probe_video, input_path)
+        guard = await video_guard(payload.get("key") or str(job["_id"]), input_path, info)
+
+        out_paths = [ws.path(f"output_{i}.mp4") for i in range(remaining)]
+        # Пакеты, как в боте: один запуск ffmpeg на USER_MAX_IN_FLIGHT копий
+        for start in range(0, remaining, USER_MAX_IN_FLIGHT):
+            paths = out_paths[start:start + USER_MAX_IN_FLIGHT]
+
+            def batch_progress(fraction: float, start=start, size=len(paths)):
+                on_progress((start + fraction * size) / remaining)
+
+            await process_videos_async(input_path, paths, payload.get("tier"), info, batch_progress, guard)
+            for path in paths:
+                with open(path, "rb") as f:
+                    file_id = await queue.files.put(f.read(), os.path.basename(path))
+                os.remove(path)
+                if not await queue.add_result(job["_id"], worker_id, file_id):
+                    await queue.files.delete(file_id)
+                    raise LeaseLost()
+
+
+async def process_job(queue: JobQueue, job: dict, worker_id: str):
+    """Обработка одной задачи с heartbeat; при потере аренды работа прерывается."""
+    progress = {"value": job.get("progress", 0.0)}
+
+    def on_progress(fraction: float):
+        progress["value"] = fraction
+
+    handler = _photo_copies if job["kind"] == "photo" else _video_copies
+    work = asyncio.ensure_future(handler(queue, job, worker_id, on_progress))
+
+    lease_lost = False
+
+    async def heartbeat():
+        nonlocal lease_lost
+        while True:
+            await asyncio.sleep(queue.lease_seconds / 3)
+            if not await queue.heartbeat(job["_id"], worker_id, progress["value"]):
+                lease_lost = True
+                work.cancel()
+                return
+
+    beat = asyncio.ensure_future(heartbeat())
+    try:
+        await work
+    except LeaseLost:
+        logging.info("Задача %s отменена или перехвачена другим воркером", job["_id"])
+        return
+    except asyncio.CancelledError:
+        if not lease_lost:
+            # Остановка воркера: возвращаем задачу в очередь, не дожидаясь истечения аренды
+            await queue.fail(job["_id"], worker_id, "воркер остановлен", retry=True)
+            raise
+        logging.info("Задача %s отменена или перехвачена другим воркером", job["_id"])
+        return
+    except Exception as e:
+        logging.exception("Ошибка в задаче %s", job["_id"])
+        # Ошибка самой обработки повторно обычно не лечится — сразу в failed
+        await queue.fail(job["_id"], worker_id, str(e) or type(e).__name__, error_type=type(e).__name__)
+        return
+    finally:
+        beat.cancel()
+
+    await queue.complete(job["_id"], worker_id)
+    logging.info("Задача %s (%s) готова", job["_id"], job["kind"])
+
+
+async def worker_slot(queue: JobQueue, worker_id: str):
+    """Один слот: берёт задачи по одной, пока воркер не остановят."""
+    while True:
+        job = await queue.claim(worker_id, WORKER_KINDS)
+        if job is None:
+            await queue.fail_exhausted()
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            continue
+        logging.info("Взята задача %s (%s, попытка %d)", job["_id"], job["kind"], job["attempts"])
+        await process_job(queue, job, worker_id)
+
+
+async def main():
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+    queue = JobQueue(db)
+    await queue.init()
+
+    await asyncio.to_thread(refresh_capabilities)
+    if "photo" in WORKER_KINDS:
+        await warm_up_executors()
+    await start_metrics_server(WORKER_METRICS_PORT)
+    await workspaces.start_sweeper()
+
+    logging.info("Воркер %s: виды %s, слотов %d", worker_id, ",".join(WORKER_KINDS), WORKER_SLOTS)
+    try:
+        await asyncio.gather(*(worker_slot(queue, worker_id) for _ in range(WORKER_SLOTS)))
+    finally:
+        await workspaces.stop_sweeper()
+        await stop_metrics_server()
+        shutdown_executors()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass